@@ -24,7 +24,7 @@ from packaging.requirements import Requirement
 from packaging.version import Version, parse
 from pynixify.nixpkgs_sources import (
     load_nixpkgs_data,
-    load_nixpkgs_version,
+    load_nixpkgs_context,
     NixpkgsData,
 )
 from pynixify.pypi_api import (
@@ -212,7 +212,7 @@ async def test_build_sampleproject_expression(fetchPypi):
         runtime_requirements=[c.package_for('peppercorn')]  # type: ignore
     )
     meta = await package.metadata()
-    expr = build_nix_expression(package, reqs, meta, sha256, await load_nixpkgs_version(), fetchPypi)
+    expr = build_nix_expression(package, reqs, meta, sha256, await load_nixpkgs_context(), fetchPypi)
 
     print(expr)
     wrapper_expr = f'(import <nixpkgs> {{}}).python3.pkgs.callPackage ({expr}) {{}}'
@@ -244,7 +244,7 @@ async def test_build_textwrap3_expression():
         runtime_requirements=[],
     )
     meta = await package.metadata()
-    expr = build_nix_expression(package, reqs, meta, sha256, await load_nixpkgs_version(), ('textwrap3', 'zip'))
+    expr = build_nix_expression(package, reqs, meta, sha256, await load_nixpkgs_context(), ('textwrap3', 'zip'))
     print(expr)
     wrapper_expr = f'(import <nixpkgs> {{}}).python3.pkgs.callPackage ({expr}) {{}}'
     print(wrapper_expr)
@@ -270,13 +270,15 @@ async def test_build_sampleproject_nixpkgs():
     package.version = Version('1.2.3')
     meta = await package.metadata()
     assert package.version == Version('1.3.1')
+    context = await load_nixpkgs_context()
     sampleproject_expr = build_nix_expression(
-        package, reqs, meta, sha256, await load_nixpkgs_version())
+        package, reqs, meta, sha256, context)
 
     with tempfile.NamedTemporaryFile(suffix='.nix') as fp:
         fp.write(sampleproject_expr.encode())
         fp.flush()
-        nixpkgs_expr = build_overlayed_nixpkgs({'sampleproject': Path(fp.name)})
+        nixpkgs_expr = build_overlayed_nixpkgs(
+            {'sampleproject': Path(fp.name)}, context)
         print(nixpkgs_expr)
         wrapper_expr = f"""(({nixpkgs_expr}) {{}}).python3.pkgs.sampleproject"""
         result = await run_nix_build(wrapper_expr)
@@ -291,6 +293,7 @@ async def test_build_sampleproject_nixpkgs():
     assert b'Call your main application code here' in stdout
 
 @pytest.mark.asyncio
-async def test_nixpkgs_version():
-    ver = await load_nixpkgs_version()
-    assert re.match(r'^\d{2}\.\d{2}', ver) is not None
+async def test_nixpkgs_context():
+    context = await load_nixpkgs_context()
+    assert re.match(r'^\d{2}\.\d{2}', context.version) is not None
+    assert 'python3' in context.interpreters
@@ -14,7 +14,6 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import json
 from pathlib import Path
 from dataclasses import dataclass
 from typing import Optional, Dict
@@ -37,46 +36,23 @@ class Package:
     def attr(self) -> str:
         raise NotImplementedError()
 
+    @property
+    def source_sha256(self) -> Optional[str]:
+        """The SHA256 of the source, if it is known without fetching it."""
+        return None
+
+    async def wheel_metadata(self) -> Optional[str]:
+        """The METADATA file of a wheel of the package, if available."""
+        return None
+
     async def metadata(self) -> PackageMetadata:
-        from pynixify.package_requirements import run_nix_build, NixBuildError
-        source = await self.source()
-        if source.name.endswith('.whl'):
-            # Some nixpkgs packages use a wheel as source, which don't have a
-            # setup.py file. For now, ignore them assume they have no metadata
-            return PackageMetadata(
-                description=None,
-                license=None,
-                url=None,
-            )
-        nix_expression_path = Path(__file__).parent / "data" / "parse_setuppy_data.nix"
-        assert nix_expression_path.exists()
-        nix_store_path = await run_nix_build(
-            str(nix_expression_path),
-            '--no-out-link',
-            '--no-build-output',
-            '--arg',
-            'file',
-            str(source.resolve())
-        )
-        if (nix_store_path / 'failed').exists():
-            print(f'Error parsing metadata of {source}. Assuming it has no metadata.')
-            return PackageMetadata(
-                url=None,
-                description=None,
-                license=None,
-            )
-        with (nix_store_path / 'meta.json').open() as fp:
-            metadata = json.load(fp)
-            try:
-                version: Optional[str] = metadata.pop('version')
-            except KeyError:
-                pass
-            else:
-                if version:  # it might be None
-                    # When using --local, version starts hardcoded to 0.1dev. This
-                    # will update it to its real value
-                    self.version = Version(version)
-            return PackageMetadata(**metadata)
+        from pynixify.package_requirements import eval_package
+        data = await eval_package(self)
+        if data.version:  # it might be None
+            # When using --local, version starts hardcoded to 0.1dev. This
+            # will update it to its real value
+            self.version = Version(data.version)
+        return data.metadata
 
 # mypy hack
 def parse_version(version: str) -> Version:
@@ -0,0 +1,132 @@
+# pynixify - Nix expression generator for Python packages
+# Copyright (C) 2020 Matías Lang
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import gzip
+import json
+import sqlite3
+import hashlib
+import tempfile
+from pathlib import Path
+from typing import Any, Optional
+
+
+def default_cache_dir() -> Path:
+    xdg_cache_home = os.environ.get('XDG_CACHE_HOME')
+    if xdg_cache_home:
+        return Path(xdg_cache_home) / 'pynixify'
+    return Path.home() / '.cache' / 'pynixify'
+
+
+_cache_dir: Optional[Path] = default_cache_dir()
+
+
+def set_cache_dir(path: Optional[Path]):
+    """Change the directory used for persistent caches.
+
+    Setting it to None disables all persistent caches, so every run will
+    start from scratch.
+    """
+    global _cache_dir, _database
+    _cache_dir = path
+    _database = None
+
+
+def get_cache_dir(*subdirs: str) -> Optional[Path]:
+    if _cache_dir is None:
+        return None
+    path = _cache_dir.joinpath(*subdirs)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def is_store_path(path: Path) -> bool:
+    # Only Nix store paths are immutable, so they are the only ones that can
+    # be safely used as cache keys
+    return str(path).startswith('/nix/store/')
+
+
+def cache_key(*parts: Any) -> str:
+    return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+
+def read_json(path: Path) -> Optional[Any]:
+    try:
+        with gzip.open(path, 'rt') as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        # A missing or corrupted entry is a cache miss
+        return None
+
+
+def write_json(path: Path, data: Any):
+    # Write to a temporary file and then rename it, so concurrent pynixify
+    # runs never see a half-written entry
+    (fd, tmp_name) = tempfile.mkstemp(dir=path.parent, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as raw, gzip.open(raw, 'wt') as fp:
+            json.dump(data, fp, separators=(',', ':'))
+        os.replace(tmp_name, path)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+
+
+class CacheDatabase:
+    """Persistent key-value store for small JSON-serializable values.
+
+    Entries are grouped by namespace, so different kinds of data can't
+    collide even if they use the same key.
+    """
+
+    def __init__(self, path: Path):
+        self.db = sqlite3.connect(str(path), timeout=30)
+        with self.db:
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    PRIMARY KEY (namespace, key)
+                )
+            """)
+
+    def get(self, namespace: str, key: str) -> Optional[Any]:
+        row = self.db.execute(
+            'SELECT value FROM entries WHERE namespace = ? AND key = ?',
+            (namespace, key)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def set(self, namespace: str, key: str, value: Any):
+        with self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO entries VALUES (?, ?, ?)',
+                (namespace, key, json.dumps(value)))
+
+
+_database: Optional[CacheDatabase] = None
+
+
+def get_database() -> Optional[CacheDatabase]:
+    global _database
+    if _database is None:
+        cache_dir = get_cache_dir()
+        if cache_dir is None:
+            return None
+        _database = CacheDatabase(cache_dir / 'cache.db')
+    return _database
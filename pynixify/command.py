@@ -16,39 +16,71 @@
 
 import re
 import os
+import sys
 import asyncio
 import argparse
 from pathlib import Path
+from dataclasses import asdict, replace
 from urllib.parse import urlparse
 from typing import List, Dict, Optional, Tuple
 from pkg_resources import parse_requirements
-import pynixify.nixpkgs_sources
 from pynixify.base import Package
+from pynixify.cache import (
+    cache_key,
+    get_cache_dir,
+    get_database,
+    set_cache_dir,
+)
+from pynixify.evaluator import (
+    EvaluatorPool,
+    get_evaluator,
+    set_evaluator,
+)
 from pynixify.nixpkgs_sources import (
     NixpkgsData,
+    LazyNixpkgsData,
     load_nixpkgs_data,
-    load_nixpkgs_version,
+    load_nixpkgs_context,
+    nix_path_args,
     set_max_jobs,
+    set_nixpkgs_url,
 )
 from pynixify.pypi_api import (
     PyPICache,
     PyPIData,
 )
+from pynixify.scheduler import (
+    scheduler,
+    set_priority,
+    PRIORITY_WRITE,
+)
 from pynixify.version_chooser import (
     VersionChooser,
+    BacktrackingVersionChooser,
     ChosenPackageRequirements,
     evaluate_package_requirements,
 )
+from pynixify.trace import (
+    ChromeTracer,
+    Tracer,
+    get_tracer,
+    event,
+    set_tracer,
+    span,
+)
 from pynixify.expression_builder import (
     build_nix_expression,
     build_overlayed_nixpkgs,
     build_overlay_expr,
     build_shell_nix_expression,
-    nixfmt,
+    nixfmt_many,
+    BUILDER_VERSION,
 )
+from pynixify.manifest import Manifest
+from pynixify.lock import Lock, LockedPackage, LOCK_FILENAME
 from pynixify.pypi_api import (
     PyPIPackage,
-    get_path_hash,
+    get_package_hash,
 )
 from packaging.requirements import Requirement
 from packaging.utils import canonicalize_name
@@ -57,10 +89,21 @@ from packaging.utils import canonicalize_name
 async def _build_version_chooser(
         load_test_requirements_for: List[str],
         ignore_test_requirements_for: List[str],
-        load_all_test_requirements: bool) -> VersionChooser:
-    nixpkgs_data = NixpkgsData(await load_nixpkgs_data({}))
-    pypi_cache = PyPICache()
-    pypi_data = PyPIData(pypi_cache)
+        load_all_test_requirements: bool,
+        max_http_connections: int = 10,
+        resolver: str = 'greedy',
+        wheel_metadata: bool = False,
+        lazy_nixpkgs: bool = False) -> VersionChooser:
+    nixpkgs_data: NixpkgsData
+    if lazy_nixpkgs:
+        nixpkgs_data = LazyNixpkgsData()
+    else:
+        nixpkgs_data = NixpkgsData(await load_nixpkgs_data({}))
+    pypi_cache = PyPICache(
+        cache_dir=get_cache_dir('pypi'),
+        max_connections=max_http_connections,
+    )
+    pypi_data = PyPIData(pypi_cache, wheel_metadata=wheel_metadata)
     def should_load_tests(package_name):
         if canonicalize_name(package_name) in [
                 canonicalize_name(n)
@@ -70,7 +113,11 @@ async def _build_version_chooser(
         return load_all_test_requirements or canonicalize_name(package_name) in [
             canonicalize_name(n)
             for n in load_test_requirements_for]
-    version_chooser = VersionChooser(
+    chooser_class = {
+        'greedy': VersionChooser,
+        'backtracking': BacktrackingVersionChooser,
+    }[resolver]
+    version_chooser = chooser_class(
         nixpkgs_data, pypi_data,
         req_evaluate=evaluate_package_requirements,
         should_load_tests=should_load_tests,
@@ -153,20 +200,173 @@ def main():
             "executed by pynixify. If it isn't specified, it will be set to "
             "the number of CPUs in the system."
         ))
+    parser.add_argument(
+        '--resolver',
+        choices=['greedy', 'backtracking'],
+        help=(
+            "Algorithm used to choose the version of each package. The "
+            "greedy resolver picks the newest version and fails if a later "
+            "requirement doesn't match it. The backtracking one tries "
+            "older versions until it finds a combination that satisfies "
+            "every requirement. [default: greedy]"
+        ))
+    parser.add_argument(
+        '--lazy-nixpkgs',
+        action='store_true',
+        help=(
+            "Only evaluate the nixpkgs packages named like the required "
+            "ones, instead of every Python package in nixpkgs. This makes "
+            "runs with few requirements start much faster, but packages "
+            "whose nixpkgs attribute isn't named after their PyPI name "
+            "will be taken from PyPI."
+        ))
+    parser.add_argument(
+        '--nix-workers',
+        type=int,
+        default=0,
+        metavar='N',
+        help=(
+            "Evaluate Nix expressions in up to N long-lived nix repl "
+            "processes that keep nixpkgs loaded, instead of starting a "
+            "nix-instantiate process for each evaluation. Each worker "
+            "uses as much memory as an evaluation of nixpkgs. Requires "
+            "Nix 2.4 or newer. [default: 0, disabled]"
+        ))
+    parser.add_argument(
+        '--wheel-metadata',
+        action='store_true',
+        help=(
+            "Read the requirements of PyPI packages from the metadata of "
+            "their pure Python wheels when available, instead of building "
+            "their source distributions. This is much faster, but wheels "
+            "don't include build requirements (e.g. setuptools_scm), so "
+            "they have to be added by hand if needed."
+        ))
+    parser.add_argument(
+        '--max-http-connections',
+        type=int,
+        default=10,
+        help=(
+            "Sets the maximum number of simultaneous connections to PyPI. "
+            "Connections are reused between requests. [default: 10]"
+        ))
+    parser.add_argument(
+        '--verify-fetchpypi',
+        action='store_true',
+        help=(
+            "Download every package from its mirror://pypi URL to check "
+            "that it can be fetched with fetchPypi, instead of trusting "
+            "PyPI metadata."
+        ))
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help=(
+            "Only regenerate the files whose inputs changed since the "
+            "last --incremental run. Unchanged files aren't rewritten."
+        ))
+    parser.add_argument(
+        '--from-lock',
+        action='store_true',
+        help=(
+            "Generate the expressions from the lock.json file written by a "
+            "previous run in the output directory, without resolving "
+            "dependencies again."
+        ))
+    trace_group = parser.add_mutually_exclusive_group()
+    trace_group.add_argument(
+        '--trace',
+        metavar='FILE',
+        help=(
+            "Write to FILE a JSON object per line describing how long each "
+            "phase and package took, and how long each process waited "
+            "for its turn to run."
+        ))
+    trace_group.add_argument(
+        '--chrome-trace',
+        metavar='FILE',
+        help=(
+            "Write the same information as --trace to FILE in the Chrome "
+            "trace-event format, to be opened with Perfetto or "
+            "chrome://tracing. It shows a track per asyncio task, per "
+            "process slot and per HTTP connection."
+        ))
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help=(
+            "Don't use the persistent caches stored in "
+            "$XDG_CACHE_HOME/pynixify between runs."
+        ))
     args = parser.parse_args()
 
-    asyncio.run(_main_async(
-        requirements=args.requirement,
-        requirement_files=args.r or [],
-        local=args.local,
-        output_dir=args.output,
-        nixpkgs=args.nixpkgs,
-        load_all_test_requirements=args.all_tests,
-        load_test_requirements_for=args.tests.split(',') if args.tests else [],
-        ignore_test_requirements_for=args.ignore_tests.split(',') if args.ignore_tests else [],
-        max_jobs=args.max_jobs,
-        generate_only_overlay=args.overlay_only,
-    ))
+    if args.from_lock:
+        # These options only affect the resolution, which is replaced by
+        # the contents of the lock
+        resolution_options = [
+            ('requirements', args.requirement),
+            ('-r', args.r),
+            ('--local', args.local),
+            ('--nixpkgs', args.nixpkgs),
+            ('--resolver', args.resolver),
+            ('--all-tests', args.all_tests),
+            ('--tests', args.tests),
+            ('--ignore-tests', args.ignore_tests),
+            ('--lazy-nixpkgs', args.lazy_nixpkgs),
+            ('--nix-workers', args.nix_workers),
+            ('--wheel-metadata', args.wheel_metadata),
+            ('--verify-fetchpypi', args.verify_fetchpypi),
+        ]
+        conflicting = [name for (name, value) in resolution_options if value]
+        if conflicting:
+            parser.error(
+                f"--from-lock can't be used with {', '.join(conflicting)}. "
+                f"They are taken from the lock instead.")
+
+    if args.no_cache:
+        set_cache_dir(None)
+
+    if args.trace:
+        set_tracer(Tracer(open(args.trace, 'w')))
+    elif args.chrome_trace:
+        set_tracer(ChromeTracer(open(args.chrome_trace, 'w')))
+
+    try:
+        asyncio.run(_main_async(
+            requirements=args.requirement,
+            requirement_files=args.r or [],
+            local=args.local,
+            output_dir=args.output,
+            nixpkgs=args.nixpkgs,
+            load_all_test_requirements=args.all_tests,
+            load_test_requirements_for=args.tests.split(',') if args.tests else [],
+            ignore_test_requirements_for=args.ignore_tests.split(',') if args.ignore_tests else [],
+            max_jobs=args.max_jobs,
+            generate_only_overlay=args.overlay_only,
+            max_http_connections=args.max_http_connections,
+            verify_fetchpypi=args.verify_fetchpypi,
+            incremental=args.incremental,
+            from_lock=args.from_lock,
+            resolver=args.resolver or 'greedy',
+            wheel_metadata=args.wheel_metadata,
+            lazy_nixpkgs=args.lazy_nixpkgs,
+            nix_workers=args.nix_workers,
+        ))
+    finally:
+        tracer = get_tracer()
+        if tracer is not None:
+            set_tracer(None)
+            tracer.close()
+
+def _load_lock(lock_path: Path) -> Lock:
+    try:
+        return Lock.load(lock_path)
+    except FileNotFoundError:
+        sys.exit(f'error: {lock_path} not found. Run pynixify without '
+                 f'--from-lock to create it.')
+    except ValueError as e:
+        # An invalid JSON file or a lock from an incompatible version
+        sys.exit(f'error: could not load {lock_path}: {e}')
 
 async def _main_async(
         requirements: List[str],
@@ -178,22 +378,97 @@ async def _main_async(
         ignore_test_requirements_for: List[str],
         load_all_test_requirements: bool,
         max_jobs: Optional[int],
-        generate_only_overlay:bool):
-
-    if nixpkgs is not None:
-        pynixify.nixpkgs_sources.NIXPKGS_URL = nixpkgs
+        generate_only_overlay:bool,
+        max_http_connections: int = 10,
+        verify_fetchpypi: bool = False,
+        incremental: bool = False,
+        from_lock: bool = False,
+        resolver: str = 'greedy',
+        wheel_metadata: bool = False,
+        lazy_nixpkgs: bool = False,
+        nix_workers: int = 0):
+
+    set_nixpkgs_url(nixpkgs)
 
     if max_jobs is not None:
         set_max_jobs(max_jobs)
 
-    version_chooser: VersionChooser = await _build_version_chooser(
-        load_test_requirements_for, ignore_test_requirements_for,
-        load_all_test_requirements)
-
-    if local is not None:
-        await version_chooser.require_local(local, Path.cwd())
-
+    output_dir = output_dir or 'pynixify'
+    base_path = Path.cwd() / output_dir
+    lock_path = base_path / LOCK_FILENAME
+
+    if from_lock:
+        # The lock has everything needed to build the expressions, so
+        # there is no need to access PyPI or to evaluate nixpkgs
+        await _write_expressions(
+            _load_lock(lock_path), base_path, generate_only_overlay,
+            incremental)
+        _report_scheduler_stats()
+        return
+
+    previous_lock: Optional[Lock] = None
+    if incremental and lock_path.exists():
+        previous_lock = _load_lock(lock_path)
+
+    if nix_workers:
+        set_evaluator(EvaluatorPool(nix_workers, nix_path_args()))
+    try:
+        version_chooser: VersionChooser = await _build_version_chooser(
+            load_test_requirements_for, ignore_test_requirements_for,
+            load_all_test_requirements, max_http_connections, resolver,
+            wheel_metadata, lazy_nixpkgs)
+        try:
+            lock = await _resolve(
+                version_chooser,
+                requirements=requirements,
+                requirement_files=requirement_files,
+                local=local,
+                nixpkgs=nixpkgs,
+                previous_lock=previous_lock,
+                verify_fetchpypi=verify_fetchpypi,
+            )
+        finally:
+            await version_chooser.pypi_data.pypi_cache.close()
+    finally:
+        evaluator = get_evaluator()
+        if evaluator is not None:
+            set_evaluator(None)
+            await evaluator.close()
+
+    await _write_expressions(
+        lock, base_path, generate_only_overlay, incremental)
+    lock.save(lock_path)
+    _report_scheduler_stats()
+
+
+def _report_scheduler_stats():
+    """Show how many processes each program ran and how long they waited
+    for their budget."""
+    summaries = []
+    for (program, stats) in sorted(scheduler.stats().items()):
+        if not stats.acquisitions:
+            continue
+        event('scheduler-stats', program=program, **asdict(stats))
+        summaries.append(
+            f'{program}: {stats.acquisitions} runs, '
+            f'max queue {stats.max_queue_depth}, '
+            f'waited {stats.total_wait:.1f}s')
+    if summaries:
+        print('Processes: ' + '; '.join(summaries), file=sys.stderr)
+
+
+async def _resolve(
+        version_chooser: VersionChooser,
+        requirements: List[str],
+        requirement_files: List[str],
+        local: Optional[str],
+        nixpkgs: Optional[str],
+        previous_lock: Optional[Lock],
+        verify_fetchpypi: bool) -> Lock:
     all_requirements: List[Requirement] = []
+    if local is not None:
+        all_requirements.append(
+            version_chooser.add_local(local, Path.cwd()))
     for requirement_file in requirement_files:
         with open(requirement_file) as fp:
             for r in parse_requirements(fp.read()):
@@ -202,83 +477,177 @@ async def _main_async(
     for req_ in requirements:
         all_requirements.append(Requirement(req_))
 
-    await asyncio.gather(*(
-        version_chooser.require(req)
-        for req in all_requirements
-    ))
+    with span('phase', phase='resolve'):
+        await version_chooser.require_all(all_requirements)
 
-    output_dir = output_dir or 'pynixify'
-    base_path = Path.cwd() / output_dir
-    packages_path = base_path / 'packages'
-    packages_path.mkdir(parents=True, exist_ok=True)
+    # From now on, spawned processes are less urgent than the ones needed
+    # for resolving dependencies
+    set_priority(PRIORITY_WRITE)
 
-    overlays: Dict[str, Path] = {}
-    package: PyPIPackage
+    chosen_packages = version_chooser.all_packages()
+    names: Dict[int, str] = {
+        id(package): name
+        for (name, package) in chosen_packages.items()
+    }
+
+    def names_of(packages: List[Package]) -> List[str]:
+        return [names[id(p)] for p in packages]
+
+    async def lock_package(name: str, package: Package) -> LockedPackage:
+        if not isinstance(package, PyPIPackage):
+            return LockedPackage(
+                origin='nixpkgs',
+                attr=package.attr,
+                version=str(package.version),
+            )
 
-    async def write_package_expression(package: PyPIPackage):
         reqs: ChosenPackageRequirements
         reqs = ChosenPackageRequirements.from_package_requirements(
             await evaluate_package_requirements(package),
             version_chooser=version_chooser,
             load_tests=version_chooser.should_load_tests(package.pypi_name),
         )
+        locked = LockedPackage(
+            origin='pypi',
+            attr=package.attr,
+            version=str(package.version),
+            download_url=package.download_url,
+            sha256=package.sha256,
+            local=package.local_source is not None,
+            build_requirements=names_of(reqs.build_requirements),
+            test_requirements=names_of(reqs.test_requirements),
+            runtime_requirements=names_of(reqs.runtime_requirements),
+        )
 
-        sha256 = await get_path_hash(await package.source())
-        meta = await package.metadata()
-        version = await load_nixpkgs_version()
+        previous = previous_lock.packages.get(name) if previous_lock else None
+        if (previous is not None and not locked.local and
+                not verify_fetchpypi and
+                replace(previous, nix_sha256=None, fetch_pypi=None,
+                        metadata=None) == locked):
+            # Nothing changed since the previous run, so there is no need
+            # to fetch the source, parse its metadata or check fetchPypi
+            return previous
+
+        locked.nix_sha256 = await get_package_hash(package)
+        locked.metadata = asdict(await package.metadata())
+        # Parsing the metadata can update the version of local packages
+        locked.version = str(package.version)
         try:
             (pname, ext) = await get_pypi_data(
-                package.download_url,
-                str(package.version),
-                sha256
-            )
+                package, locked.nix_sha256, verify=verify_fetchpypi)
         except RuntimeError:
-            expr = build_nix_expression(
-                package, reqs, meta, sha256, version)
+            pass
         else:
+            locked.fetch_pypi = [pname, ext]
+        return locked
+
+    with span('phase', phase='lock'):
+        locked_packages = await asyncio.gather(*(
+            lock_package(name, package)
+            for (name, package) in chosen_packages.items()
+        ))
+
+    nixpkgs_sha256: Optional[str] = None
+    if nixpkgs is not None:
+        if previous_lock is not None and previous_lock.nixpkgs_url == nixpkgs:
+            nixpkgs_sha256 = previous_lock.nixpkgs_sha256
+        else:
+            nixpkgs_sha256 = await get_url_hash(nixpkgs)
+
+    context = await load_nixpkgs_context(nixpkgs_sha256)
+    return Lock(
+        nixpkgs_version=context.version,
+        requirements=[str(r) for r in all_requirements],
+        packages=dict(zip(chosen_packages, locked_packages)),
+        nixpkgs_url=context.url,
+        nixpkgs_sha256=context.sha256,
+        local=canonicalize_name(local) if local is not None else None,
+        nixpkgs_interpreters=list(context.interpreters),
+    )
+
+
+async def _write_expressions(
+        lock: Lock,
+        base_path: Path,
+        generate_only_overlay: bool,
+        incremental: bool):
+    packages_path = base_path / 'packages'
+    packages_path.mkdir(parents=True, exist_ok=True)
+
+    manifest: Optional[Manifest] = None
+    if incremental:
+        manifest = Manifest.load(base_path)
+
+    nixpkgs = lock.nixpkgs_context()
+    overlays: Dict[str, Path] = {}
+    # Rendered expressions, formatted all together before writing them
+    outputs: Dict[Path, str] = {}
+
+    def add_output(path: Path, expr: str):
+        inputs = {'builder': BUILDER_VERSION, 'expr': expr}
+        if manifest is not None:
+            if manifest.is_fresh(path, inputs):
+                return
+            manifest.record(path, inputs)
+        outputs[path] = expr
+
+    for (name, locked) in sorted(lock.packages.items()):
+        if locked.origin != 'pypi':
+            continue
+        package = lock.package(name)
+        assert isinstance(package, PyPIPackage)
+        assert locked.nix_sha256 is not None
+        reqs = ChosenPackageRequirements(
+            build_requirements=[
+                lock.package(n) for n in locked.build_requirements],
+            test_requirements=[
+                lock.package(n) for n in locked.test_requirements],
+            runtime_requirements=[
+                lock.package(n) for n in locked.runtime_requirements],
+        )
+        fetchPypi: Optional[Tuple[str, str]] = None
+        if locked.fetch_pypi is not None:
+            (pname, ext) = locked.fetch_pypi
+            fetchPypi = (pname, ext)
+        with span('render', package=name):
             expr = build_nix_expression(
-                package, reqs, meta, sha256, version, fetchPypi=(pname, ext))
+                package, reqs, lock.metadata(name), locked.nix_sha256,
+                nixpkgs, fetchPypi=fetchPypi)
         expression_dir = (packages_path / f'{package.pypi_name}/')
         expression_dir.mkdir(exist_ok=True)
         expression_path = expression_dir / 'default.nix'
-        with expression_path.open('w') as fp:
-            fp.write(await nixfmt(expr))
-        expression_path = expression_path.relative_to(base_path)
-        overlays[package.attr] = expression_path
-
-    await asyncio.gather(*(
-        write_package_expression(package)
-        for package in version_chooser.all_pypi_packages()
-    ))
+        add_output(expression_path, expr)
+        overlays[package.attr] = expression_path.relative_to(base_path)
 
     if generate_only_overlay:
-        with (base_path / 'overlay.nix').open('w') as fp:
-            expr = build_overlay_expr(overlays)
-            fp.write(await nixfmt(expr))
-            return
-
-
-    with (base_path / 'nixpkgs.nix').open('w') as fp:
-        if nixpkgs is None:
-            expr = build_overlayed_nixpkgs(overlays)
-        else:
-            sha256 = await get_url_hash(nixpkgs)
-            expr = build_overlayed_nixpkgs(overlays, (nixpkgs, sha256))
-        fp.write(await nixfmt(expr))
-
-    packages: List[Package] = []
-    for req in all_requirements:
-        p: Optional[Package] = version_chooser.package_for(req.name)
-        assert p is not None
-        packages.append(p)
-    if local is not None:
-        p = version_chooser.package_for(local)
-        assert p is not None
-        packages.append(p)
-
-    with (base_path / 'shell.nix').open('w') as fp:
-        expr = build_shell_nix_expression(packages)
-        fp.write(await nixfmt(expr))
+        add_output(base_path / 'overlay.nix', build_overlay_expr(overlays))
+    else:
+        add_output(
+            base_path / 'nixpkgs.nix',
+            build_overlayed_nixpkgs(overlays, nixpkgs))
+
+        packages: List[Package] = []
+        for r in lock.requirements:
+            name = canonicalize_name(Requirement(r).name)
+            # Requirements whose marker doesn't match aren't in the lock
+            if name in lock.packages:
+                packages.append(lock.package(name))
+        if lock.local is not None:
+            packages.append(lock.package(lock.local))
+
+        add_output(base_path / 'shell.nix', build_shell_nix_expression(packages))
+
+    with span('format', files=len(outputs)):
+        formatted = await nixfmt_many(list(outputs.values()))
+    for (path, expr) in zip(outputs, formatted):
+        if incremental and path.exists() and path.read_text() == expr:
+            # Keep the modification time of files that didn't change
+            continue
+        with span('write', path=str(path)), path.open('w') as fp:
+            fp.write(expr)
+
+    if manifest is not None:
+        manifest.save()
 
 
 async def get_url_hash(url: str, unpack=True) -> str:
@@ -287,26 +656,29 @@ async def get_url_hash(url: str, unpack=True) -> str:
         cmd.append('--unpack')
     cmd.append(url)
 
-    proc = await asyncio.create_subprocess_exec(
-        *cmd,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.DEVNULL,
-    )
-    (stdout, _) = await proc.communicate()
-    status = await proc.wait()
+    (status, stdout, _) = await scheduler.run(*cmd)
     if status != 0:
         raise RuntimeError(f'Could not get hash of URL: {url}')
     return stdout.decode().strip()
 
 
-async def get_pypi_data(url: str, version: str, sha256: str) -> Tuple[str, str]:
+async def get_pypi_data(package: PyPIPackage, sha256: str,
+                        verify: bool = False) -> Tuple[str, str]:
     """Try to form a fetchPypi pname and extension to avoid using builtins.fetchurl.
 
     If this fails, the generated expression will use builtins.fetchurl. It will
     work perfectly, but the code of the expression won't be of nixpkgs quality.
     Most Python expressions in nixpkgs use fetchPypi instead of raw
     builtins.fetchurl, so our generated expression should do it too.
+
+    When the sdist is hosted by PyPI and its filename matches the package
+    name, the mirror://pypi URL serves the same file, whose hash we already
+    know from PyPI metadata. Otherwise, or if verify is set, the file is
+    downloaded from the mirror to compare its hash. Decisions are recorded
+    in the persistent cache.
     """
+    url = package.download_url
+    version = str(package.version)
     filename = Path(urlparse(url).path).name
     match = re.match(
         f'(?P<pname>.+)-{re.escape(version)}\\.(?P<ext>.+)',
@@ -319,8 +691,21 @@ async def get_pypi_data(url: str, version: str, sha256: str) -> Tuple[str, str]:
     # See <nixpkgs>/pkgs/development/python-modules/ansiwrap/default.nix
     # "mirror://pypi/${builtins.substring 0 1 pname}/${pname}/${pname}-${version}.${extension}";
     url = f'mirror://pypi/{pname[0]}/{pname}/{pname}-{version}.{ext}'
-    newhash = await get_url_hash(url, unpack=False)
-    if newhash != sha256:
+
+    database = get_database()
+    key = cache_key(package.download_url, sha256)
+    decision = database.get('fetchpypi', key) if database else None
+    if decision is None or (verify and not decision['verified']):
+        if (not verify and
+                urlparse(package.download_url).hostname == 'files.pythonhosted.org' and
+                canonicalize_name(pname) == canonicalize_name(package.pypi_name)):
+            decision = {'valid': True, 'verified': False}
+        else:
+            newhash = await get_url_hash(url, unpack=False)
+            decision = {'valid': newhash == sha256, 'verified': True}
+        if database is not None:
+            database.set('fetchpypi', key, decision)
+    if not decision['valid']:
         raise RuntimeError(f'Invalid hash for URL: {url}')
     return (pname, ext)
 
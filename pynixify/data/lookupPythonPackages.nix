@@ -0,0 +1,43 @@
+# Evaluate only the given attrs of python3Packages, instead of all of them
+# like pythonPackages.nix does. Attrs that don't exist or that fail to
+# evaluate are returned as null. Like in pythonPackages.nix, user overlays
+# and config aren't used.
+{ attrs, pkgs ? import <nixpkgs> {
+  overlays = [ ];
+  config = { };
+} }:
+
+with pkgs;
+
+let
+  srcUrl = value:
+    if !value ? src then
+      null
+    else if !(builtins.tryEval value.src).success then
+      null
+    else if !value.src ? urls then
+      null
+    else
+      builtins.head value.src.urls;
+
+  lookUp = attr:
+    let
+      value = python3Packages.${attr};
+      record = if builtins.isNull value || !value ? version then
+        null
+      else {
+        inherit attr;
+        version = value.version;
+        src = srcUrl value;
+      };
+      # The fields are evaluated lazily, so force all of them inside
+      # tryEval. Otherwise a broken attr would abort the whole batch.
+      result = builtins.tryEval (builtins.deepSeq record record);
+    in if !(python3Packages ? ${attr}) then
+      null
+    else if result.success then
+      result.value
+    else
+      null;
+
+in map lookUp attrs
@@ -1,4 +1,11 @@
-with (import <nixpkgs> { });
+# User overlays and config aren't used, so the result only depends on the
+# nixpkgs source and can be cached by its store path
+{ pkgs ? import <nixpkgs> {
+  overlays = [ ];
+  config = { };
+} }:
+
+with pkgs;
 
 let
   allPackages = python3Packages;
@@ -0,0 +1,237 @@
+# pynixify - Nix expression generator for Python packages
+# Copyright (C) 2020 Matías Lang
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Evaluate Nix expressions in long-lived nix repl processes.
+
+Every nix-instantiate process parses and evaluates nixpkgs from scratch.
+A nix repl keeps everything it evaluated, so the queries sent to the same
+worker share the parsed files and the nixpkgs set bound to the pkgs
+argument of the queried functions.
+"""
+
+import os
+import re
+import json
+import asyncio
+import tempfile
+import itertools
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence
+from pynixify.exceptions import NixBuildError
+from pynixify.scheduler import Budget
+
+NIX_REPL_COMMAND = (
+    'nix', '--extra-experimental-features', 'nix-command', 'repl')
+
+# The output of some queries, like the evaluation of every Python package,
+# is a single line of many megabytes
+MAX_LINE_LENGTH = 2**30
+
+_evaluator: Optional['EvaluatorPool'] = None
+
+
+def set_evaluator(evaluator: Optional['EvaluatorPool']):
+    """Evaluate Nix expressions with the given pool of workers.
+
+    Setting it to None makes each evaluation run its own nix-instantiate
+    process.
+    """
+    global _evaluator
+    _evaluator = evaluator
+
+
+def get_evaluator() -> Optional['EvaluatorPool']:
+    return _evaluator
+
+
+def query_source(expr: str, attr: Optional[str] = None,
+                 args: Dict[str, str] = {}) -> str:
+    """Build a function that takes the nixpkgs set of the worker and
+    returns the JSON representation of the expression.
+
+    Like nix-instantiate, if the expression is a function it is called
+    with the given args, whose values are Nix expressions. Functions with
+    a pkgs argument get the nixpkgs set of the worker.
+    """
+    args_source = ' '.join(f'{name} = ({value});'
+                           for (name, value) in args.items())
+    attr_path = ' '.join(
+        json.dumps(name) for name in attr.split('.')) if attr else ''
+    return f"""
+        pynixifyPkgs:
+        let
+          f = (
+            {expr}
+          );
+          args = {{ pkgs = pynixifyPkgs; {args_source} }};
+          value = if builtins.isFunction f then
+            f (builtins.intersectAttrs (builtins.functionArgs f) args)
+          else
+            f;
+        in builtins.toJSON
+        (builtins.foldl' (v: name: v.${{name}}) value [ {attr_path} ])
+    """
+
+
+_ESCAPES = {'n': '\n', 'r': '\r', 't': '\t'}
+
+
+def unescape_nix_string(literal: str) -> str:
+    """Get the value of a string printed by nix repl."""
+    if len(literal) < 2 or literal[0] != '"' or literal[-1] != '"':
+        raise ValueError(f'Not a Nix string: {literal!r}')
+    return re.sub(
+        r'\\(.)', lambda m: _ESCAPES.get(m.group(1), m.group(1)),
+        literal[1:-1], flags=re.DOTALL)
+
+
+class NixEvaluator:
+    """A nix repl process that evaluates one query at a time.
+
+    Each query is followed by a string sentinel. Everything the repl
+    prints before the sentinel is the result of the query, which is
+    empty when its evaluation failed.
+    """
+
+    def __init__(self, proc: asyncio.subprocess.Process, tmp_dir: Path):
+        self.proc = proc
+        self.tmp_dir = tmp_dir
+        self._counter = itertools.count()
+        self._stderr = bytearray()
+        self._stderr_task = asyncio.ensure_future(self._read_stderr())
+
+    @classmethod
+    async def start(cls, command: Sequence[str],
+                    tmp_dir: Path) -> 'NixEvaluator':
+        proc = await asyncio.create_subprocess_exec(
+            *command,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            limit=MAX_LINE_LENGTH,
+            env={**os.environ, 'NO_COLOR': '1', 'TERM': 'dumb'},
+        )
+        evaluator = cls(proc, tmp_dir)
+        try:
+            # It is lazy, so nixpkgs is only evaluated by the first query
+            # that uses it. User overlays and config aren't used, like in
+            # pythonPackages.nix.
+            await evaluator._run('pynixifyPkgs = import <nixpkgs> '
+                                 '{ overlays = [ ]; config = { }; }')
+        except BaseException:
+            await evaluator.close()
+            raise
+        return evaluator
+
+    async def _read_stderr(self):
+        assert self.proc.stderr is not None
+        while True:
+            chunk = await self.proc.stderr.read(2**16)
+            if not chunk:
+                break
+            self._stderr += chunk
+
+    async def _run(self, line: str) -> List[str]:
+        assert self.proc.stdin is not None and self.proc.stdout is not None
+        sentinel = f'"pynixify-done-{next(self._counter)}"'
+        self._stderr.clear()
+        self.proc.stdin.write(f'{line}\n{sentinel}\n'.encode())
+        await self.proc.stdin.drain()
+        lines: List[str] = []
+        while True:
+            raw = await self.proc.stdout.readline()
+            if not raw:
+                raise NixBuildError(
+                    f'nix repl exited unexpectedly: '
+                    f'{self._stderr.decode(errors="replace")}')
+            output = raw.decode().strip()
+            if output.endswith(sentinel):
+                return lines
+            if '"' in output:
+                # Skip the prompt, if any
+                lines.append(output[output.index('"'):])
+
+    async def evaluate(self, expr: str, attr: Optional[str] = None,
+                       args: Dict[str, str] = {}) -> Any:
+        path = self.tmp_dir / f'query-{id(self)}-{next(self._counter)}.nix'
+        # The query is imported from a file, so it can span multiple lines
+        # and it isn't mistaken for a repl command
+        path.write_text(query_source(expr, attr, args))
+        try:
+            lines = await self._run(f'import {path} pynixifyPkgs')
+        finally:
+            path.unlink()
+        if len(lines) != 1:
+            raise NixBuildError(
+                f'Nix evaluation failed: '
+                f'{self._stderr.decode(errors="replace")}')
+        return json.loads(unescape_nix_string(lines[0]))
+
+    @property
+    def exited(self) -> bool:
+        assert self.proc.stdout is not None
+        return self.proc.stdout.at_eof()
+
+    async def close(self):
+        if self.proc.returncode is None:
+            self.proc.kill()
+            await self.proc.wait()
+        await self._stderr_task
+
+
+class EvaluatorPool:
+    """Run Nix evaluations in up to size nix repl workers.
+
+    Workers are started on demand and reused until the pool is closed.
+    Each one keeps its own copy of nixpkgs in memory.
+    """
+
+    def __init__(self, size: int, nix_path: Sequence[str] = (),
+                 command: Sequence[str] = NIX_REPL_COMMAND):
+        self.command = [*command, *nix_path]
+        self._budget = Budget(size)
+        self._idle: List[NixEvaluator] = []
+        self._tmp_dir = tempfile.TemporaryDirectory(prefix='pynixify-eval-')
+
+    async def evaluate(self, expr: str, attr: Optional[str] = None,
+                       args: Dict[str, str] = {}) -> Any:
+        async with self._budget.slot():
+            if self._idle:
+                worker = self._idle.pop()
+            else:
+                worker = await NixEvaluator.start(
+                    self.command, Path(self._tmp_dir.name))
+            try:
+                result = await worker.evaluate(expr, attr, args)
+            except NixBuildError:
+                if worker.exited:
+                    await worker.close()
+                else:
+                    self._idle.append(worker)
+                raise
+            except BaseException:
+                # The worker could still be evaluating the query, so its
+                # output can't be trusted anymore
+                await worker.close()
+                raise
+            self._idle.append(worker)
+            return result
+
+    async def close(self):
+        (workers, self._idle) = (self._idle, [])
+        for worker in workers:
+            await worker.close()
+        self._tmp_dir.cleanup()
@@ -14,16 +14,25 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import sys
 import asyncio
+import hashlib
+import tempfile
 from pathlib import Path
-from typing import Iterable, Mapping, List, Set, Optional, Tuple
+from typing import Iterable, Mapping, List, Set, Optional, Sequence, Tuple
 from mako.template import Template
 from pynixify.version_chooser import (
     VersionChooser,
     ChosenPackageRequirements,
 )
 from pynixify.base import PackageMetadata, Package
+from pynixify.nixpkgs_sources import NixpkgsContext
 from pynixify.pypi_api import PyPIPackage
+from pynixify.scheduler import scheduler, PRIORITY_FORMAT
+
+# Changes to this module can change the generated expressions, so they
+# invalidate the files written by previous --incremental runs
+BUILDER_VERSION = hashlib.sha256(Path(__file__).read_bytes()).hexdigest()
 
 DISCLAIMER = """
 # WARNING: This file was automatically generated. You should avoid editing it.
@@ -100,13 +109,12 @@ overlayed_nixpkgs_template = Template("""${DISCLAIMER}
         };
 
         nixpkgs =
-            % if nixpkgs is None:
+            % if nixpkgs.url is None:
                 <nixpkgs>;
             % else:
-                <% (url, sha256) = nixpkgs %>
                 builtins.fetchTarball {
-                    url = ${url | nix};
-                    sha256 = "${sha256}";
+                    url = ${nixpkgs.url | nix};
+                    sha256 = "${nixpkgs.sha256}";
                 };
             % endif
 
@@ -145,7 +153,7 @@ def build_nix_expression(
         requirements: ChosenPackageRequirements,
         metadata: PackageMetadata,
         sha256: str,
-        nixpkgs_version: str,
+        nixpkgs: NixpkgsContext,
         fetchPypi: Optional[Tuple[str, str]] = None,
     ) -> str:
     non_python_dependencies = ['lib', 'fetchPypi', 'buildPythonPackage']
@@ -163,7 +171,7 @@ def build_nix_expression(
 
     version = str(package.version)
     nix = escape_string
-    is_old_nixpkgs = int(nixpkgs_version.split('.')[0]) <= 22
+    is_old_nixpkgs = nixpkgs.is_old_nixpkgs
     return expression_template.render(DISCLAIMER=DISCLAIMER, **locals())
 
 def build_overlay_expr(overlays: Mapping[str, Path]):
@@ -179,7 +187,7 @@ def build_overlay_expr(overlays: Mapping[str, Path]):
 
 def build_overlayed_nixpkgs(
         overlays: Mapping[str, Path],
-        nixpkgs: Optional[Tuple[str, str]] = None
+        nixpkgs: NixpkgsContext,
         ) -> str:
     nix = escape_string
 
@@ -190,18 +198,7 @@ def build_overlayed_nixpkgs(
         for k in sorted(overlays.keys())
     }
 
-    # Taken from Interpreters section in https://nixos.org/nixpkgs/manual/#reference
-    interpreters = [
-        'python2',
-        'python27',
-        'python3',
-        'python35',
-        'python36',
-        'python37',
-        'python38',
-        'python39',
-        'python310'
-    ]
+    interpreters = nixpkgs.interpreters
 
     return overlayed_nixpkgs_template.render(DISCLAIMER=DISCLAIMER, **locals())
 
@@ -211,19 +208,32 @@ def build_shell_nix_expression(packages: List[Package]) -> str:
 
 
 async def nixfmt(expr: str) -> str:
-    proc = await asyncio.create_subprocess_exec(
-        'nixfmt',
-        stdout=asyncio.subprocess.PIPE,
-        stdin=asyncio.subprocess.PIPE,
-    )
-    proc.stdin.write(expr.encode())  # type: ignore
-    proc.stdin.write_eof()  # type: ignore
-    (stdout, _) = await proc.communicate()
-    status = await proc.wait()
+    (status, stdout, stderr) = await scheduler.run(
+        'nixfmt', stdin=expr.encode(), priority=PRIORITY_FORMAT)
     if status:
+        print(stderr.decode(), file=sys.stderr)
         raise TypeError(f'nixfmt failed')
     return stdout.decode()
 
+async def nixfmt_many(exprs: Sequence[str]) -> List[str]:
+    """Format many expressions with a single nixfmt process.
+
+    If it fails, each expression is formatted with its own process, so the
+    error is raised for the expression that caused it.
+    """
+    if not exprs:
+        return []
+    with tempfile.TemporaryDirectory(prefix='pynixify_') as tmpdir:
+        paths = [Path(tmpdir) / f'{i}.nix' for i in range(len(exprs))]
+        for (path, expr) in zip(paths, exprs):
+            path.write_text(expr)
+        # nixfmt formats the files in place when they're given as arguments
+        (status, _, _) = await scheduler.run(
+            'nixfmt', *map(str, paths), priority=PRIORITY_FORMAT)
+        if status == 0:
+            return [path.read_text() for path in paths]
+    return list(await asyncio.gather(*map(nixfmt, exprs)))
+
 def escape_string(string: str) -> str:
     # Based on the documentation in https://nixos.org/nix/manual/#idm140737322106128
     string = string.replace('\\', '\\\\')
@@ -0,0 +1,123 @@
+# pynixify - Nix expression generator for Python packages
+# Copyright (C) 2020 Matías Lang
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+from pathlib import Path
+from dataclasses import dataclass, field, asdict, replace
+from typing import Dict, List, Optional
+from pynixify.base import Package, PackageMetadata, parse_version
+from pynixify.nixpkgs_sources import NixPackage, NixpkgsContext
+from pynixify.pypi_api import ABCPyPICache, PyPIPackage
+
+LOCK_FILENAME = 'lock.json'
+LOCK_FORMAT_VERSION = 1
+
+
+class LockedPyPICache(ABCPyPICache):
+    # Packages loaded from a lock must never access PyPI
+    async def fetch(self, package_name: str) -> object:
+        raise RuntimeError(
+            f'Tried to fetch {package_name} from PyPI while using a lock')
+
+    async def fetch_url(self, url: str, sha256: str) -> Path:
+        raise RuntimeError(f'Tried to fetch {url} while using a lock')
+
+
+@dataclass
+class LockedPackage:
+    # Either "nixpkgs" or "pypi"
+    origin: str
+    attr: str
+    version: str
+    # The following fields are only used by PyPI packages
+    download_url: Optional[str] = None
+    sha256: Optional[str] = None
+    nix_sha256: Optional[str] = None
+    fetch_pypi: Optional[List[str]] = None
+    local: bool = False
+    metadata: Optional[Dict[str, Optional[str]]] = None
+    # Names of other packages of the lock
+    build_requirements: List[str] = field(default_factory=list)
+    test_requirements: List[str] = field(default_factory=list)
+    runtime_requirements: List[str] = field(default_factory=list)
+
+
+@dataclass
+class Lock:
+    """The resolved dependency graph and everything needed to build the
+    expressions of its PyPI packages, without accessing PyPI or nixpkgs.
+    """
+    nixpkgs_version: str
+    requirements: List[str]
+    # Indexed by canonicalized PyPI name
+    packages: Dict[str, LockedPackage]
+    nixpkgs_url: Optional[str] = None
+    nixpkgs_sha256: Optional[str] = None
+    local: Optional[str] = None
+    # Locks written before it was added use every known interpreter
+    nixpkgs_interpreters: Optional[List[str]] = None
+
+    def save(self, path: Path):
+        data = asdict(self)
+        data['format_version'] = LOCK_FORMAT_VERSION
+        with path.open('w') as fp:
+            json.dump(data, fp, indent=2, sort_keys=True)
+            fp.write('\n')
+
+    @classmethod
+    def load(cls, path: Path) -> 'Lock':
+        with path.open() as fp:
+            data = json.load(fp)
+        format_version = data.pop('format_version', None)
+        if format_version != LOCK_FORMAT_VERSION:
+            raise ValueError(
+                f'Unsupported lock format version {format_version} in {path}')
+        data['packages'] = {
+            name: LockedPackage(**package)
+            for (name, package) in data['packages'].items()
+        }
+        return cls(**data)
+
+    def nixpkgs_context(self) -> NixpkgsContext:
+        context = NixpkgsContext(
+            version=self.nixpkgs_version,
+            url=self.nixpkgs_url,
+            sha256=self.nixpkgs_sha256,
+        )
+        if self.nixpkgs_interpreters is not None:
+            context = replace(
+                context, interpreters=tuple(self.nixpkgs_interpreters))
+        return context
+
+    def package(self, name: str) -> Package:
+        locked = self.packages[name]
+        if locked.origin == 'nixpkgs':
+            return NixPackage(
+                attr=locked.attr, version=parse_version(locked.version))
+        assert locked.origin == 'pypi'
+        return PyPIPackage(
+            pypi_name=locked.attr,
+            version=parse_version(locked.version),
+            download_url=locked.download_url or '',
+            sha256=locked.sha256 or '',
+            pypi_cache=LockedPyPICache(),
+            local_source=Path.cwd() if locked.local else None,
+        )
+
+    def metadata(self, name: str) -> PackageMetadata:
+        locked = self.packages[name]
+        assert locked.metadata is not None
+        return PackageMetadata(**locked.metadata)
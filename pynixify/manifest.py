@@ -0,0 +1,67 @@
+# pynixify - Nix expression generator for Python packages
+# Copyright (C) 2020 Matías Lang
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+from pathlib import Path
+from typing import Any, Dict
+from pynixify.cache import cache_key
+
+
+class Manifest:
+    """Record the inputs used to generate each file of the output directory.
+
+    When a file is about to be generated with the same inputs as the
+    previous run, it can be left untouched.
+    """
+
+    FILENAME = '.pynixify-manifest.json'
+
+    def __init__(self, base_path: Path, files: Dict[str, str] = {}):
+        self.base_path = base_path
+        self.previous_files = dict(files)
+        self.files: Dict[str, str] = {}
+
+    @classmethod
+    def load(cls, base_path: Path) -> 'Manifest':
+        try:
+            with (base_path / cls.FILENAME).open() as fp:
+                data = json.load(fp)
+        except (OSError, ValueError):
+            return cls(base_path)
+        return cls(base_path, files=data.get('files', {}))
+
+    def _key(self, path: Path) -> str:
+        return str(path.relative_to(self.base_path))
+
+    def is_fresh(self, path: Path, inputs: Any) -> bool:
+        """Check if path was generated from the same inputs as now.
+
+        Fresh files are kept in the manifest that will be saved.
+        """
+        key = self._key(path)
+        fingerprint = cache_key(inputs)
+        if self.previous_files.get(key) != fingerprint or not path.exists():
+            return False
+        self.files[key] = fingerprint
+        return True
+
+    def record(self, path: Path, inputs: Any):
+        self.files[self._key(path)] = cache_key(inputs)
+
+    def save(self):
+        with (self.base_path / self.FILENAME).open('w') as fp:
+            json.dump({'files': self.files}, fp, indent=2, sort_keys=True)
+            fp.write('\n')
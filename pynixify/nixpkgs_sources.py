@@ -14,35 +14,87 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import os
+import re
 import sys
 import json
 import asyncio
+import bisect
+import codecs
+import hashlib
 from pathlib import Path
-from typing import Sequence, Any, Optional
+from dataclasses import dataclass
+from typing import (
+    Sequence, Any, Awaitable, Callable, Optional, Dict, List, NamedTuple,
+    Set, Tuple)
 from collections import defaultdict
-from multiprocessing import cpu_count
 from packaging.utils import canonicalize_name
 from packaging.requirements import Requirement
-from packaging.version import Version
+from packaging.specifiers import SpecifierSet
+from packaging.version import InvalidVersion, Version
 from pynixify.base import Package, parse_version
+from pynixify.evaluator import get_evaluator
 from pynixify.exceptions import PackageNotFound, NixBuildError
+from pynixify.scheduler import scheduler
+from pynixify.trace import event, span
+from pynixify.cache import (
+    cache_key,
+    get_cache_dir,
+    is_store_path,
+    read_json,
+    write_json,
+)
 
-NIXPKGS_URL: Optional[str] = None
+_nixpkgs_url: Optional[str] = None
 
-class NixPackage(Package):
-    def __init__(self, *, attr: str, version: Version):
-        self.version = version
-        self.__attr = attr  # Ugly hack to fix mypy errors
+# Taken from Interpreters section in https://nixos.org/nixpkgs/manual/#reference
+PYTHON_INTERPRETERS = (
+    'python2',
+    'python27',
+    'python3',
+    'python35',
+    'python36',
+    'python37',
+    'python38',
+    'python39',
+    'python310',
+)
+
+
+def set_nixpkgs_url(url: Optional[str]):
+    """Use the nixpkgs tarball at the given URL instead of the <nixpkgs>
+    of NIX_PATH."""
+    global _nixpkgs_url
+    _nixpkgs_url = url
+
+
+def nix_path_args() -> List[str]:
+    """Arguments that make Nix commands use the selected nixpkgs."""
+    if _nixpkgs_url is None:
+        return []
+    return ['-I', f'nixpkgs={_nixpkgs_url}']
+
+
+@dataclass(frozen=True)
+class NixpkgsContext:
+    """What the generated expressions need to know about the nixpkgs
+    they will be built with. It is loaded once per run.
+    """
+    version: str
+    url: Optional[str] = None
+    sha256: Optional[str] = None
+    # The attrs of PYTHON_INTERPRETERS that exist in this nixpkgs
+    interpreters: Tuple[str, ...] = PYTHON_INTERPRETERS
 
     @property
-    def attr(self):
-        # Ugly hack to fix mypy errors
-        return self.__attr
+    def is_old_nixpkgs(self) -> bool:
+        # Releases before 23.05 take test requirements in checkInputs
+        return int(self.version.split('.')[0]) <= 22
 
-    async def source(self, extra_args=[]):
-        expr = """
-        with import <nixpkgs> {};
-        let
+
+def source_expr(attr: str) -> str:
+    return """
+        (let
           pkg = python3Packages."ATTR";
         in
           if pkg ? "src" then
@@ -54,45 +106,386 @@ class NixPackage(Package):
               text = "raise RuntimeError('This is expected to fail')";
               name = "ATTR_dummy_src";
               destination = "/setup.py";
-            }
-        """.replace('ATTR', self.attr)
-        args = [
-            '--no-out-link',
-            '--no-build-output',
-            '-E',
-            expr
-        ]
-        args += extra_args
-        return await run_nix_build(*args)
+            })
+    """.replace('ATTR', attr)
+
+
+class NixPackage(Package):
+    def __init__(self, *, attr: str, version: Version):
+        self.version = version
+        self.__attr = attr  # Ugly hack to fix mypy errors
+
+    @property
+    def attr(self):
+        # Ugly hack to fix mypy errors
+        return self.__attr
+
+    async def source(self, extra_args=[]):
+        with span('realise_source', package=self.attr, origin='nixpkgs'):
+            if not extra_args:
+                return await source_batcher.get(self.attr)
+            args = [
+                '--no-out-link',
+                '--no-build-output',
+                '-E',
+                f'with import <nixpkgs> {{}}; {source_expr(self.attr)}',
+            ]
+            args += extra_args
+            return await run_nix_build(*args)
 
     def __str__(self):
         return f'NixPackage(attr={self.attr}, version={self.version})'
 
 
+class Batcher:
+    """Process many keys with a single call.
+
+    Some Nix operations are slow to start (e.g. importing <nixpkgs>), so
+    instead of running them for each key, the keys requested during a
+    short window are collected and given to process together. It must
+    return the result of each key, or the exception that prevented getting
+    it.
+    """
+
+    def __init__(self,
+                 process: Callable[[List[str]], Awaitable[List[Any]]],
+                 window: float = 0.05):
+        self.process = process
+        self.window = window
+        # Keys waiting for the next batch, and the ones being processed
+        self._futures: Dict[str, asyncio.Future] = {}
+        self._pending: List[str] = []
+        self._flush_task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def get(self, key: str) -> 'asyncio.Future[Any]':
+        """Add the key to the current batch and return a future with its
+        result."""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # A previous event loop could have been closed before flushing
+            # its batch, whose futures can't be resolved anymore
+            self._futures = {}
+            self._pending = []
+            self._flush_task = None
+            self._loop = loop
+        future = self._futures.get(key)
+        if future is None:
+            future = self._futures[key] = loop.create_future()
+            self._pending.append(key)
+        if self._pending and (
+                self._flush_task is None or self._flush_task.done()):
+            self._flush_task = loop.create_task(self._flush())
+            self._flush_task.add_done_callback(self._flush_done)
+        # Shield the future so a cancelled caller doesn't cancel it for
+        # the rest of them
+        return asyncio.shield(future)
+
+    def _take_pending(self) -> List[str]:
+        # Keys requested from now on will go to the next batch
+        (keys, self._pending) = (sorted(self._pending), [])
+        self._flush_task = None
+        return keys
+
+    async def _flush(self):
+        keys: List[str] = []
+        try:
+            await asyncio.sleep(self.window)
+            keys = self._take_pending()
+            try:
+                results = await self.process(keys)
+            except Exception as e:
+                results = [e] * len(keys)
+            for (key, result) in zip(keys, results):
+                future = self._futures.pop(key)
+                if isinstance(result, BaseException):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+        finally:
+            # Don't leave the callers waiting forever if the task was
+            # cancelled
+            self._cancel(keys)
+
+    def _flush_done(self, task: asyncio.Task):
+        if self._flush_task is task:
+            # It was cancelled before taking its batch
+            self._cancel(self._take_pending())
+
+    def _cancel(self, keys: List[str]):
+        # Later calls will process them again
+        for key in keys:
+            future = self._futures.pop(key, None)
+            if future is not None and not future.done():
+                future.cancel()
+
+
+async def _realise_batch(attrs: List[str]) -> List[Any]:
+    """Get the source of each attr, or the exception that prevented
+    building it."""
+    try:
+        paths = await realise_sources(attrs)
+    except NixBuildError as e:
+        if len(attrs) == 1:
+            return [e]
+        # Don't let a broken source make the whole batch fail.
+        # Build each one separately to know which ones are valid
+        results = await asyncio.gather(*(
+            realise_sources([attr]) for attr in attrs
+        ), return_exceptions=True)
+        return [
+            r[0] if isinstance(r, list) else r
+            for r in results
+        ]
+    return list(paths)
+
+
+async def realise_sources(attrs: Sequence[str]) -> List[Path]:
+    if len(attrs) == 1:
+        expr = f'with import <nixpkgs> {{}}; {source_expr(attrs[0])}'
+    else:
+        # Put all sources in a single derivation so nix-build has only one
+        # output, and get each source by following its symlink
+        entries = ' '.join(
+            f'{{ name = "{i}"; path = {source_expr(attr)}; }}'
+            for (i, attr) in enumerate(attrs)
+        )
+        expr = (f'with import <nixpkgs> {{}}; '
+                f'linkFarm "pynixify-sources" [ {entries} ]')
+    result = await run_nix_build(
+        '--no-out-link',
+        '--no-build-output',
+        '-E',
+        expr,
+    )
+    if len(attrs) == 1:
+        return [result]
+    return [
+        Path(os.readlink(result / str(i)))
+        for i in range(len(attrs))
+    ]
+
+
+# Importing <nixpkgs> is the slowest part of building a source, so the
+# sources of many nixpkgs packages are realised with a single nix-build
+source_batcher = Batcher(_realise_batch)
+
+
+class NixDerivation(NamedTuple):
+    """A Python package defined in nixpkgs, with its version already
+    parsed."""
+    version: Version
+    attr: str
+
+
 class NixpkgsData:
     def __init__(self, data):
-        data_defaultdict: Any = defaultdict(list)
-        for (k, v) in data.items():
-            data_defaultdict[canonicalize_name(k)] += v
-        self.__data = dict(data_defaultdict)
+        # Derivations of each package, sorted by version
+        self._data: Dict[str, Tuple[NixDerivation, ...]] = {}
+        self._versions: Dict[str, List[Version]] = {}
+        # The same requirements are looked up many times while resolving
+        self._matches: Dict[Tuple[str, str], Tuple[NixDerivation, ...]] = {}
+        self._add(data)
+
+    def _add(self, data):
+        added: Set[str] = set()
+        for (k, drvs) in data.items():
+            # Keys with the same canonical name are merged
+            name = canonicalize_name(k)
+            derivations = list(self._data.get(name, ()))
+            for drv in drvs:
+                try:
+                    version = parse_version(drv['version'])
+                except InvalidVersion:
+                    # e.g. "1.7.7-SNAPSHOT". No requirement can match them.
+                    continue
+                derivations.append(NixDerivation(version, drv['attr']))
+            derivations.sort()
+            self._data[name] = tuple(derivations)
+            self._versions[name] = [drv.version for drv in derivations]
+            added.add(name)
+        if self._matches:
+            self._matches = {
+                key: matches for (key, matches) in self._matches.items()
+                if key[0] not in added
+            }
+
+    async def prepare(self, *names: str):
+        """Make sure the given PyPI names can be looked up.
+
+        Everything is loaded beforehand, so there is nothing to do.
+        """
+        pass
 
     def from_pypi_name(self, name: str) -> Sequence[NixPackage]:
+        return self._packages(self._derivations(canonicalize_name(name)))
+
+    def from_requirement(self, req: Requirement) -> Sequence[NixPackage]:
+        name = canonicalize_name(req.name)
+        key = (name, str(req.specifier))
         try:
-            data = self.__data[canonicalize_name(name)]
+            matches = self._matches[key]
+        except KeyError:
+            matches = self._matches[key] = self._matching(name, req.specifier)
+        return self._packages(matches)
+
+    def _derivations(self, name: str) -> Tuple[NixDerivation, ...]:
+        try:
+            return self._data[name]
         except KeyError:
             raise PackageNotFound(f'{name} is not defined in nixpkgs')
-        return [
-            NixPackage(attr=drv['attr'], version=parse_version(drv['version']))
-            for drv in data
+
+    def _matching(self, name: str,
+                  specifier: SpecifierSet) -> Tuple[NixDerivation, ...]:
+        drvs = self._derivations(name)
+        specs = list(specifier)
+        if (len(specs) == 1 and specs[0].operator == '==' and
+                not specs[0].version.endswith('*')):
+            # Pinned versions are the most common requirement. Only the
+            # derivations with the same public version can match.
+            public = Version(Version(specs[0].version).public)
+            start = bisect.bisect_left(self._versions[name], public)
+            end = start
+            while (end < len(drvs) and
+                   Version(drvs[end].version.public) == public):
+                end += 1
+            drvs = drvs[start:end]
+        return tuple(drv for drv in drvs if specifier.contains(drv.version))
+
+    def _packages(self, drvs: Sequence[NixDerivation]) -> List[NixPackage]:
+        # NixPackage objects are mutable, so a new one is returned every time
+        return [NixPackage(attr=drv.attr, version=drv.version) for drv in drvs]
+
+
+class LazyNixpkgsData(NixpkgsData):
+    """NixpkgsData that only evaluates the packages it is asked about.
+
+    Evaluating every Python package of nixpkgs takes a lot of time, which
+    is wasted when there are only a few requirements. Instead, the
+    prepare() calls made in a short window are batched in a single
+    nix-instantiate, which evaluates the attrs named like the requested
+    packages. Packages whose attr isn't derived from their PyPI name
+    won't be found.
+    """
+
+    def __init__(self, window: float = 0.05):
+        super().__init__({})
+        self._prepared: Set[str] = set()
+        self._batcher = Batcher(self._lookup, window)
+
+    async def prepare(self, *names: str):
+        await asyncio.gather(*(
+            self._batcher.get(name)
+            for name in set(map(canonicalize_name, names))
+            if name not in self._prepared
+        ))
+
+    async def _lookup(self, names: List[str]) -> List[Any]:
+        data = await lookup_python_packages(names)
+        self._add(data)
+        self._prepared.update(names)
+        return [None] * len(names)
+
+    def _derivations(self, name: str) -> Tuple[NixDerivation, ...]:
+        assert name in self._prepared, \
+            f'{name} was looked up before calling prepare()'
+        return super()._derivations(name)
+
+
+def _attr_candidates(name: str) -> List[str]:
+    """Attrs that a package with the given canonical name could have in
+    python3Packages."""
+    candidates = [name, name.replace('-', '_'), name.replace('-', '')]
+    return sorted(set(candidates), key=candidates.index)
+
+
+def pypi_name_from_url(url: Optional[str]) -> Optional[str]:
+    """Same as urlToPypiName in pythonPackages.nix."""
+    if url is None:
+        return None
+    for pattern in [r'mirror://pypi/./([^/]+)/.*',
+                    r'https://files\.pythonhosted\.org/packages/[^/]+/./([^/]+)/.*']:
+        match = re.fullmatch(pattern, url)
+        if match is not None:
+            return match.group(1)
+    return None
+
+
+async def lookup_python_packages(
+        names: Sequence[str]) -> Dict[str, List[Dict[str, str]]]:
+    """Evaluate the packages with the given PyPI names.
+
+    The result has the same format as load_nixpkgs_data.
+    """
+    attrs = sorted({
+        attr for name in names for attr in _attr_candidates(name)
+    })
+    nix_expression_path = (
+        Path(__file__).parent / "data" / "lookupPythonPackages.nix")
+    attrs_arg = '[ ' + ' '.join(f'"{attr}"' for attr in attrs) + ' ]'
+    evaluator = get_evaluator()
+    if evaluator is not None:
+        drvs = await evaluator.evaluate(
+            f'import {nix_expression_path}', args={'attrs': attrs_arg})
+    else:
+        args = [
+            '--eval',
+            '--strict',
+            '--json',
+            str(nix_expression_path),
+            '--arg',
+            'attrs',
+            attrs_arg,
         ]
+        args += nix_path_args()
+        (status, stdout, stderr) = await scheduler.run(
+            'nix-instantiate', *args)
+        if status:
+            print(stderr.decode(), file=sys.stderr)
+            raise NixBuildError(f'nix-instantiate failed with code {status}')
+        drvs = json.loads(stdout)
 
-    def from_requirement(self, req: Requirement) -> Sequence[NixPackage]:
-        drvs = self.from_pypi_name(req.name)
-        return [drv for drv in drvs if str(drv.version) in req.specifier]
+    wanted = set(names)
+    data: Dict[str, List[Dict[str, str]]] = defaultdict(list)
+    for drv in drvs:
+        if drv is None:
+            continue
+        pypi_name = canonicalize_name(
+            pypi_name_from_url(drv['src']) or drv['attr'])
+        if pypi_name in wanted:
+            data[pypi_name].append(
+                {'attr': drv['attr'], 'version': drv['version']})
+    return dict(data)
 
 
 async def load_nixpkgs_data(extra_args):
     nix_expression_path = Path(__file__).parent / "data" / "pythonPackages.nix"
+    cache_path = await _nixpkgs_data_cache_path(nix_expression_path, extra_args)
+    if cache_path is not None:
+        cached = read_json(cache_path)
+        if cached is not None:
+            return {
+                pypi_name: [
+                    {'attr': attr, 'version': version}
+                    for (attr, version) in drvs
+                ]
+                for (pypi_name, drvs) in cached.items()
+            }
+
+    evaluator = get_evaluator()
+    if evaluator is not None and not extra_args:
+        data = {
+            pypi_name: [
+                {'attr': drv['attr'], 'version': drv['version']}
+                for drv in drvs
+            ]
+            for (pypi_name, drvs) in (await evaluator.evaluate(
+                f'import {nix_expression_path}')).items()
+        }
+        if cache_path is not None:
+            _write_nixpkgs_data_cache(cache_path, data)
+        return data
+
     args = [
         '--eval',
         '--strict',
@@ -100,47 +493,185 @@ async def load_nixpkgs_data(extra_args):
         str(nix_expression_path),
     ]
     args += extra_args
-    if NIXPKGS_URL is not None:
-        args += ['-I', f'nixpkgs={NIXPKGS_URL}']
-    proc = await asyncio.create_subprocess_exec(
-        'nix-instantiate', *args, stdout=asyncio.subprocess.PIPE)
-    (stdout, _) = await proc.communicate()
-    status = await proc.wait()
-    assert status == 0
-    ret = json.loads(stdout)
-    return ret
+    args += nix_path_args()
+    # The output is parsed while it is read, and only what NixpkgsData
+    # uses is kept. This way, neither the whole output nor its complete
+    # JSON representation are in memory at the same time.
+    ret: Dict[str, List[Dict[str, str]]] = {}
+    stream = JSONObjectStream()
 
-async def load_nixpkgs_version() -> str:
-    args = [
-        '--eval',
-        '--strict',
-        '--expr',
-        'with import <nixpkgs> {}; lib.version'
-    ]
-    if NIXPKGS_URL is not None:
-        args += ['-I', f'nixpkgs={NIXPKGS_URL}']
-    proc = await asyncio.create_subprocess_exec(
-        'nix-instantiate', *args, stdout=asyncio.subprocess.PIPE)
-    (stdout, _) = await proc.communicate()
-    status = await proc.wait()
+    def on_stdout(chunk: bytes):
+        for (pypi_name, drvs) in stream.feed(chunk):
+            ret[pypi_name] = [
+                {'attr': drv['attr'], 'version': drv['version']}
+                for drv in drvs
+            ]
+
+    # Evaluating all Python packages takes a lot more memory than the
+    # rest of nix-instantiate calls, so it uses more of the budget
+    (status, stderr) = await scheduler.run_streaming(
+        'nix-instantiate', *args, on_stdout=on_stdout, weight=4)
+    if status:
+        print(stderr.decode(), file=sys.stderr)
     assert status == 0
-    ret = json.loads(stdout)
+    stream.close()
+
+    if cache_path is not None:
+        _write_nixpkgs_data_cache(cache_path, ret)
     return ret
 
 
+def _write_nixpkgs_data_cache(
+        cache_path: Path, data: Dict[str, List[Dict[str, str]]]):
+    # Use a compact representation, so loading the cache is fast
+    write_json(cache_path, {
+        pypi_name: [[drv['attr'], drv['version']] for drv in drvs]
+        for (pypi_name, drvs) in data.items()
+    })
+
+
+class JSONObjectStream:
+    """Incremental parser of a JSON object.
+
+    feed() returns the items of the object that were completed by the
+    given chunk of data, so they can be processed before the rest of the
+    object is read.
+    """
+
+    def __init__(self):
+        self._decoder = json.JSONDecoder()
+        self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._started = False
+        self._finished = False
+
+    def feed(self, chunk: bytes) -> List[Tuple[str, Any]]:
+        buffer = self._buffer + self._text_decoder.decode(chunk)
+        items = []
+        pos = 0
+        while not self._finished:
+            pos = _skip_whitespace(buffer, pos)
+            if pos == len(buffer):
+                break
+            if not self._started:
+                if buffer[pos] != '{':
+                    raise ValueError('Expected a JSON object')
+                self._started = True
+                pos += 1
+                continue
+            if buffer[pos] == '}':
+                self._finished = True
+                pos += 1
+                break
+            if buffer[pos] == ',':
+                pos += 1
+                continue
+            try:
+                (key, end) = self._decoder.raw_decode(buffer, pos)
+                end = _skip_whitespace(buffer, end)
+                if end == len(buffer):
+                    break
+                if buffer[end] != ':':
+                    raise ValueError(f'Expected ":" at position {end}')
+                end = _skip_whitespace(buffer, end + 1)
+                (value, end) = self._decoder.raw_decode(buffer, end)
+            except json.JSONDecodeError:
+                # The item isn't complete yet. Object values are always
+                # objects, arrays or strings, so they can't be parsed
+                # before their end.
+                break
+            items.append((key, value))
+            pos = end
+        self._buffer = buffer[pos:]
+        return items
+
+    def close(self):
+        if not self._finished or self._buffer.strip():
+            raise ValueError('Incomplete or invalid JSON object')
+
+
+def _skip_whitespace(text: str, pos: int) -> int:
+    while pos < len(text) and text[pos] in ' \t\n\r':
+        pos += 1
+    return pos
+
 
-async def _run_nix_build(*args: Sequence[str], retries=0, max_retries=5) -> Path:
-    if NIXPKGS_URL is not None:
-        # TODO fix mypy hack
-        args_ = list(args) + ['-I', f'nixpkgs={NIXPKGS_URL}']
+async def find_nixpkgs_path() -> Optional[Path]:
+    """Return the resolved path of <nixpkgs>, or None if it can't be found."""
+    args = ['--find-file', 'nixpkgs']
+    args += nix_path_args()
+    (status, stdout, _) = await scheduler.run('nix-instantiate', *args)
+    if status:
+        return None
+    return Path(stdout.decode().strip()).resolve()
+
+
+async def _nixpkgs_data_cache_path(
+        nix_expression_path: Path, extra_args) -> Optional[Path]:
+    cache_dir = get_cache_dir('nixpkgs')
+    if cache_dir is None:
+        return None
+    nixpkgs_path = await find_nixpkgs_path()
+    if nixpkgs_path is None or not is_store_path(nixpkgs_path):
+        # A local nixpkgs checkout can change at any time, so we can't
+        # reuse a previous evaluation of it
+        return None
+    key = cache_key(
+        str(nixpkgs_path),
+        _nixpkgs_url,
+        hashlib.sha256(nix_expression_path.read_bytes()).hexdigest(),
+        list(extra_args),
+    )
+    return cache_dir / f'{key}.json.gz'
+
+NIXPKGS_CONTEXT_EXPR = """
+    { pkgs ? import <nixpkgs> { } }: {
+      version = pkgs.lib.version;
+      # Removed interpreters are aliases that throw an error
+      interpreters = builtins.filter (name:
+        (builtins.tryEval (pkgs ? ${name} && pkgs.${name} ? override)).value)
+        [ INTERPRETERS ];
+    }
+"""
+
+
+async def load_nixpkgs_context(
+        sha256: Optional[str] = None) -> NixpkgsContext:
+    """Evaluate the selected nixpkgs to get its NixpkgsContext.
+
+    sha256 is the hash of the nixpkgs tarball, if there is one.
+    """
+    expr = NIXPKGS_CONTEXT_EXPR.replace('INTERPRETERS', ' '.join(
+        f'"{interpreter}"' for interpreter in PYTHON_INTERPRETERS))
+    evaluator = get_evaluator()
+    if evaluator is not None:
+        ret = await evaluator.evaluate(expr)
     else:
-        args_ = list(args)
-    # TODO remove mypy ignore below and fix compatibility with mypy 0.790
-    proc = await asyncio.create_subprocess_exec(
-        'nix-build', *args_, stdout=asyncio.subprocess.PIPE,  # type: ignore
-        stderr=asyncio.subprocess.PIPE)
-    (stdout, stderr) = await proc.communicate()
-    status = await proc.wait()
+        args = [
+            '--eval',
+            '--strict',
+            '--json',
+            '--expr',
+            expr,
+        ]
+        args += nix_path_args()
+        (status, stdout, stderr) = await scheduler.run(
+            'nix-instantiate', *args)
+        if status:
+            print(stderr.decode(), file=sys.stderr)
+        assert status == 0
+        ret = json.loads(stdout)
+    return NixpkgsContext(
+        version=ret['version'],
+        url=_nixpkgs_url,
+        sha256=sha256,
+        interpreters=tuple(ret['interpreters']),
+    )
+
+
+async def run_nix_build(*args: str, retries=0, max_retries=5) -> Path:
+    args_ = list(args) + nix_path_args()
+    (status, stdout, stderr) = await scheduler.run('nix-build', *args_)
 
     if b'all build users are currently in use' in stderr and retries < max_retries:
         # perform an expotential backoff and retry
@@ -149,6 +680,7 @@ async def _run_nix_build(*args: Sequence[str], retries=0, max_retries=5) -> Path
             f'warning: All build users are currently in use. '
             f'Retrying in {2**retries} seconds\n'
         )
+        event('nix_build_retry', retries=retries, delay=2**retries)
         await asyncio.sleep(2**retries)
         return await run_nix_build(
             *args,
@@ -164,17 +696,5 @@ async def _run_nix_build(*args: Sequence[str], retries=0, max_retries=5) -> Path
     return Path(stdout.strip().decode())
 
 
-sem: Optional[asyncio.BoundedSemaphore] = None
-
-
 def set_max_jobs(n: int):
-    global sem
-    sem = asyncio.BoundedSemaphore(n)
-
-
-async def run_nix_build(*args: Sequence[str], retries=0, max_retries=5) -> Path:
-    global sem
-    if not sem:
-        sem = asyncio.BoundedSemaphore(cpu_count())
-    async with sem:
-        return await _run_nix_build(*args, retries=retries, max_retries=5)
+    scheduler.set_limit('nix-build', n)
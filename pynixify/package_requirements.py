@@ -14,13 +14,20 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import json
+import asyncio
+import hashlib
+from email.parser import HeaderParser
 from pathlib import Path
-from typing import List
-from dataclasses import dataclass
+from typing import List, Dict, Optional, Tuple
+from dataclasses import dataclass, asdict
 from packaging.requirements import Requirement
 from pkg_resources import parse_requirements
+from pynixify.base import Package, PackageMetadata
+from pynixify.cache import cache_key, get_database, is_store_path
 from pynixify.nixpkgs_sources import run_nix_build
-from pynixify.exceptions import NixBuildError
+from pynixify.static_metadata import TEST_EXTRAS, static_source_data
+from pynixify.wheel import read_wheel_metadata
 
 
 @dataclass
@@ -44,19 +51,236 @@ class PackageRequirements:
                 kwargs[attr] = reqs
         return cls(**kwargs)
 
+    def copy(self) -> 'PackageRequirements':
+        return PackageRequirements(
+            build_requirements=list(self.build_requirements),
+            test_requirements=list(self.test_requirements),
+            runtime_requirements=list(self.runtime_requirements),
+        )
 
-async def eval_path_requirements(path: Path) -> PackageRequirements:
+
+@dataclass
+class SourceData:
+    requirements: PackageRequirements
+    metadata: PackageMetadata
+    # The version declared in setup.py, if it could be parsed
+    version: Optional[str] = None
+
+    @classmethod
+    def from_result_path(cls, result_path: Path):
+        with (result_path / 'meta.json').open() as fp:
+            metadata = json.load(fp)
+        version = metadata.pop('version', None)
+        return cls(
+            requirements=PackageRequirements.from_result_path(result_path),
+            metadata=PackageMetadata(**metadata),
+            version=version,
+        )
+
+    @classmethod
+    def from_wheel_metadata(cls, text: str):
+        """Parse the METADATA file of a wheel.
+
+        Wheels don't record the requirements needed to build them, so
+        build_requirements is always empty.
+        """
+        message = HeaderParser().parsestr(text)
+        runtime_requirements = []
+        test_requirements = []
+        for line in message.get_all('Requires-Dist') or []:
+            req = Requirement(line)
+            if req.marker is None or 'extra' not in str(req.marker):
+                runtime_requirements.append(req)
+            elif any(req.marker.evaluate({'extra': extra})
+                     for extra in TEST_EXTRAS):
+                # Drop the marker, otherwise the requirement would be
+                # ignored because no extra is being installed
+                extras = ''
+                if req.extras:
+                    extras = f'[{",".join(sorted(req.extras))}]'
+                test_requirements.append(
+                    Requirement(f'{req.name}{extras}{req.specifier}'))
+
+        url = message.get('Home-page')
+        for project_url in message.get_all('Project-URL') or []:
+            (label, _, value) = project_url.partition(',')
+            if not url and label.strip().lower() in ('homepage', 'home'):
+                url = value.strip()
+        license = message.get('License')
+        if license == 'UNKNOWN':
+            license = None
+
+        return cls(
+            requirements=PackageRequirements(
+                build_requirements=[],
+                test_requirements=test_requirements,
+                runtime_requirements=runtime_requirements,
+            ),
+            metadata=PackageMetadata(
+                description=message.get('Summary'),
+                license=license,
+                url=url or None,
+            ),
+            version=message.get('Version'),
+        )
+
+    def to_json(self):
+        reqs = self.requirements
+        return {
+            'build_requirements': [str(r) for r in reqs.build_requirements],
+            'test_requirements': [str(r) for r in reqs.test_requirements],
+            'runtime_requirements': [str(r) for r in reqs.runtime_requirements],
+            'metadata': asdict(self.metadata),
+            'version': self.version,
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(
+            requirements=PackageRequirements(**{
+                attr: [Requirement(r) for r in data[attr]]
+                for attr in ['build_requirements', 'test_requirements',
+                             'runtime_requirements']
+            }),
+            metadata=PackageMetadata(**data['metadata']),
+            version=data['version'],
+        )
+
+    @classmethod
+    def empty(cls):
+        return cls(
+            requirements=PackageRequirements(
+                build_requirements=[],
+                test_requirements=[],
+                runtime_requirements=[],
+            ),
+            metadata=PackageMetadata(
+                description=None,
+                license=None,
+                url=None,
+            ),
+        )
+
+
+# Evaluations already done (or in progress) in this run. Concurrent
+# callers asking for the same source await the same task.
+_evaluations: Dict[Tuple[Path, Optional[int]], 'asyncio.Future[SourceData]'] = {}
+
+
+async def eval_package(package: Package, extra_args=[]) -> SourceData:
+    """Parse the requirements and metadata of a package.
+
+    Unlike eval_path, this can avoid fetching the source of the package if
+    it was already parsed in a previous run, or if the metadata of one of
+    its wheels is available.
+    """
+    sha256 = package.source_sha256
+    if sha256:
+        data = _load_persisted(('sdist', sha256))
+        if data is not None:
+            return data
+    wheel_metadata = await package.wheel_metadata()
+    if wheel_metadata is not None:
+        return SourceData.from_wheel_metadata(wheel_metadata)
+    return await eval_path(await package.source(extra_args), sha256=sha256)
+
+
+async def eval_path(path: Path, sha256: Optional[str] = None) -> SourceData:
+    """Parse the requirements and metadata of a package source.
+
+    The nix-build is only done once per source and run, even if both the
+    requirements and the metadata are needed. If sha256 is given, it is
+    the hash of the sdist in path.
+    """
+    path = path.resolve()
+    # Store paths can't change. Other paths (e.g. the source of a --local
+    # package) could be modified during the run.
+    key = (path, None if is_store_path(path) else path.stat().st_mtime_ns)
+    loop = asyncio.get_running_loop()
+    evaluation = _evaluations.get(key)
+    if evaluation is None or (
+            not evaluation.done() and evaluation.get_loop() is not loop):
+        evaluation = loop.create_task(_eval_path_persisted(path, sha256))
+        _evaluations[key] = evaluation
+    # Shield the evaluation so a cancelled caller doesn't cancel it for
+    # the rest of them
+    return await asyncio.shield(evaluation)
+
+
+def parser_revision() -> str:
+    """Hash of everything used to parse setup.py files.
+
+    Changing the parser or the setuptools patches invalidates the results
+    persisted by previous runs.
+    """
+    global _parser_revision
+    if _parser_revision is None:
+        h = hashlib.sha256()
+        for filename in ['parse_setuppy_data.nix', 'setuptools_patch.diff',
+                         'old_setuptools_patch.diff']:
+            h.update((Path(__file__).parent / "data" / filename).read_bytes())
+        # Wheels and static metadata are parsed in Python instead of by a
+        # nix-build
+        for module in [Path(__file__), Path(__file__).parent / 'static_metadata.py']:
+            h.update(module.read_bytes())
+        _parser_revision = h.hexdigest()
+    return _parser_revision
+
+
+_parser_revision: Optional[str] = None
+
+
+def _persisted_keys(path: Path, sha256: Optional[str]) -> List[Tuple[str, str]]:
+    keys = []
+    if sha256:
+        keys.append(('sdist', sha256))
+    if is_store_path(path):
+        keys.append(('path', str(path)))
+    return keys
+
+
+def _load_persisted(key: Tuple[str, str]) -> Optional[SourceData]:
+    database = get_database()
+    if database is None:
+        return None
+    data = database.get('source-data', cache_key(*key, parser_revision()))
+    if data is None:
+        return None
+    return SourceData.from_json(data)
+
+
+async def _eval_path_persisted(path: Path, sha256: Optional[str]) -> SourceData:
+    keys = _persisted_keys(path, sha256)
+    for key in keys:
+        data = _load_persisted(key)
+        if data is not None:
+            return data
+    data = await _eval_path(path)
+    database = get_database()
+    if database is not None:
+        for key in keys:
+            database.set('source-data', cache_key(*key, parser_revision()),
+                         data.to_json())
+    return data
+
+
+async def _eval_path(path: Path) -> SourceData:
     nix_expression_path = Path(__file__).parent / "data" / "parse_setuppy_data.nix"
     if path.name.endswith('.whl'):
         # Some nixpkgs packages use a wheel as source, which don't have a
-        # setup.py file. For now, ignore them assume they have no dependencies
-        print(f'{path} is a wheel file instead of a source distribution. '
-              f'Assuming it has no dependencies.')
-        return PackageRequirements(
-            build_requirements=[],
-            test_requirements=[],
-            runtime_requirements=[]
-        )
+        # setup.py file. Their METADATA file has everything but the build
+        # requirements, which aren't needed to install a wheel.
+        wheel_metadata = read_wheel_metadata(path)
+        if wheel_metadata is None:
+            print(f'{path} is a wheel file without metadata. Assuming it '
+                  f'has no dependencies.')
+            return SourceData.empty()
+        return SourceData.from_wheel_metadata(wheel_metadata)
+    # Only run setup.py when the requirements aren't declared statically
+    loop = asyncio.get_running_loop()
+    static_data = await loop.run_in_executor(None, static_source_data, path)
+    if static_data is not None:
+        return SourceData.from_json(static_data)
     assert nix_expression_path.exists()
     nix_store_path = await run_nix_build(
         str(nix_expression_path),
@@ -64,13 +288,15 @@ async def eval_path_requirements(path: Path) -> PackageRequirements:
         '--no-build-output',
         '--arg',
         'file',
-        str(path.resolve())
+        str(path)
     )
     if (nix_store_path / 'failed').exists():
-        print(f'Error parsing requirements of {path}. Assuming it has no dependencies.')
-        return PackageRequirements(
-            build_requirements=[],
-            test_requirements=[],
-            runtime_requirements=[],
-        )
-    return PackageRequirements.from_result_path(nix_store_path)
+        print(f'Error parsing requirements of {path}. Assuming it has no '
+              f'dependencies nor metadata.')
+        return SourceData.empty()
+    return SourceData.from_result_path(nix_store_path)
+
+
+async def eval_path_requirements(path: Path) -> PackageRequirements:
+    # Return a copy because VersionChooser modifies it
+    return (await eval_path(path)).requirements.copy()
@@ -15,24 +15,45 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import os
+import re
 import sys
 import json
+import mmap
+import time
 import asyncio
 import hashlib
+import operator
+import sqlite3
+import zipfile
 import aiohttp
 import aiofiles
-from typing import Sequence, Optional, List
+from typing import (
+    Any, AsyncIterator, Dict, Sequence, Optional, List, NamedTuple, Tuple)
 from pathlib import Path
 from dataclasses import dataclass, field
 from urllib.parse import urlunparse
 from abc import ABCMeta, abstractmethod
+from contextlib import asynccontextmanager
 from urllib.parse import quote, urlparse
-from packaging.utils import canonicalize_name
+from packaging.tags import Tag
+from packaging.utils import (
+    InvalidWheelFilename, canonicalize_name, parse_wheel_filename)
 from packaging.requirements import Requirement
-from packaging.version import Version, parse
+from packaging.version import InvalidVersion, Version, parse
 from pynixify.base import Package, parse_version
+from pynixify.cache import get_database, is_store_path
+from pynixify.evaluator import get_evaluator
+from pynixify.scheduler import scheduler
+from pynixify.trace import Lanes, span
+from pynixify.wheel import (
+    ZIP_TAIL_SIZE,
+    SparseFile,
+    central_directory_range,
+    metadata_member,
+)
 from pynixify.exceptions import (
-    IntegrityError
+    IntegrityError,
+    PackageNotFound,
 )
 
 
@@ -45,6 +66,13 @@ class ABCPyPICache(metaclass=ABCMeta):
     async def fetch_url(self, url: str, sha256: str) -> Path:
         pass
 
+    async def fetch_wheel_metadata(self, url: str) -> Optional[str]:
+        """Get the METADATA file of the wheel in url, if possible."""
+        return None
+
+    async def close(self):
+        pass
+
 
 @dataclass
 class PyPIPackage(Package):
@@ -53,27 +81,37 @@ class PyPIPackage(Package):
     pypi_name: str
     pypi_cache: ABCPyPICache
     local_source: Optional[Path] = None
+    # A wheel of the same version, whose metadata can be used instead of
+    # building the sdist
+    wheel_url: Optional[str] = None
+
+    _cached_downloaded_file: Optional[Path] = field(
+        default=None, init=False, repr=False, compare=False)
 
     async def source(self, extra_args=[]) -> Path:
         if self.local_source is not None:
             return self.local_source
-        downloaded_file: Path = await self.pypi_cache.fetch_url(
-            self.download_url, self.sha256)
-        h = hashlib.sha256()
-        with downloaded_file.open('rb') as fp:
-            while True:
-                data = fp.read(65536)
-                if not data:
-                    break
-                h.update(data)
-        if h.hexdigest() != self.sha256:
-            raise IntegrityError(
-                f"SHA256 hash does not match. The hash of {self.download_url} "
-                f"should be {self.sha256} but it is {h.hexdigest()} instead."
-            )
+        if self._cached_downloaded_file is not None:
+            return self._cached_downloaded_file
+        with span('realise_source', package=self.pypi_name,
+                  version=str(self.version)):
+            downloaded_file: Path = await self.pypi_cache.fetch_url(
+                self.download_url, self.sha256)
+            digest = await file_sha256(downloaded_file)
+            if digest != self.sha256:
+                raise IntegrityError(
+                    f"SHA256 hash does not match. The hash of "
+                    f"{self.download_url} should be {self.sha256} but it "
+                    f"is {digest} instead."
+                )
         self._cached_downloaded_file = downloaded_file
         return downloaded_file
 
+    async def wheel_metadata(self) -> Optional[str]:
+        if self.wheel_url is None or self.local_source is not None:
+            return None
+        return await self.pypi_cache.fetch_wheel_metadata(self.wheel_url)
+
     @property
     def filename(self):
         return Path(urlparse(self.download_url).path).name
@@ -82,39 +120,423 @@ class PyPIPackage(Package):
     def attr(self):
         return self.pypi_name
 
+    @property
+    def source_sha256(self) -> Optional[str]:
+        if self.local_source is not None:
+            return None
+        return self.sha256
+
     def __str__(self):
         return f'PyPIPackage(attr={self.attr}, version={self.version})'
 
 
+class PyPIRelease(NamedTuple):
+    """The source distribution of a release of a PyPI package."""
+    version: Version
+    sha256: str
+    download_url: str
+    wheel_url: Optional[str]
+
+
 class PyPIData:
-    def __init__(self, pypi_cache):
+    def __init__(self, pypi_cache, wheel_metadata: bool = False):
         self.pypi_cache = pypi_cache
+        self.wheel_metadata = wheel_metadata
+        # The releases of each package, sorted by version. The JSON
+        # document of a package is only parsed once per run.
+        self._releases: Dict[
+            str, 'asyncio.Future[Tuple[PyPIRelease, ...]]'] = {}
 
     async def from_requirement(self, req: Requirement) -> Sequence[PyPIPackage]:
-        response = await self.pypi_cache.fetch(canonicalize_name(req.name))
-        matching = []
+        name = canonicalize_name(req.name)
+        return [
+            PyPIPackage(
+                sha256=release.sha256,
+                version=release.version,
+                download_url=release.download_url,
+                pypi_name=name,
+                pypi_cache=self.pypi_cache,
+                wheel_url=release.wheel_url,
+            )
+            for release in await self.releases(name)
+            if req.specifier.contains(release.version)
+        ]
+
+    async def releases(self, name: str) -> Tuple[PyPIRelease, ...]:
+        loop = asyncio.get_running_loop()
+        releases = self._releases.get(name)
+        if releases is None or (
+                not releases.done() and releases.get_loop() is not loop):
+            releases = loop.create_task(self._load_releases(name))
+            self._releases[name] = releases
+        return await asyncio.shield(releases)
+
+    async def _load_releases(self, name: str) -> Tuple[PyPIRelease, ...]:
+        response = await self.pypi_cache.fetch(name)
+        releases = []
         for (version, version_dist) in response['releases'].items():
             try:
                 data = next(e for e in version_dist if e['packagetype'] == 'sdist')
             except StopIteration:
                 continue
-            if version in req.specifier:
-                matching.append(PyPIPackage(
-                    sha256=data['digests']['sha256'],
-                    version=parse_version(version),
-                    download_url=data['url'],
-                    pypi_name=canonicalize_name(req.name),
-                    pypi_cache=self.pypi_cache,
-                ))
-        return matching
+            try:
+                parsed_version = parse_version(version)
+            except InvalidVersion:
+                # Old releases of some packages have versions that aren't
+                # valid anymore. No requirement can match them.
+                continue
+            releases.append(PyPIRelease(
+                version=parsed_version,
+                sha256=data['digests']['sha256'],
+                download_url=data['url'],
+                wheel_url=(self._pure_wheel_url(version_dist)
+                           if self.wheel_metadata else None),
+            ))
+        releases.sort(key=operator.attrgetter('version'))
+        return tuple(releases)
+
+    def _pure_wheel_url(self, version_dist) -> Optional[str]:
+        # Platform specific wheels could have different requirements than
+        # the sdist, so only pure Python ones are used
+        for e in version_dist:
+            if (e['packagetype'] == 'bdist_wheel' and
+                    not e.get('yanked') and
+                    _is_pure_py3_wheel(e['filename'])):
+                return e['url']
+        return None
+
+
+def _is_pure_py3_wheel(filename: str) -> bool:
+    try:
+        (_, _, _, tags) = parse_wheel_filename(filename)
+    except InvalidWheelFilename:
+        return False
+    # Wheels tagged only for Python 2 can have different requirements
+    return Tag('py3', 'none', 'any') in tags
+
+
+class UnexpectedResponse(Exception):
+    """The server didn't answer a request for part of a wheel as expected.
+
+    Unlike a wheel without a METADATA file, it could work in a later run.
+    """
 
 
 class PyPICache:
+    """Fetch package information from the PyPI JSON API.
+
+    When a cache directory is given, responses are stored there and reused
+    by later runs. Entries newer than ttl seconds are used directly, older
+    ones are revalidated with their ETag and Last-Modified headers. When
+    the stored responses take more than max_size bytes, the least recently
+    used ones are removed.
+
+    All requests share a single HTTP session whose connection pool is
+    bounded by max_connections, so connections are kept alive and reused
+    between packages. Call close() once the cache isn't needed anymore.
+    """
+
+    def __init__(self, cache_dir: Optional[Path] = None,
+                 ttl: float = 3600, max_size: int = 256 * 2**20,
+                 index_url: str = 'https://pypi.org/pypi',
+                 max_connections: int = 10,
+                 max_connections_per_host: Optional[int] = None,
+                 keepalive_timeout: float = 30):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_size = max_size
+        self.index_url = index_url
+        self.max_connections = max_connections
+        self.max_connections_per_host = (
+            max_connections_per_host or max_connections)
+        self.keepalive_timeout = keepalive_timeout
+        self._db: Optional[sqlite3.Connection] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._connections = Lanes()
+
+    def session(self) -> aiohttp.ClientSession:
+        # The session must be created inside the running event loop, so it
+        # can't be done in __init__
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections,
+                limit_per_host=self.max_connections_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            trace_config = aiohttp.TraceConfig()
+            trace_config.on_connection_create_end.append(self._on_connection)
+            trace_config.on_connection_reuseconn.append(self._on_connection)
+            self._session = aiohttp.ClientSession(
+                connector=connector, trace_configs=[trace_config])
+        return self._session
+
+    @asynccontextmanager
+    async def _get(self, url: str,
+                   **kwargs: Any) -> AsyncIterator[aiohttp.ClientResponse]:
+        with span('http', url=url) as record:
+            request = {'record': record, 'queued': time.monotonic()}
+            try:
+                async with self.session().get(
+                        url, trace_request_ctx=request,
+                        **kwargs) as response:
+                    record['status'] = response.status
+                    yield response
+            finally:
+                if 'connection' in record:
+                    self._connections.release(record['connection'])
+
+    async def _on_connection(self, session, trace_config_ctx, params):
+        # Called when the connector gives a connection to a request made
+        # by _get. aiohttp doesn't identify the connection, but there are
+        # never more requests with a connection than open connections, so
+        # each one is drawn in a track of its own.
+        request = trace_config_ctx.trace_request_ctx
+        if request is None:
+            return
+        record = request['record']
+        if 'connection' in record:
+            # The previous response was a redirect
+            self._connections.release(record['connection'])
+        record['wait'] = time.monotonic() - request['queued']
+        record['reused'] = isinstance(
+            params, aiohttp.TraceConnectionReuseconnParams)
+        record['connection'] = self._connections.acquire()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    async def fetch_wheel_metadata(self, url: str) -> Optional[str]:
+        # Uploaded files never change, so the result can be persisted
+        # without expiration
+        database = get_database()
+        if database is not None:
+            cached = database.get('wheel-metadata', url)
+            if cached is not None:
+                return cached['metadata']
+        try:
+            metadata = await self._fetch_wheel_metadata(url)
+        except (aiohttp.ClientError, asyncio.TimeoutError,
+                UnexpectedResponse):
+            # These failures aren't persisted, the sdist will be used
+            # instead in this run
+            return None
+        # Either the metadata or a wheel without a METADATA file
+        if database is not None:
+            database.set('wheel-metadata', url, {'metadata': metadata})
+        return metadata
+
+    async def _fetch_wheel_metadata(self, url: str) -> Optional[str]:
+        # PEP 658 metadata file, served by PyPI along with most wheels
+        async with self._get(url + '.metadata') as response:
+            if response.status == 200:
+                return await response.text()
+        # Otherwise, download only the central directory and the METADATA
+        # file of the wheel zip
+        (start, size, tail) = await self._fetch_range(
+            url, f'-{ZIP_TAIL_SIZE}')
+        if start + len(tail) != size:
+            raise UnexpectedResponse(f'Incomplete end of {url}')
+        sparse = SparseFile(size)
+        sparse.add(start, tail)
+        try:
+            (cd_offset, cd_size) = central_directory_range(tail)
+            if not sparse.covers(cd_offset, cd_offset + cd_size):
+                # Wheels with many files have a central directory that
+                # doesn't fit in the tail
+                (offset, _, data) = await self._fetch_range(
+                    url, f'{cd_offset}-{cd_offset + cd_size - 1}')
+                sparse.add(offset, data)
+            with zipfile.ZipFile(sparse) as zf:
+                name = metadata_member(zf.namelist())
+                if name is None:
+                    return None
+                info = zf.getinfo(name)
+                if not sparse.covers(info.header_offset, size):
+                    # The local header has a variable length extra field
+                    # of at most 64 KiB
+                    end = min(size, info.header_offset + 30 +
+                              len(info.orig_filename.encode()) + 2**16 +
+                              info.compress_size)
+                    (offset, _, data) = await self._fetch_range(
+                        url, f'{info.header_offset}-{end - 1}')
+                    sparse.add(offset, data)
+                return zf.read(name).decode()
+        except (OSError, zipfile.BadZipFile, KeyError, ValueError,
+                EOFError) as e:
+            # Usually caused by a truncated response
+            raise UnexpectedResponse(f'Could not read {url}: {e}') from e
+
+    async def _fetch_range(self, url: str,
+                           byte_range: str) -> Tuple[int, int, bytes]:
+        """Download part of a file.
+
+        Return the offset of the downloaded data, the size of the whole
+        file and the data.
+        """
+        headers = {'Range': f'bytes={byte_range}'}
+        async with self._get(url, headers=headers) as response:
+            if response.status != 206:
+                raise UnexpectedResponse(
+                    f'Range request to {url} returned {response.status}')
+            # For example, bytes 100-199/1000
+            content_range = response.headers.get('Content-Range', '')
+            match = re.fullmatch(r'bytes (\d+)-\d+/(\d+)', content_range)
+            if match is None:
+                raise UnexpectedResponse(
+                    f'Invalid Content-Range from {url}: {content_range}')
+            return (int(match.group(1)), int(match.group(2)),
+                    await response.read())
+
     async def fetch(self, package_name):
-        url = f'https://pypi.org/pypi/{quote(package_name)}/json'
-        async with aiohttp.ClientSession(raise_for_status=True) as session:
-            async with session.get(url) as response:
-                return await response.json()
+        with span('fetch_json', package=package_name) as record:
+            return await self._fetch(package_name, record)
+
+    async def _fetch(self, package_name: str, record: Dict[str, Any]):
+        url = f'{self.index_url}/{quote(package_name)}/json'
+        entry = self._lookup(package_name)
+        headers = {}
+        body: Optional[bytes] = None
+        if entry is not None:
+            (digest, etag, last_modified, fetched_at) = entry
+            body = self._read_blob(digest)
+            if body is not None and time.time() - fetched_at < self.ttl:
+                self._touch(package_name, refresh=False)
+                record['cached'] = True
+                return json.loads(body)
+            if body is not None:
+                if etag:
+                    headers['If-None-Match'] = etag
+                if last_modified:
+                    headers['If-Modified-Since'] = last_modified
+        async with self._get(url, headers=headers) as response:
+            if response.status == 404:
+                raise PackageNotFound(f'{package_name} not found in PyPI')
+            record['status'] = response.status
+            if response.status == 304 and body is not None:
+                self._touch(package_name, refresh=True)
+                return json.loads(body)
+            response.raise_for_status()
+            body = await response.read()
+            self._store(
+                package_name, body,
+                etag=response.headers.get('ETag'),
+                last_modified=response.headers.get('Last-Modified'),
+            )
+            return json.loads(body)
+
+    def _connect(self) -> Optional[sqlite3.Connection]:
+        if self.cache_dir is None:
+            return None
+        if self._db is None:
+            (self.cache_dir / 'blobs').mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(
+                str(self.cache_dir / 'index.db'), timeout=30)
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    name TEXT PRIMARY KEY,
+                    digest TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    etag TEXT,
+                    last_modified TEXT,
+                    fetched_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            """)
+        return self._db
+
+    def _blob_path(self, digest: str) -> Path:
+        assert self.cache_dir is not None
+        return self.cache_dir / 'blobs' / digest
+
+    def _read_blob(self, digest: str) -> Optional[bytes]:
+        try:
+            return self._blob_path(digest).read_bytes()
+        except OSError:
+            return None
+
+    def _lookup(self, package_name: str):
+        db = self._connect()
+        if db is None:
+            return None
+        return db.execute(
+            'SELECT digest, etag, last_modified, fetched_at FROM responses '
+            'WHERE name = ?', (package_name,)).fetchone()
+
+    def _touch(self, package_name: str, refresh: bool):
+        db = self._connect()
+        assert db is not None
+        now = time.time()
+        with db:
+            if refresh:
+                db.execute(
+                    'UPDATE responses SET fetched_at = ?, accessed_at = ? '
+                    'WHERE name = ?', (now, now, package_name))
+            else:
+                db.execute(
+                    'UPDATE responses SET accessed_at = ? WHERE name = ?',
+                    (now, package_name))
+
+    def _store(self, package_name: str, body: bytes,
+               etag: Optional[str], last_modified: Optional[str]):
+        db = self._connect()
+        if db is None:
+            return
+        # Blobs are content-addressed, so identical responses share a file
+        digest = hashlib.sha256(body).hexdigest()
+        blob_path = self._blob_path(digest)
+        if not blob_path.exists():
+            tmp_path = blob_path.with_name(f'.tmp-{os.getpid()}-{digest}')
+            tmp_path.write_bytes(body)
+            os.replace(tmp_path, blob_path)
+        now = time.time()
+        with db:
+            previous = db.execute(
+                'SELECT digest FROM responses WHERE name = ?',
+                (package_name,)).fetchone()
+            db.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (package_name, digest, len(body), etag, last_modified,
+                 now, now))
+        if previous is not None and previous[0] != digest:
+            self._remove_unreferenced_blob(previous[0])
+        self._evict()
+
+    def _remove_unreferenced_blob(self, digest: str) -> bool:
+        assert self._db is not None
+        (references,) = self._db.execute(
+            'SELECT COUNT(*) FROM responses WHERE digest = ?',
+            (digest,)).fetchone()
+        if references:
+            return False
+        try:
+            self._blob_path(digest).unlink()
+        except FileNotFoundError:
+            pass
+        return True
+
+    def _evict(self):
+        assert self._db is not None
+        (total,) = self._db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM '
+            '(SELECT DISTINCT digest, size FROM responses)').fetchone()
+        if total <= self.max_size:
+            return
+        rows = self._db.execute(
+            'SELECT name, digest, size FROM responses '
+            'ORDER BY accessed_at').fetchall()
+        for (name, digest, size) in rows:
+            if total <= self.max_size:
+                break
+            with self._db:
+                self._db.execute(
+                    'DELETE FROM responses WHERE name = ?', (name,))
+            if self._remove_unreferenced_blob(digest):
+                total -= size
 
     async def fetch_url(self, url, sha256) -> Path:
         from pynixify.expression_builder import escape_string
@@ -130,25 +552,93 @@ class PyPICache:
 
 
 async def nix_instantiate(expr: str, attr=None, **kwargs):
+    evaluator = get_evaluator()
+    if evaluator is not None:
+        return await evaluator.evaluate(expr, attr, kwargs)
+
     extra_args: List[str] = []
     if attr is not None:
         extra_args += ['--attr', attr]
     for (k, v) in kwargs.items():
         extra_args += ['--arg', k, v]
 
-    proc = await asyncio.create_subprocess_exec(
+    (status, stdout, stderr) = await scheduler.run(
         'nix-instantiate', '--json', '--eval', '-', *extra_args,
-        stdin=asyncio.subprocess.PIPE,
-        stdout=asyncio.subprocess.PIPE,
-    )
-    proc.stdin.write(expr.encode())  # type: ignore
-    proc.stdin.write_eof()  # type: ignore
-    stdout, stderr = await proc.communicate()
-    status = await proc.wait()
-    assert (await proc.wait()) == 0
+        stdin=expr.encode())
+    if status:
+        print(stderr.decode(), file=sys.stderr)
+    assert status == 0
     return json.loads(stdout.decode())
 
 
+async def file_sha256(path: Path) -> str:
+    """Return the hex SHA256 of a file without blocking the event loop.
+
+    Store paths are immutable, so their hash is recorded in the persistent
+    cache and each one is hashed at most once per machine.
+    """
+    database = get_database() if is_store_path(path) else None
+    if database is not None:
+        known_digest: Optional[str] = database.get('file-sha256', str(path))
+        if known_digest is not None:
+            return known_digest
+    loop = asyncio.get_running_loop()
+    digest = await loop.run_in_executor(None, _sha256_file, path)
+    if database is not None:
+        database.set('file-sha256', str(path), digest)
+    return digest
+
+
+def _sha256_file(path: Path) -> str:
+    h = hashlib.sha256()
+    with path.open('rb') as fp:
+        try:
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                h.update(m)
+                return h.hexdigest()
+        except (ValueError, OSError):
+            # Empty files and special files such as /dev/null can't be
+            # mapped into memory
+            pass
+        while True:
+            data = fp.read(65536)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+NIX_BASE32_CHARS = '0123456789abcdfghijklmnpqrsvwxyz'
+
+
+def nix_base32(digest: bytes) -> str:
+    """Encode a hash the way nix-prefetch-url prints it.
+
+    Nix uses its own base32 alphabet, and encodes the bytes starting from
+    the least significant bits of the last one.
+    """
+    length = (len(digest) * 8 - 1) // 5 + 1
+    chars = []
+    for n in reversed(range(length)):
+        bit = n * 5
+        (i, j) = divmod(bit, 8)
+        c = digest[i] >> j
+        if i + 1 < len(digest):
+            c |= digest[i + 1] << (8 - j)
+        chars.append(NIX_BASE32_CHARS[c & 0x1f])
+    return ''.join(chars)
+
+
+async def get_package_hash(package: PyPIPackage) -> str:
+    """Return the hash of the package source, in Nix's base32 format."""
+    if package.local_source is None:
+        # We already know the hash from PyPI, so there is no need to hash
+        # the file again
+        return nix_base32(bytes.fromhex(package.sha256))
+    with span('hash', package=package.pypi_name):
+        return await get_path_hash(await package.source())
+
+
 async def get_path_hash(path: Path) -> str:
     url = urlunparse((
         'file',
@@ -158,13 +648,7 @@ async def get_path_hash(path: Path) -> str:
         '',
         '',
     ))
-    proc = await asyncio.create_subprocess_exec(
-        'nix-prefetch-url', url,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE,
-    )
-    (stdout, stderr) = await proc.communicate()
-    status = await proc.wait()
+    (status, stdout, stderr) = await scheduler.run('nix-prefetch-url', url)
     if status:
         print(stderr.decode(), file=sys.stderr)
         raise RuntimeError(f'nix-prefetch-url failed with code {status}')
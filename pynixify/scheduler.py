@@ -0,0 +1,300 @@
+# pynixify - Nix expression generator for Python packages
+# Copyright (C) 2020 Matías Lang
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import heapq
+import asyncio
+import itertools
+from collections import Counter, defaultdict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from multiprocessing import cpu_count
+from pynixify.trace import Lanes, span
+from typing import Any, Callable, Dict, List, Optional, Tuple, AsyncIterator
+
+# Lower values are served first. Resolving the dependency tree is the
+# critical path of a run, formatting the generated files is the least
+# urgent thing to do.
+PRIORITY_RESOLVE = 0
+# Work that the resolver will probably, but not certainly, need
+PRIORITY_SPECULATIVE = 5
+PRIORITY_WRITE = 10
+PRIORITY_FORMAT = 20
+
+# Bytes read at once from the stdout of streamed processes
+STREAM_CHUNK_SIZE = 2**16
+
+
+class Priority:
+    """The priority of the processes spawned by a task.
+
+    Unlike a plain number, it can be promoted while the task is waiting
+    for a budget, for example when a speculative task becomes needed.
+    """
+
+    def __init__(self, value: int):
+        self.value = value
+        # Budgets where it is queued, and how many times
+        self.budgets: 'Counter[Budget]' = Counter()
+
+    def promote(self, value: int):
+        if value >= self.value:
+            return
+        self.value = value
+        for budget in list(self.budgets):
+            budget.reprioritize()
+
+
+_priority: ContextVar[Optional[Priority]] = ContextVar(
+    'priority', default=None)
+
+
+def set_priority(priority: int) -> Priority:
+    """Set the priority of the processes spawned by the current task.
+
+    Tasks created afterwards by the current one inherit it. The returned
+    object can be used to promote all of them later.
+    """
+    current = Priority(priority)
+    _priority.set(current)
+    return current
+
+
+def get_priority() -> int:
+    current = _priority.get()
+    return PRIORITY_RESOLVE if current is None else current.value
+
+
+@dataclass
+class BudgetStats:
+    capacity: int
+    acquisitions: int = 0
+    max_queue_depth: int = 0
+    total_wait: float = 0
+
+
+class Budget:
+    """A counting semaphore whose waiters are woken by priority.
+
+    Each holder takes a weight, so expensive processes can use more than
+    one unit of the budget. Unlike asyncio.Semaphore, it isn't bound to an
+    event loop.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.used = 0
+        self.stats = BudgetStats(capacity=capacity)
+        self._waiters: List[
+            Tuple[int, int, int, asyncio.Future, Priority]] = []
+        self._counter = itertools.count()
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(1 for (_, _, _, f, _) in self._waiters if not f.done())
+
+    def set_capacity(self, capacity: int):
+        self.capacity = self.stats.capacity = capacity
+        self._wake()
+
+    async def acquire(self, weight: int = 1,
+                      priority: Optional[int] = None) -> int:
+        # A weight bigger than the budget would never be satisfied
+        weight = min(weight, self.capacity)
+        if priority is not None:
+            current = Priority(priority)
+        else:
+            current = _priority.get() or Priority(PRIORITY_RESOLVE)
+        start = time.monotonic()
+        if not self.queue_depth and self.used + weight <= self.capacity:
+            self.used += weight
+        else:
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._waiters, (
+                current.value, next(self._counter), weight, future, current))
+            self.stats.max_queue_depth = max(
+                self.stats.max_queue_depth, self.queue_depth)
+            current.budgets[self] += 1
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # The slot was given to us right before the cancellation
+                    self.release(weight)
+                raise
+            finally:
+                current.budgets[self] -= 1
+                if not current.budgets[self]:
+                    del current.budgets[self]
+        self.stats.acquisitions += 1
+        self.stats.total_wait += time.monotonic() - start
+        return weight
+
+    def release(self, weight: int = 1):
+        self.used -= weight
+        self._wake()
+
+    def reprioritize(self):
+        """Reorder the waiters after some of their priorities changed."""
+        self._waiters = [
+            (current.value, counter, weight, future, current)
+            for (_, counter, weight, future, current) in self._waiters
+        ]
+        heapq.heapify(self._waiters)
+        self._wake()
+
+    def _wake(self):
+        while self._waiters:
+            (_, _, weight, future, _) = self._waiters[0]
+            if future.done() or future.get_loop().is_closed():
+                heapq.heappop(self._waiters)
+                continue
+            if self.used + weight > self.capacity:
+                break
+            heapq.heappop(self._waiters)
+            self.used += weight
+            future.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, weight: int = 1,
+                   priority: Optional[int] = None) -> AsyncIterator[None]:
+        weight = await self.acquire(weight, priority)
+        try:
+            yield
+        finally:
+            self.release(weight)
+
+
+class SubprocessScheduler:
+    """Limit the number of processes spawned by pynixify.
+
+    Each program has its own budget, so a lot of cheap nixfmt processes
+    can't delay the nix-build processes needed to resolve dependencies.
+    """
+
+    def __init__(self, limits: Dict[str, int], default_limit: int):
+        self.default_limit = default_limit
+        self.budgets = {
+            program: Budget(limit)
+            for (program, limit) in limits.items()
+        }
+        self._slots: Dict[str, Lanes] = defaultdict(Lanes)
+
+    def budget(self, program: str) -> Budget:
+        try:
+            return self.budgets[program]
+        except KeyError:
+            budget = self.budgets[program] = Budget(self.default_limit)
+            return budget
+
+    def set_limit(self, program: str, limit: int):
+        self.budget(program).set_capacity(limit)
+
+    @asynccontextmanager
+    async def _slot(self, program: str, weight: int,
+                    priority: Optional[int]) -> AsyncIterator[Dict[str, Any]]:
+        # The span covers both the time waiting for the budget, which is
+        # recorded separately, and the time running the process
+        with span('subprocess', program=program, weight=weight,
+                  priority=get_priority() if priority is None else priority
+                  ) as record:
+            queued = time.monotonic()
+            async with self.budget(program).slot(weight, priority):
+                record['wait'] = time.monotonic() - queued
+                # Only used to draw each slot of the budget in a track
+                slot = record['slot'] = self._slots[program].acquire()
+                try:
+                    yield record
+                finally:
+                    self._slots[program].release(slot)
+
+    async def run(self, program: str, *args: str,
+                  stdin: Optional[bytes] = None, weight: int = 1,
+                  priority: Optional[int] = None) -> Tuple[int, bytes, bytes]:
+        """Run a program once its budget allows it.
+
+        Return its exit status, stdout and stderr.
+        """
+        async with self._slot(program, weight, priority) as record:
+            proc = await asyncio.create_subprocess_exec(
+                program, *args,
+                stdin=asyncio.subprocess.PIPE if stdin is not None else None,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            try:
+                (stdout, stderr) = await proc.communicate(stdin)
+            except asyncio.CancelledError:
+                # Don't leave the process running when nobody will read
+                # its output
+                if proc.returncode is None:
+                    proc.kill()
+                    await proc.wait()
+                raise
+            status = await proc.wait()
+            record['status'] = status
+        return (status, stdout, stderr)
+
+    async def run_streaming(
+            self, program: str, *args: str,
+            on_stdout: Callable[[bytes], None], weight: int = 1,
+            priority: Optional[int] = None) -> Tuple[int, bytes]:
+        """Run a program once its budget allows it, passing each chunk of
+        its stdout to on_stdout as soon as it is read.
+
+        Return its exit status and stderr.
+        """
+        async with self._slot(program, weight, priority) as record:
+            proc = await asyncio.create_subprocess_exec(
+                program, *args,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            assert proc.stdout is not None and proc.stderr is not None
+            # Read stderr at the same time, otherwise the process could
+            # block after filling its pipe
+            stderr = asyncio.ensure_future(proc.stderr.read())
+            try:
+                while True:
+                    chunk = await proc.stdout.read(STREAM_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    on_stdout(chunk)
+                status = await proc.wait()
+                record['status'] = status
+            except BaseException:
+                stderr.cancel()
+                if proc.returncode is None:
+                    proc.kill()
+                    await proc.wait()
+                raise
+            return (status, await stderr)
+
+    def stats(self) -> Dict[str, BudgetStats]:
+        return {
+            program: budget.stats
+            for (program, budget) in self.budgets.items()
+        }
+
+
+scheduler = SubprocessScheduler({
+    'nix-build': cpu_count(),
+    'nix-instantiate': cpu_count(),
+    # Each nix-prefetch-url process downloads a file
+    'nix-prefetch-url': 4,
+    'nixfmt': cpu_count(),
+}, default_limit=cpu_count())
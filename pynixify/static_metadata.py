@@ -0,0 +1,277 @@
+# pynixify - Nix expression generator for Python packages
+# Copyright (C) 2020 Matías Lang
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Read the requirements of packages that declare them statically.
+
+Packages whose requirements are in pyproject.toml (PEP 621) or in
+setup.cfg, and whose setup.py (if any) does nothing but calling setup(),
+can be parsed without running setup.py in a nix sandbox.
+"""
+
+import ast
+import sys
+import tarfile
+import zipfile
+import configparser
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+from packaging.requirements import InvalidRequirement, Requirement
+from packaging.utils import canonicalize_name
+
+if sys.version_info >= (3, 11):
+    import tomllib
+else:
+    try:
+        import tomli as tomllib
+    except ImportError:
+        # Without a TOML parser, pyproject.toml files are ignored
+        tomllib = None
+
+# Extras that usually have the requirements needed to run the tests
+TEST_EXTRAS = ('test', 'tests', 'testing')
+
+# Build requirements that are always available when building a package
+# with buildPythonPackage
+IMPLICIT_BUILD_REQUIREMENTS = ('setuptools', 'wheel')
+
+MEMBERS = ('pyproject.toml', 'setup.cfg', 'setup.py')
+
+
+class DynamicMetadata(Exception):
+    """The requirements can only be known by running setup.py."""
+
+
+def read_members(path: Path) -> Dict[str, bytes]:
+    """Read the top-level files in MEMBERS of a source distribution.
+
+    Tarballs are streamed, so reading stops as soon as every file was
+    found.
+    """
+    if path.is_dir():
+        return {
+            name: (path / name).read_bytes()
+            for name in MEMBERS
+            if (path / name).is_file()
+        }
+
+    members: Dict[str, bytes] = {}
+    if path.name.endswith('.zip'):
+        with zipfile.ZipFile(path) as zf:
+            for name in zf.namelist():
+                member = _top_level_name(name)
+                if member is not None:
+                    members[member] = zf.read(name)
+        return members
+
+    with tarfile.open(path, 'r|*') as tf:
+        for info in tf:
+            member = _top_level_name(info.name)
+            if member is None or not info.isfile():
+                continue
+            fp = tf.extractfile(info)
+            assert fp is not None
+            members[member] = fp.read()
+            if len(members) == len(MEMBERS):
+                break
+    return members
+
+
+def _top_level_name(name: str) -> Optional[str]:
+    # Source distributions have all their files inside a
+    # <name>-<version>/ directory
+    parts = name.split('/')
+    if len(parts) == 2 and parts[1] in MEMBERS:
+        return parts[1]
+    return None
+
+
+def parse_members(members: Dict[str, bytes]) -> Optional[Dict[str, Any]]:
+    """Get the requirements and metadata declared in the given files.
+
+    The result has the same format as SourceData.to_json. Return None if
+    the files don't have all the needed information.
+    """
+    setup_py = members.get('setup.py')
+    if setup_py is not None and not is_trivial_setup_py(setup_py):
+        return None
+    try:
+        pyproject: Dict[str, Any] = {}
+        if 'pyproject.toml' in members:
+            if tomllib is None:
+                return None
+            pyproject = tomllib.loads(members['pyproject.toml'].decode())
+        build_system = pyproject.get('build-system', {}).get('requires', [])
+        if 'project' in pyproject:
+            return _parse_project(pyproject['project'], build_system)
+        if 'setup.cfg' in members:
+            return _parse_setup_cfg(members['setup.cfg'], build_system)
+    except (DynamicMetadata, InvalidRequirement, ValueError,
+            UnicodeDecodeError, configparser.Error):
+        return None
+    return None
+
+
+def is_trivial_setup_py(source: bytes) -> bool:
+    """Whether a setup.py only calls setup() without arguments."""
+    try:
+        module = ast.parse(source)
+    except (SyntaxError, ValueError):
+        return False
+    body = module.body
+    last = body[-1] if body else None
+    if isinstance(last, ast.If) and _is_main_check(last):
+        # if __name__ == "__main__": setup()
+        body = body[:-1] + last.body
+    setup_calls = 0
+    for node in body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            continue
+        if (isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant)
+                and isinstance(node.value.value, str)):
+            # Docstring
+            continue
+        if (isinstance(node, ast.Expr) and isinstance(node.value, ast.Call)
+                and _call_name(node.value.func) == 'setup' and
+                not node.value.args and not node.value.keywords):
+            setup_calls += 1
+            continue
+        return False
+    return setup_calls == 1
+
+
+def _is_main_check(node: ast.If) -> bool:
+    return (not node.orelse and isinstance(node.test, ast.Compare) and
+            isinstance(node.test.left, ast.Name) and
+            node.test.left.id == '__name__')
+
+
+def _call_name(func: ast.expr) -> Optional[str]:
+    if isinstance(func, ast.Name):
+        return func.id
+    if isinstance(func, ast.Attribute):
+        return func.attr
+    return None
+
+
+def _parse_project(project: Dict[str, Any],
+                   build_system: List[str]) -> Dict[str, Any]:
+    dynamic = project.get('dynamic', [])
+    if 'dependencies' in dynamic or 'optional-dependencies' in dynamic:
+        raise DynamicMetadata()
+
+    test_requirements: List[str] = []
+    for (extra, reqs) in project.get('optional-dependencies', {}).items():
+        if canonicalize_name(extra) in TEST_EXTRAS:
+            test_requirements += reqs
+
+    license = project.get('license')
+    if isinstance(license, dict):
+        license = license.get('text')
+
+    urls = {
+        name.lower(): url
+        for (name, url) in project.get('urls', {}).items()
+    }
+
+    return _source_data(
+        build_requirements=build_system,
+        test_requirements=test_requirements,
+        runtime_requirements=project.get('dependencies', []),
+        description=project.get('description'),
+        license=license,
+        url=urls.get('homepage') or urls.get('home'),
+        version=None if 'version' in dynamic else project.get('version'),
+    )
+
+
+def _parse_setup_cfg(content: bytes,
+                     build_system: List[str]) -> Optional[Dict[str, Any]]:
+    config = configparser.ConfigParser(interpolation=None)
+    config.read_string(content.decode())
+    if not config.has_section('metadata') or not config.has_section('options'):
+        return None
+
+    def get_list(section: str, option: str) -> List[str]:
+        value = config.get(section, option, fallback='').strip()
+        if value.startswith('file:') or value.startswith('attr:'):
+            raise DynamicMetadata()
+        if '\n' in value:
+            lines = value.splitlines()
+        else:
+            lines = value.split(';')
+        return [
+            line.strip() for line in lines
+            if line.strip() and not line.strip().startswith('#')
+        ]
+
+    test_requirements = get_list('options', 'tests_require')
+    if config.has_section('options.extras_require'):
+        for extra in config.options('options.extras_require'):
+            if canonicalize_name(extra) in TEST_EXTRAS:
+                test_requirements += get_list('options.extras_require', extra)
+
+    version = config.get('metadata', 'version', fallback=None)
+    if version is not None and ':' in version:
+        # file: or attr: directive
+        version = None
+
+    return _source_data(
+        build_requirements=(
+            build_system + get_list('options', 'setup_requires')),
+        test_requirements=test_requirements,
+        runtime_requirements=get_list('options', 'install_requires'),
+        description=config.get('metadata', 'description', fallback=None),
+        license=config.get('metadata', 'license', fallback=None),
+        url=config.get('metadata', 'url', fallback=None),
+        version=version,
+    )
+
+
+def _source_data(build_requirements: List[str],
+                 test_requirements: List[str],
+                 runtime_requirements: List[str],
+                 description: Optional[str],
+                 license: Optional[str],
+                 url: Optional[str],
+                 version: Optional[str]) -> Dict[str, Any]:
+    build_requirements = [
+        r for r in build_requirements
+        if canonicalize_name(Requirement(r).name) not in
+        IMPLICIT_BUILD_REQUIREMENTS
+    ]
+    return {
+        'build_requirements': [str(Requirement(r)) for r in build_requirements],
+        'test_requirements': [str(Requirement(r)) for r in test_requirements],
+        'runtime_requirements': [
+            str(Requirement(r)) for r in runtime_requirements],
+        'metadata': {
+            'description': description or None,
+            'license': license or None,
+            'url': url or None,
+        },
+        'version': version,
+    }
+
+
+def static_source_data(path: Path) -> Optional[Dict[str, Any]]:
+    """Get the requirements and metadata of a package source without
+    building it, if they are declared statically.
+    """
+    try:
+        members = read_members(path)
+    except (OSError, tarfile.TarError, zipfile.BadZipFile):
+        return None
+    return parse_members(members)
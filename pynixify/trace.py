@@ -0,0 +1,276 @@
+# pynixify - Nix expression generator for Python packages
+# Copyright (C) 2020 Matías Lang
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Record what pynixify spends its time on, as JSON lines.
+
+Each line is either a span, with start and end Unix timestamps, or an
+instant event, with only a start. Spans have an id, and the parent of a
+span or event is the span that was active in the task that created it.
+The task field identifies the asyncio task that ran it.
+
+ChromeTracer writes the same records as a Chrome trace-event file instead.
+"""
+
+import json
+import time
+import asyncio
+import weakref
+import itertools
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional, Set, TextIO
+
+_tracer: Optional['Tracer'] = None
+
+_current_span: ContextVar[Optional[int]] = ContextVar(
+    'current_span', default=None)
+
+# The id() of a task can be reused once it is garbage collected, so tasks
+# are numbered instead
+_task_ids: 'weakref.WeakKeyDictionary[asyncio.Task, int]' = (
+    weakref.WeakKeyDictionary())
+_task_counter = itertools.count(1)
+
+
+class Tracer:
+    def __init__(self, fp: TextIO):
+        self.fp = fp
+        self._ids = itertools.count(1)
+
+    def next_id(self) -> int:
+        return next(self._ids)
+
+    def emit(self, record: Dict[str, Any]):
+        self.fp.write(json.dumps(record, default=str) + '\n')
+
+    def close(self):
+        self.fp.close()
+
+
+class ChromeTracer(Tracer):
+    """Write the records as a Chrome trace-event file when it is closed.
+
+    The file can be opened with Perfetto or chrome://tracing. See
+    chrome_trace for how the records are drawn.
+    """
+
+    def __init__(self, fp: TextIO):
+        super().__init__(fp)
+        self.records: List[Dict[str, Any]] = []
+
+    def emit(self, record: Dict[str, Any]):
+        self.records.append(record)
+
+    def close(self):
+        json.dump(chrome_trace(self.records), self.fp)
+        super().close()
+
+
+class Lanes:
+    """Give each concurrent user of a resource the lowest free number, so
+    they can be drawn in separate tracks."""
+
+    def __init__(self):
+        self._used: Set[int] = set()
+
+    def acquire(self) -> int:
+        lane = 0
+        while lane in self._used:
+            lane += 1
+        self._used.add(lane)
+        return lane
+
+    def release(self, lane: int):
+        self._used.discard(lane)
+
+
+def set_tracer(tracer: Optional[Tracer]):
+    """Send the spans and events to the given tracer.
+
+    Setting it to None disables tracing.
+    """
+    global _tracer
+    _tracer = tracer
+
+
+def get_tracer() -> Optional[Tracer]:
+    return _tracer
+
+
+@contextmanager
+def span(name: str, **fields: Any) -> Iterator[Dict[str, Any]]:
+    """Record the duration of the enclosed block.
+
+    The yielded dict can be updated to add fields that are only known
+    inside the block. If the block raises, the exception type is recorded
+    in the error field.
+    """
+    tracer = _tracer
+    if tracer is None:
+        yield {}
+        return
+    record: Dict[str, Any] = {
+        'type': 'span',
+        'name': name,
+        'id': tracer.next_id(),
+        'parent': _current_span.get(),
+        'task': _task_id(),
+        'start': time.time(),
+        **fields,
+    }
+    token = _current_span.set(record['id'])
+    try:
+        yield record
+    except BaseException as e:
+        record['error'] = type(e).__name__
+        raise
+    finally:
+        _current_span.reset(token)
+        record['end'] = time.time()
+        tracer.emit(record)
+
+
+def event(name: str, **fields: Any):
+    """Record something that happened at a single point in time."""
+    tracer = _tracer
+    if tracer is None:
+        return
+    tracer.emit({
+        'type': 'event',
+        'name': name,
+        'parent': _current_span.get(),
+        'task': _task_id(),
+        'start': time.time(),
+        **fields,
+    })
+
+
+def _task_id() -> Optional[int]:
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        # There is no running event loop
+        return None
+    if task is None:
+        return None
+    task_id = _task_ids.get(task)
+    if task_id is None:
+        task_id = _task_ids[task] = next(_task_counter)
+    return task_id
+
+
+# Process ids of the Chrome trace. Each subprocess program gets its own
+# process, after these ones.
+_TASKS_PID = 1
+_HTTP_PID = 2
+
+
+def chrome_trace(records: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Convert trace records to the Chrome trace-event format.
+
+    Each asyncio task has its own track. When a span is started by a task
+    other than the one of its parent span, a flow arrow goes from the
+    parent, which is usually waiting for it in a gather(), to the span.
+
+    Subprocesses are also drawn in one track per slot of the budget of
+    their program, and the time they waited for a slot is drawn as a
+    queued span inside the subprocess span. HTTP requests are also drawn
+    in one track per open connection, from the moment they got one.
+    """
+    if not records:
+        return {'traceEvents': []}
+    t0 = min(r['start'] for r in records)
+
+    def ts(t: float) -> float:
+        return (t - t0) * 1e6
+
+    events: List[Dict[str, Any]] = []
+    tids: Dict[Optional[int], int] = {}
+    pids: Dict[str, int] = {}
+    flow_ids = itertools.count(1)
+    spans = {r['id']: r for r in records if r['type'] == 'span'}
+
+    def task_tid(task: Optional[int]) -> int:
+        if task not in tids:
+            tids[task] = len(tids) + 1
+            events.append(_metadata(
+                'thread_name', _TASKS_PID, tids[task],
+                'main' if task is None else f'task {tids[task]}'))
+        return tids[task]
+
+    def program_pid(program: str) -> int:
+        if program not in pids:
+            pids[program] = _HTTP_PID + len(pids) + 1
+            events.append(_metadata(
+                'process_name', pids[program], 0, f'{program} slots'))
+        return pids[program]
+
+    def flow(start: Dict[str, Any], end: Dict[str, Any]):
+        flow_id = next(flow_ids)
+        events.append({**start, 'ph': 's', 'id': flow_id, 'cat': 'flow',
+                       'name': 'waits for'})
+        events.append({**end, 'ph': 'f', 'bp': 'e', 'id': flow_id,
+                       'cat': 'flow', 'name': 'waits for'})
+
+    events.append(_metadata('process_name', _TASKS_PID, 0, 'asyncio tasks'))
+    events.append(_metadata('process_name', _HTTP_PID, 0, 'HTTP connections'))
+    for record in sorted(records, key=lambda r: r['start']):
+        args = {
+            k: v for (k, v) in record.items()
+            if k not in ('type', 'name', 'id', 'parent', 'task', 'start',
+                         'end')
+        }
+        location = {
+            'pid': _TASKS_PID,
+            'tid': task_tid(record['task']),
+            'ts': ts(record['start']),
+        }
+        if record['type'] == 'event':
+            events.append({**location, 'ph': 'i', 's': 't',
+                           'name': record['name'], 'args': args})
+            continue
+        events.append({**location, 'ph': 'X', 'name': record['name'],
+                       'dur': ts(record['end']) - location['ts'],
+                       'args': args})
+
+        parent = spans.get(record['parent'])
+        if parent is not None and parent['task'] != record['task']:
+            flow({'pid': _TASKS_PID, 'tid': task_tid(parent['task']),
+                  'ts': location['ts']}, location)
+
+        if record['name'] == 'subprocess' and 'slot' in record:
+            started = record['start'] + record['wait']
+            events.append({**location, 'ph': 'X', 'name': 'queued',
+                           'dur': ts(started) - location['ts']})
+            slot = {'pid': program_pid(record['program']),
+                    'tid': record['slot'], 'ts': ts(started)}
+            events.append({**slot, 'ph': 'X', 'name': record['program'],
+                           'dur': ts(record['end']) - slot['ts'],
+                           'args': args})
+            flow({**location, 'ts': slot['ts']}, slot)
+        elif record['name'] == 'http' and 'connection' in record:
+            connection = {'pid': _HTTP_PID, 'tid': record['connection'],
+                          'ts': ts(record['start'] + record['wait'])}
+            events.append({**connection, 'ph': 'X', 'name': 'http',
+                           'dur': ts(record['end']) - connection['ts'],
+                           'args': args})
+            flow({**location, 'ts': connection['ts']}, connection)
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def _metadata(name: str, pid: int, tid: int, value: str) -> Dict[str, Any]:
+    return {'ph': 'M', 'name': name, 'pid': pid, 'tid': tid,
+            'args': {'name': value}}
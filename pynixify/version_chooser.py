@@ -18,7 +18,8 @@ import asyncio
 import operator
 from pathlib import Path
 from dataclasses import dataclass
-from typing import Any, Dict, Callable, Awaitable, Optional, List, Tuple
+from multiprocessing import cpu_count
+from typing import Any, Dict, Callable, Awaitable, Optional, List, Sequence, Set, Tuple
 from packaging.requirements import Requirement
 from packaging.utils import canonicalize_name
 from packaging.specifiers import SpecifierSet
@@ -27,8 +28,16 @@ from pynixify.nixpkgs_sources import NixpkgsData, NixPackage
 from pynixify.pypi_api import PyPIData, PyPIPackage
 from pynixify.package_requirements import (
     PackageRequirements,
-    eval_path_requirements,
+    eval_package,
 )
+from pynixify.scheduler import (
+    Budget,
+    Priority,
+    PRIORITY_RESOLVE,
+    PRIORITY_SPECULATIVE,
+    set_priority,
+)
+from pynixify.trace import span
 from pynixify.exceptions import (
     NoMatchingVersionFound,
     PackageNotFound,
@@ -47,20 +56,25 @@ class VersionChooser:
         self.should_load_tests = should_load_tests
 
     async def require(self, r: Requirement, coming_from: Optional[Package]=None):
+        with span('resolve', requirement=str(r),
+                  coming_from=coming_from and str(coming_from)):
+            await self._require(r, coming_from)
+
+    async def _require(self, r: Requirement, coming_from: Optional[Package]):
         pkg: Package
 
         if r.marker and not r.marker.evaluate():
             return
 
+        await self.nixpkgs_data.prepare(r.name)
+        nixpkgs_pkgs: Optional[Sequence[NixPackage]]
         try:
-            self.nixpkgs_data.from_requirement(r)
+            nixpkgs_pkgs = self.nixpkgs_data.from_requirement(r)
         except PackageNotFound:
-            is_in_nixpkgs = False
-        else:
-            is_in_nixpkgs = True
+            nixpkgs_pkgs = None
         if (isinstance(coming_from, NixPackage) and
-                is_in_nixpkgs and
-                not self.nixpkgs_data.from_requirement(r)):
+                nixpkgs_pkgs is not None and
+                not nixpkgs_pkgs):
             # This shouldn't happen in an ideal world. Unfortunately,
             # nixpkgs does some patching to packages to disable some
             # requirements. Because we don't use these patches, the
@@ -98,11 +112,10 @@ class VersionChooser:
         try:
             pkg = self._local_packages[canonicalize_name(r.name)]
         except KeyError:
-            try:
-                for p in self.nixpkgs_data.from_requirement(r):
-                    pkgs.append(p)
-            except PackageNotFound:
+            if nixpkgs_pkgs is None:
                 found_nixpkgs = False
+            else:
+                pkgs += nixpkgs_pkgs
 
             if not pkgs:
                 try:
@@ -131,7 +144,20 @@ class VersionChooser:
                         reqs.build_requirements)
         ))
 
+    async def require_all(self, requirements: Sequence[Requirement]):
+        """Require many packages at once."""
+        await asyncio.gather(*map(self.require, requirements))
+
     async def require_local(self, pypi_name: str, src: Path):
+        await self.require(self.add_local(pypi_name, src))
+
+    def add_local(self, pypi_name: str, src: Path) -> Requirement:
+        """Use the source in src for the given package, without requiring
+        it yet.
+
+        Returns the requirement of the package, so it can be required
+        along with the rest of them.
+        """
         assert pypi_name not in self._choosed_packages
         package = PyPIPackage(
             pypi_name=pypi_name,
@@ -142,7 +168,7 @@ class VersionChooser:
             local_source=src,
         )
         self._local_packages[canonicalize_name(pypi_name)] = package
-        await self.require(Requirement(pypi_name))
+        return Requirement(pypi_name)
 
     def package_for(self, package_name: str) -> Optional[Package]:
         try:
@@ -151,6 +177,12 @@ class VersionChooser:
             return None
         return pkg
 
+    def all_packages(self) -> Dict[str, Package]:
+        return {
+            name: pkg
+            for (name, (pkg, _)) in self._choosed_packages.items()
+        }
+
     def all_pypi_packages(self) -> List[PyPIPackage]:
         return [
             v[0] for v in self._choosed_packages.values()
@@ -158,10 +190,362 @@ class VersionChooser:
         ]
 
 
+
+@dataclass
+class _ResolutionState:
+    # Packages chosen so far, indexed by canonicalized name
+    decisions: Dict[str, Package]
+    # Every requirement of each name, along with the package requiring it
+    constraints: Dict[str, List[Tuple[Requirement, Optional[Package]]]]
+
+    def copy(self) -> '_ResolutionState':
+        return _ResolutionState(
+            decisions=dict(self.decisions),
+            constraints={
+                name: list(reqs)
+                for (name, reqs) in self.constraints.items()
+            },
+        )
+
+    def specifier(self, name: str) -> SpecifierSet:
+        specifier = SpecifierSet()
+        for (req, _) in self.constraints[name]:
+            specifier &= req.specifier
+        return specifier
+
+    def describe(self, name: str) -> str:
+        return ', '.join(
+            f'{req}{f" (from {parent})" if parent else ""}'
+            for (req, parent) in self.constraints[name]
+        )
+
+
+@dataclass
+class _Frame:
+    # The state before deciding the package
+    state: _ResolutionState
+    name: str
+    # Candidates that weren't tried yet
+    remaining: List[Package]
+    tried_pypi: bool = False
+    # The last conflict found when trying the candidates
+    conflict: Optional[str] = None
+
+
+class BacktrackingVersionChooser(VersionChooser):
+    """Version chooser that revisits previous choices on conflicts.
+
+    The greedy VersionChooser picks the newest version of each package and
+    fails as soon as a later requirement doesn't match it. This one does a
+    depth-first search over the candidate versions instead, always
+    deciding first the package with fewer candidates left. Versions from
+    nixpkgs are preferred over the ones from PyPI, and the search gives up
+    after max_backtracks failed choices so it can't run forever on wide
+    dependency graphs.
+
+    Because choices are made one at a time, the requirements of the best
+    candidate of every pending package are evaluated speculatively in the
+    background, using at most max_speculative slots and a low priority.
+    """
+
+    def __init__(self, *args, max_backtracks: int = 1000,
+                 max_speculative: Optional[int] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_backtracks = max_backtracks
+        if max_speculative is None:
+            max_speculative = max(1, cpu_count() // 2)
+        self._speculation_budget = Budget(max_speculative)
+        self._speculations: Dict[Tuple[str, str, str], asyncio.Task] = {}
+        # Speculations that got a slot of the speculation budget and are
+        # still running. They aren't cancelled, because their evaluation
+        # would keep running anyway.
+        self._started_speculations: Set[Tuple[str, str, str]] = set()
+        # Priorities of the started speculations that weren't promoted, so
+        # they still hold their slot
+        self._speculation_priorities: Dict[
+            Tuple[str, str, str], Priority] = {}
+        self._roots: List[Requirement] = []
+        self._resolved_roots = 0
+        self._lock = asyncio.Lock()
+        self._requirements: Dict[Tuple[str, str, str], asyncio.Task] = {}
+        self._nixpkgs_data_cache: Dict[str, List[Package]] = {}
+        self._pypi_data_cache: Dict[str, List[Package]] = {}
+
+    async def require(self, r: Requirement, coming_from: Optional[Package]=None):
+        await self.require_all([r])
+
+    async def require_all(self, requirements: Sequence[Requirement]):
+        # Each resolution starts from scratch, so doing a single one for
+        # all the requirements is a lot faster than one for each
+        roots = [r for r in requirements
+                 if not r.marker or r.marker.evaluate()]
+        if not roots:
+            return
+        self._roots.extend(roots)
+        async with self._lock:
+            if self._resolved_roots == len(self._roots):
+                # Another call already resolved them along with its own
+                # requirements
+                return
+            roots = list(self._roots)
+            try:
+                with span('resolve', requirements=[str(r) for r in roots]):
+                    await self._resolve(roots)
+            finally:
+                self._cancel_speculations(lambda _: True)
+            self._resolved_roots = len(roots)
+
+    async def _resolve(self, roots: List[Requirement]):
+        state = _ResolutionState(decisions={}, constraints={})
+        for r in roots:
+            state.constraints.setdefault(
+                canonicalize_name(r.name), []).append((r, None))
+
+        previous = {
+            name: pkg for (name, (pkg, _)) in self._choosed_packages.items()
+        }
+        backtracks = 0
+        stack: List[_Frame] = []
+        while True:
+            name = await self._next_undecided(state)
+            if name is None:
+                break
+            print(f'Resolving {name} ({state.describe(name)})')
+            candidates = self._candidates(name, state, from_pypi=False)
+            if previous.get(name) in candidates:
+                # Keep the choices of previous resolutions when possible
+                candidates.remove(previous[name])
+                candidates.insert(0, previous[name])
+            stack.append(_Frame(state, name, candidates))
+
+            while True:
+                frame = stack[-1]
+                (base, name) = (frame.state, frame.name)
+                new_state: Optional[_ResolutionState] = None
+                while new_state is None:
+                    if not frame.remaining and not frame.tried_pypi:
+                        # PyPI is only used after all nixpkgs versions of
+                        # the package failed
+                        frame.tried_pypi = True
+                        frame.remaining = await self._pypi_candidates(
+                            name, base)
+                    if not frame.remaining:
+                        break
+                    pkg = frame.remaining.pop(0)
+                    (new_state, conflict) = await self._decide(base, name, pkg)
+                    if conflict is not None:
+                        frame.conflict = conflict
+                if new_state is not None:
+                    state = new_state
+                    break
+                stack.pop()
+                backtracks += 1
+                if not stack or backtracks > self.max_backtracks:
+                    reason = frame.conflict or (
+                        f'no version of {name} matches {base.describe(name)}')
+                    if stack:
+                        reason = (f'giving up after {backtracks} backtracks: '
+                                  f'{reason}')
+                    raise NoMatchingVersionFound(reason)
+
+        self._choosed_packages = {
+            name: (pkg, state.specifier(name))
+            for (name, pkg) in state.decisions.items()
+        }
+
+    async def _next_undecided(self, state: _ResolutionState) -> Optional[str]:
+        undecided = [
+            name for name in state.constraints
+            if name not in state.decisions
+        ]
+        if not undecided:
+            return None
+        await self.nixpkgs_data.prepare(*undecided)
+        counts = await asyncio.gather(*(
+            self._count_candidates(name, state) for name in undecided
+        ))
+        self._speculate(state, undecided)
+        # Deciding first the most constrained packages makes conflicts
+        # show up as early as possible
+        return min(zip(counts, undecided))[1]
+
+    async def _count_candidates(self, name: str,
+                                state: _ResolutionState) -> int:
+        count = len(self._candidates(name, state, from_pypi=False))
+        if not count:
+            count = len(await self._pypi_candidates(name, state))
+        return count
+
+    def _candidates(self, name: str, state: _ResolutionState,
+                    from_pypi: bool) -> List[Package]:
+        if name in self._local_packages:
+            return [] if from_pypi else [self._local_packages[name]]
+        if from_pypi:
+            candidates = self._pypi_data_cache[name]
+        else:
+            candidates = self._all_nixpkgs_candidates(name)
+        specifier = state.specifier(name)
+        return [p for p in candidates if str(p.version) in specifier]
+
+    def _all_nixpkgs_candidates(self, name: str) -> List[Package]:
+        try:
+            return self._nixpkgs_data_cache[name]
+        except KeyError:
+            pass
+        try:
+            candidates: List[Package] = sorted(
+                self.nixpkgs_data.from_pypi_name(name),
+                key=operator.attrgetter('version'), reverse=True)
+        except PackageNotFound:
+            candidates = []
+        self._nixpkgs_data_cache[name] = candidates
+        return candidates
+
+    async def _pypi_candidates(self, name: str,
+                               state: _ResolutionState) -> List[Package]:
+        if name in self._local_packages:
+            return []
+        if name not in self._pypi_data_cache:
+            try:
+                pkgs = await self.pypi_data.from_requirement(Requirement(name))
+            except PackageNotFound:
+                if not self._all_nixpkgs_candidates(name):
+                    raise PackageNotFound(
+                        f'{name} not found in PyPI nor nixpkgs')
+                pkgs = []
+            self._pypi_data_cache[name] = sorted(
+                pkgs, key=operator.attrgetter('version'), reverse=True)
+        return self._candidates(name, state, from_pypi=True)
+
+    async def _decide(
+            self, base: _ResolutionState, name: str, pkg: Package
+            ) -> Tuple[Optional[_ResolutionState], Optional[str]]:
+        state = base.copy()
+        state.decisions[name] = pkg
+        for req in await self._package_requirements(name, pkg):
+            dep = canonicalize_name(req.name)
+            state.constraints.setdefault(dep, []).append((req, pkg))
+            chosen = state.decisions.get(dep)
+            if chosen is not None and chosen.version not in req.specifier:
+                return (None, (
+                    f'{req} (from {pkg}) does not match already chosen '
+                    f'{dep}=={chosen.version}'))
+        return (state, None)
+
+    async def _package_requirements(
+            self, name: str, pkg: Package) -> List[Requirement]:
+        key = self._package_key(pkg)
+        try:
+            task = self._requirements[key]
+        except KeyError:
+            speculation = self._speculations.pop(key, None)
+            if speculation is not None and (
+                    key in self._started_speculations or speculation.done()):
+                # It is in the critical path now, so it shouldn't wait
+                # behind less urgent processes
+                priority = self._speculation_priorities.pop(key, None)
+                if priority is not None:
+                    priority.promote(PRIORITY_RESOLVE)
+                    self._speculation_budget.release()
+                task = speculation
+            else:
+                if speculation is not None:
+                    # Don't wait for a slot of the speculation budget
+                    speculation.cancel()
+                task = asyncio.ensure_future(self.evaluate_requirements(pkg))
+            self._requirements[key] = task
+        reqs: PackageRequirements = await asyncio.shield(task)
+
+        all_reqs = reqs.runtime_requirements + reqs.build_requirements
+        if not isinstance(pkg, NixPackage) and self.should_load_tests(name):
+            all_reqs = all_reqs + reqs.test_requirements
+
+        if isinstance(pkg, NixPackage):
+            # Needed by _ignored_by_nixpkgs
+            await self.nixpkgs_data.prepare(*(req.name for req in all_reqs))
+        result = []
+        for req in all_reqs:
+            if req.marker and not req.marker.evaluate():
+                continue
+            if isinstance(pkg, NixPackage) and self._ignored_by_nixpkgs(req):
+                print(f"warning: ignoring requirement {req} from {pkg} "
+                      f"because there is no matching version in nixpkgs "
+                      f"packages")
+                continue
+            result.append(req)
+        return result
+
+    def _package_key(self, pkg: Package) -> Tuple[str, str, str]:
+        return (type(pkg).__name__, pkg.attr, str(pkg.version))
+
+    def _speculate(self, state: _ResolutionState, undecided: List[str]):
+        wanted: Dict[Tuple[str, str, str], Package] = {}
+        for name in undecided:
+            candidates = self._candidates(name, state, from_pypi=False)
+            if not candidates and name in self._pypi_data_cache:
+                candidates = self._candidates(name, state, from_pypi=True)
+            if candidates:
+                wanted[self._package_key(candidates[0])] = candidates[0]
+
+        # Candidates that aren't the best ones anymore won't probably be
+        # needed
+        self._cancel_speculations(lambda key: key not in wanted)
+
+        for (key, pkg) in wanted.items():
+            if key in self._requirements or key in self._speculations:
+                continue
+            task = asyncio.ensure_future(
+                self._speculative_evaluation(key, pkg))
+            # Failed speculations are only reported if they were needed
+            task.add_done_callback(
+                lambda t: t.cancelled() or t.exception())
+            self._speculations[key] = task
+
+    async def _speculative_evaluation(
+            self, key: Tuple[str, str, str],
+            pkg: Package) -> PackageRequirements:
+        await self._speculation_budget.acquire(priority=PRIORITY_SPECULATIVE)
+        self._started_speculations.add(key)
+        # Only affects the processes spawned by this task
+        self._speculation_priorities[key] = set_priority(PRIORITY_SPECULATIVE)
+        try:
+            return await self.evaluate_requirements(pkg)
+        finally:
+            self._started_speculations.discard(key)
+            # Promoted speculations released their slot already
+            if self._speculation_priorities.pop(key, None) is not None:
+                self._speculation_budget.release()
+
+    def _cancel_speculations(
+            self, predicate: Callable[[Tuple[str, str, str]], bool]):
+        """Cancel the matching speculations that didn't start yet.
+
+        Started ones can't be stopped, since the evaluation they wait for
+        is shared with other callers and keeps running. They keep their
+        slot until it finishes, and stay available to be promoted.
+        """
+        for key in [k for k in self._speculations if predicate(k)]:
+            speculation = self._speculations[key]
+            if key in self._started_speculations or speculation.done():
+                continue
+            del self._speculations[key]
+            speculation.cancel()
+
+    def _ignored_by_nixpkgs(self, req: Requirement) -> bool:
+        # Same as in VersionChooser.require: nixpkgs patches some packages
+        # to disable requirements it can't satisfy
+        try:
+            return not self.nixpkgs_data.from_requirement(req)
+        except PackageNotFound:
+            return False
+
+
 async def evaluate_package_requirements(
         pkg: Package, extra_args=[]) -> PackageRequirements:
-    src = await pkg.source(extra_args)
-    return await eval_path_requirements(src)
+    with span('parse_requirements', package=str(pkg)):
+        data = await eval_package(pkg, extra_args)
+    # Return a copy because VersionChooser modifies it
+    return data.requirements.copy()
 
 
 @dataclass
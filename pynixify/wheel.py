@@ -0,0 +1,135 @@
+# pynixify - Nix expression generator for Python packages
+# Copyright (C) 2020 Matías Lang
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import io
+import struct
+import zipfile
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+# Layouts of the end of central directory record, the zip64 locator that
+# precedes it and the zip64 end of central directory record
+_EOCD = struct.Struct('<4s4H2LH')
+_ZIP64_LOCATOR = struct.Struct('<4sLQL')
+_ZIP64_EOCD = struct.Struct('<4sQ2H2L4Q')
+
+# The end of a zip file that contains the zip64 records and the end of
+# central directory record, with a comment of the maximum length
+ZIP_TAIL_SIZE = _ZIP64_EOCD.size + _ZIP64_LOCATOR.size + _EOCD.size + 2**16 - 1
+
+
+def metadata_member(names: List[str]) -> Optional[str]:
+    """Find the METADATA file in the list of files of a wheel."""
+    for name in names:
+        parts = name.split('/')
+        if (len(parts) == 2 and parts[0].endswith('.dist-info') and
+                parts[1] == 'METADATA'):
+            return name
+    return None
+
+
+def read_wheel_metadata(path: Path) -> Optional[str]:
+    with zipfile.ZipFile(path) as zf:
+        name = metadata_member(zf.namelist())
+        if name is None:
+            return None
+        return zf.read(name).decode()
+
+
+def central_directory_range(tail: bytes) -> Tuple[int, int]:
+    """Find the offset and size of the central directory of a zip file.
+
+    The tail must be the end of the file, at least ZIP_TAIL_SIZE bytes
+    long unless it is the whole file.
+    """
+    position = len(tail)
+    while True:
+        position = tail.rfind(b'PK\x05\x06', 0, position)
+        if position < 0:
+            raise zipfile.BadZipFile('End of central directory not found')
+        if len(tail) - position < _EOCD.size:
+            continue
+        (_, _, _, _, _, size, offset, comment_length) = _EOCD.unpack_from(
+            tail, position)
+        # The signature could also be part of the comment
+        if position + _EOCD.size + comment_length == len(tail):
+            break
+    locator = position - _ZIP64_LOCATOR.size
+    if locator < 0 or tail[locator:locator + 4] != b'PK\x06\x07':
+        return (offset, size)
+    # Like zipfile, assume the zip64 record is right before its locator
+    record = locator - _ZIP64_EOCD.size
+    if record < 0:
+        raise zipfile.BadZipFile('Zip64 end of central directory not found')
+    (signature, _, _, _, _, _, _, _, size, offset) = _ZIP64_EOCD.unpack_from(
+        tail, record)
+    if signature != b'PK\x06\x06':
+        raise zipfile.BadZipFile('Invalid zip64 end of central directory')
+    return (offset, size)
+
+
+class SparseFile(io.RawIOBase):
+    """Read-only file of which only some ranges are known.
+
+    It is used to open a remote wheel with zipfile after downloading only
+    its central directory and the members that will be read. Reading an
+    unknown range raises an OSError.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.position = 0
+        self.chunks: Dict[int, bytes] = {}
+
+    def add(self, offset: int, data: bytes):
+        self.chunks[offset] = data
+
+    def covers(self, offset: int, end: int) -> bool:
+        """Whether the range from offset to end can be read at once."""
+        return any(
+            start <= offset and end <= start + len(data)
+            for (start, data) in self.chunks.items()
+        )
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = offset
+        return offset
+
+    def read(self, size: Optional[int] = -1) -> bytes:
+        if size is None or size < 0:
+            size = self.size - self.position
+        size = min(size, self.size - self.position)
+        for (start, data) in self.chunks.items():
+            if start <= self.position and (
+                    self.position + size <= start + len(data)):
+                offset = self.position - start
+                self.position += size
+                return data[offset:offset + size]
+        raise OSError(f'Range {self.position}-{self.position + size} '
+                      f'was not downloaded')
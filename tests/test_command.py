@@ -0,0 +1,130 @@
+# pynixify - Nix expression generator for Python packages
+# Copyright (C) 2020 Matías Lang
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import io
+import sys
+import json
+import pytest
+from packaging.version import Version
+from pynixify import cache, command, trace
+from pynixify.command import _report_scheduler_stats, get_pypi_data
+from pynixify.lock import LOCK_FILENAME
+from pynixify.pypi_api import PyPIPackage
+from pynixify.scheduler import SubprocessScheduler
+
+SAMPLEPROJECT_URL = "https://files.pythonhosted.org/packages/6f/5b/2f3fe94e1c02816fe23c7ceee5292fb186912929e1972eee7fb729fa27af/sampleproject-1.3.1.tar.gz"
+SAMPLEPROJECT_HASH = '0m9cz3b07dq617kds4x23mdh6a7vf92b2i311pbpjwh53qpwm4rm'
+
+
+def sampleproject(download_url=SAMPLEPROJECT_URL, pypi_name='sampleproject'):
+    return PyPIPackage(
+        pypi_name=pypi_name,
+        version=Version('1.3.1'),
+        sha256='3593ca2f1e057279d70d6144b14472fb28035b1da213dde60906b703d6f82c55',
+        download_url=download_url,
+        pypi_cache=None,  # type: ignore
+    )
+
+
+@pytest.fixture
+def url_hashes(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, '_cache_dir', tmp_path)
+    monkeypatch.setattr(cache, '_database', None)
+    downloads = []
+    async def get_url_hash(url, unpack=True):
+        downloads.append(url)
+        return SAMPLEPROJECT_HASH
+    monkeypatch.setattr(command, 'get_url_hash', get_url_hash)
+    return downloads
+
+
+@pytest.mark.asyncio
+async def test_get_pypi_data_without_download(url_hashes):
+    (pname, ext) = await get_pypi_data(sampleproject(), SAMPLEPROJECT_HASH)
+    assert (pname, ext) == ('sampleproject', 'tar.gz')
+    assert url_hashes == []
+
+
+@pytest.mark.asyncio
+async def test_get_pypi_data_verify(url_hashes):
+    for _ in range(2):
+        (pname, ext) = await get_pypi_data(
+            sampleproject(), SAMPLEPROJECT_HASH, verify=True)
+        assert (pname, ext) == ('sampleproject', 'tar.gz')
+    assert url_hashes == [
+        'mirror://pypi/s/sampleproject/sampleproject-1.3.1.tar.gz'
+    ]
+
+
+@pytest.mark.asyncio
+async def test_get_pypi_data_not_hosted_by_pypi(url_hashes):
+    package = sampleproject('https://example.com/sampleproject-1.3.1.tar.gz')
+    with pytest.raises(RuntimeError):
+        await get_pypi_data(package, 'anotherhash')
+    assert len(url_hashes) == 1
+
+
+@pytest.mark.asyncio
+async def test_get_pypi_data_name_mismatch(url_hashes):
+    package = sampleproject(pypi_name='other')
+    await get_pypi_data(package, SAMPLEPROJECT_HASH)
+    assert len(url_hashes) == 1
+
+
+@pytest.mark.asyncio
+async def test_report_scheduler_stats(monkeypatch, capsys):
+    fp = io.StringIO()
+    monkeypatch.setattr(trace, '_tracer', trace.Tracer(fp))
+    scheduler = SubprocessScheduler({'unused': 1}, default_limit=1)
+    monkeypatch.setattr(command, 'scheduler', scheduler)
+    for _ in range(2):
+        await scheduler.run(sys.executable, '-c', 'pass')
+    _report_scheduler_stats()
+    (record,) = [json.loads(line) for line in fp.getvalue().splitlines()
+                 if json.loads(line)['name'] == 'scheduler-stats']
+    assert record['program'] == sys.executable
+    assert record['acquisitions'] == 2
+    assert f'{sys.executable}: 2 runs' in capsys.readouterr().err
+
+
+@pytest.mark.parametrize('args', [
+    ['flask'],
+    ['--nixpkgs', 'https://example.com/nixpkgs.tar.gz'],
+    ['--resolver', 'greedy'],
+])
+def test_from_lock_conflicts(monkeypatch, capsys, args):
+    monkeypatch.setattr(sys, 'argv', ['pynixify', '--from-lock', *args])
+    with pytest.raises(SystemExit):
+        command.main()
+    assert "--from-lock can't be used with" in capsys.readouterr().err
+
+
+@pytest.mark.parametrize('lock_contents', [
+    None,
+    '{"format_version": 0}',
+    'not json',
+])
+def test_from_lock_invalid_lock(tmp_path, monkeypatch, capsys,
+                                lock_contents):
+    if lock_contents is not None:
+        (tmp_path / 'pynixify').mkdir()
+        (tmp_path / 'pynixify' / LOCK_FILENAME).write_text(lock_contents)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, 'argv', ['pynixify', '--from-lock'])
+    with pytest.raises(SystemExit) as excinfo:
+        command.main()
+    assert str(excinfo.value).startswith('error: ')
+    assert LOCK_FILENAME in str(excinfo.value)
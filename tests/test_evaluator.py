@@ -0,0 +1,95 @@
+import sys
+import json
+import asyncio
+import pytest
+from pynixify.evaluator import (
+    EvaluatorPool,
+    query_source,
+    unescape_nix_string,
+)
+from pynixify.exceptions import NixBuildError
+
+# Answers like nix repl: each query prints a JSON string as a Nix string
+# literal, and errors are printed to stderr
+FAKE_REPL = r'''
+import os
+import sys
+import json
+for line in sys.stdin:
+    line = line.strip()
+    if line.startswith('"'):
+        print(line)
+    elif line.startswith('import '):
+        source = open(line.split()[1]).read()
+        if 'throw' in source:
+            print('error: thrown', file=sys.stderr)
+        else:
+            value = json.dumps({'pid': os.getpid(), 'text': '"${x}"'})
+            print('"' + value.replace('\\', '\\\\').replace('"', '\\"')
+                  .replace('${', '\\${') + '"')
+    sys.stdout.flush()
+'''
+
+
+def fake_pool(size: int) -> EvaluatorPool:
+    return EvaluatorPool(size, command=[sys.executable, '-c', FAKE_REPL])
+
+
+@pytest.mark.parametrize('literal,value', [
+    ('"test"', 'test'),
+    (r'"\""', '"'),
+    (r'"\\"', '\\'),
+    (r'"a\nb"', 'a\nb'),
+    (r'"\${x}"', '${x}'),
+])
+def test_unescape_nix_string(literal, value):
+    assert unescape_nix_string(literal) == value
+
+
+def test_unescape_invalid_string():
+    with pytest.raises(ValueError):
+        unescape_nix_string('1')
+
+
+def test_query_source():
+    source = query_source(
+        '{ a, pkgs }: a', attr='b.c', args={'a': '{ b.c = 1; }'})
+    assert 'a = ({ b.c = 1; });' in source
+    assert '[ "b" "c" ]' in source
+
+
+@pytest.mark.asyncio
+async def test_evaluator_pool():
+    pool = fake_pool(1)
+    try:
+        first = await pool.evaluate('1')
+        assert first['text'] == '"${x}"'
+        with pytest.raises(NixBuildError, match='thrown'):
+            await pool.evaluate('throw "x"')
+        # The worker is reused after a failed evaluation
+        assert (await pool.evaluate('1'))['pid'] == first['pid']
+    finally:
+        await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_evaluator_pool_size():
+    pool = fake_pool(2)
+    try:
+        results = await asyncio.gather(*(pool.evaluate('1') for _ in range(6)))
+        assert len({r['pid'] for r in results}) == 2
+    finally:
+        await pool.close()
+
+
+@pytest.mark.usesnix
+@pytest.mark.asyncio
+async def test_nix_repl_evaluator():
+    pool = EvaluatorPool(1)
+    try:
+        assert await pool.evaluate(
+            '{ a }: { b = a + 1; }', attr='b', args={'a': '1'}) == 2
+        assert isinstance(await pool.evaluate(
+            '{ pkgs }: pkgs.lib.version'), str)
+    finally:
+        await pool.close()
@@ -25,6 +25,7 @@ from packaging.requirements import Requirement
 from pynixify.base import PackageMetadata
 from pynixify.version_chooser import VersionChooser
 from pynixify.nixpkgs_sources import (
+    NixpkgsContext,
     NixpkgsData,
 )
 from pynixify.pypi_api import (
@@ -33,10 +34,13 @@ from pynixify.pypi_api import (
 )
 from pynixify.expression_builder import (
     build_nix_expression,
+    build_overlayed_nixpkgs,
     build_shell_nix_expression,
     escape_string,
-    nixfmt
+    nixfmt,
+    nixfmt_many,
 )
+from pynixify import expression_builder
 from .test_pypi_api import DummyCache, SAMPLEPROJECT_DATA
 from .test_version_chooser import (
     NIXPKGS_JSON,
@@ -51,6 +55,8 @@ DEFAULT_ARGS = {
     'lib': 'a: a',
 }
 
+NIXPKGS = NixpkgsContext(version='23.05')
+
 NO_REQUIREMENTS = ChosenPackageRequirements(
     build_requirements=[],
     test_requirements=[],
@@ -98,7 +104,7 @@ async def test_compiles(version_chooser):
         version_chooser.package_for('sampleproject'),
         NO_REQUIREMENTS,
         NO_METADATA,
-        nixpkgs_version="23.05",
+        nixpkgs=NIXPKGS,
         sha256='aaaaaa')
     assert await is_valid_nix(result), "Invalid Nix expression"
 
@@ -118,7 +124,7 @@ async def test_duplicate_parameter(version_chooser):
         version_chooser.package_for('sampleproject'),
         requirements,
         NO_METADATA,
-        nixpkgs_version="23.05",
+        nixpkgs=NIXPKGS,
         sha256='aaaaaa')
     assert await is_valid_nix(result), "Invalid Nix expression"
 
@@ -131,7 +137,7 @@ async def test_call(version_chooser):
         version_chooser.package_for('sampleproject'),
         NO_REQUIREMENTS,
         NO_METADATA,
-        nixpkgs_version="23.05",
+        nixpkgs=NIXPKGS,
         sha256='aaaaaa')
     assert await is_valid_nix(result, **DEFAULT_ARGS), "Invalid Nix expression"
 
@@ -156,6 +162,60 @@ async def test_nixfmt():
     expr = await nixfmt('{}: 1 + 1')
     assert await is_valid_nix(expr)
 
+@pytest.mark.usesnix
+@pytest.mark.asyncio
+async def test_nixfmt_many():
+    exprs = ['{}: 1 + 1', '{ a }:   a']
+    assert await nixfmt_many(exprs) == [await nixfmt(e) for e in exprs]
+
+
+@pytest.mark.asyncio
+async def test_nixfmt_many_fallback(monkeypatch):
+    calls = []
+    class Scheduler:
+        async def run(self, program, *args, **kwargs):
+            calls.append(args)
+            return (1, b'', b'')
+    async def nixfmt(expr):
+        if 'invalid' in expr:
+            raise TypeError('nixfmt failed')
+        return expr.upper()
+    monkeypatch.setattr(expression_builder, 'scheduler', Scheduler())
+    monkeypatch.setattr(expression_builder, 'nixfmt', nixfmt)
+    assert await nixfmt_many(['a', 'b']) == ['A', 'B']
+    assert len(calls) == 1 and len(calls[0]) == 2
+    with pytest.raises(TypeError):
+        await nixfmt_many(['a', 'invalid'])
+
+
+@pytest.mark.asyncio
+async def test_nixfmt_prints_errors(monkeypatch, capsys):
+    class Scheduler:
+        async def run(self, program, *args, **kwargs):
+            return (1, b'', b'unexpected end of input')
+    monkeypatch.setattr(expression_builder, 'scheduler', Scheduler())
+    with pytest.raises(TypeError):
+        await nixfmt('{')
+    assert 'unexpected end of input' in capsys.readouterr().err
+
+
+
+def test_overlayed_nixpkgs_interpreters():
+    nixpkgs = NixpkgsContext(version='23.05', interpreters=('python3',))
+    expr = build_overlayed_nixpkgs({'a': Path('packages/a/default.nix')}, nixpkgs)
+    assert 'python3 = super.python3.override' in expr
+    assert 'python2' not in expr
+    assert '<nixpkgs>' in expr
+
+
+def test_overlayed_nixpkgs_pinned():
+    nixpkgs = NixpkgsContext(
+        version='23.05', url='https://example.com/nixpkgs.tar.gz',
+        sha256='abc')
+    expr = build_overlayed_nixpkgs({}, nixpkgs)
+    assert '"https://example.com/nixpkgs.tar.gz"' in expr
+    assert '<nixpkgs>' not in expr
+
 @pytest.mark.usesnix
 @pytest.mark.asyncio
 async def test_metadata(version_chooser):
@@ -165,7 +225,7 @@ async def test_metadata(version_chooser):
         version_chooser.package_for('sampleproject'),
         NO_REQUIREMENTS,
         sha256='aaaaaa',
-        nixpkgs_version="23.05",
+        nixpkgs=NIXPKGS,
         metadata=PackageMetadata(
             description=desc,
             url=None,
@@ -0,0 +1,94 @@
+# pynixify - Nix expression generator for Python packages
+# Copyright (C) 2020 Matías Lang
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import pytest
+from pynixify.base import PackageMetadata
+from pynixify.nixpkgs_sources import NixPackage, PYTHON_INTERPRETERS
+from pynixify.pypi_api import PyPIPackage
+from pynixify.lock import Lock, LockedPackage, LOCK_FILENAME
+
+
+def sample_lock() -> Lock:
+    return Lock(
+        nixpkgs_version='20.03',
+        requirements=['sampleproject'],
+        packages={
+            'sampleproject': LockedPackage(
+                origin='pypi',
+                attr='sampleproject',
+                version='1.3.1',
+                download_url='https://files.pythonhosted.org/sampleproject-1.3.1.tar.gz',
+                sha256='eb00f1b6a9d1ea6e1e7c1c1ee4e4c9c8bd0d8bc2a4ff8a6bb5d8ee1e7a4d1b0e',
+                nix_sha256='0m9cz3b07dq617kds4x23mdh6a7vf92b2i311pbpjwh53qpwm4rm',
+                fetch_pypi=['sampleproject', 'tar.gz'],
+                metadata={'description': 'A sample project',
+                          'license': 'MIT', 'url': None},
+                runtime_requirements=['peppercorn'],
+            ),
+            'peppercorn': LockedPackage(
+                origin='nixpkgs',
+                attr='peppercorn',
+                version='0.6',
+            ),
+        },
+    )
+
+
+def test_roundtrip(tmp_path):
+    lock = sample_lock()
+    lock.save(tmp_path / LOCK_FILENAME)
+    assert Lock.load(tmp_path / LOCK_FILENAME) == lock
+
+
+def test_package(tmp_path):
+    lock = sample_lock()
+    package = lock.package('sampleproject')
+    assert isinstance(package, PyPIPackage)
+    assert package.attr == 'sampleproject'
+    assert str(package.version) == '1.3.1'
+    assert package.local_source is None
+    dependency = lock.package('peppercorn')
+    assert isinstance(dependency, NixPackage)
+    assert dependency.attr == 'peppercorn'
+    assert lock.metadata('sampleproject') == PackageMetadata(
+        description='A sample project', license='MIT', url=None)
+
+
+def test_nixpkgs_context():
+    lock = sample_lock()
+    assert lock.nixpkgs_context().version == '20.03'
+    # Locks without interpreters use all of them
+    assert lock.nixpkgs_context().interpreters == PYTHON_INTERPRETERS
+    lock.nixpkgs_interpreters = ['python3']
+    assert lock.nixpkgs_context().interpreters == ('python3',)
+
+
+@pytest.mark.asyncio
+async def test_locked_packages_are_not_fetched():
+    package = sample_lock().package('sampleproject')
+    assert isinstance(package, PyPIPackage)
+    with pytest.raises(RuntimeError):
+        await package.source()
+
+
+def test_unsupported_format_version(tmp_path):
+    sample_lock().save(tmp_path / LOCK_FILENAME)
+    data = json.loads((tmp_path / LOCK_FILENAME).read_text())
+    data['format_version'] = 1000
+    (tmp_path / LOCK_FILENAME).write_text(json.dumps(data))
+    with pytest.raises(ValueError):
+        Lock.load(tmp_path / LOCK_FILENAME)
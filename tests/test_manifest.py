@@ -0,0 +1,54 @@
+# pynixify - Nix expression generator for Python packages
+# Copyright (C) 2020 Matías Lang
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from pathlib import Path
+from pynixify.manifest import Manifest
+
+
+def test_fresh_file(tmp_path):
+    path = tmp_path / 'packages' / 'a' / 'default.nix'
+    path.parent.mkdir(parents=True)
+    path.write_text('{}: {}')
+    manifest = Manifest.load(tmp_path)
+    assert not manifest.is_fresh(path, {'version': '1.0'})
+    manifest.record(path, {'version': '1.0'})
+    manifest.save()
+
+    manifest = Manifest.load(tmp_path)
+    assert manifest.is_fresh(path, {'version': '1.0'})
+    assert not manifest.is_fresh(path, {'version': '2.0'})
+
+    path.unlink()
+    assert not Manifest.load(tmp_path).is_fresh(path, {'version': '1.0'})
+
+
+def test_only_keeps_current_files(tmp_path):
+    (tmp_path / 'a.nix').write_text('')
+    (tmp_path / 'b.nix').write_text('')
+    manifest = Manifest.load(tmp_path)
+    manifest.record(tmp_path / 'a.nix', 1)
+    manifest.record(tmp_path / 'b.nix', 1)
+    manifest.save()
+
+    manifest = Manifest.load(tmp_path)
+    assert manifest.is_fresh(tmp_path / 'a.nix', 1)
+    manifest.save()
+    assert Manifest.load(tmp_path).previous_files.keys() == {'a.nix'}
+
+
+def test_invalid_manifest(tmp_path):
+    (tmp_path / Manifest.FILENAME).write_text('{')
+    assert not Manifest.load(tmp_path).is_fresh(tmp_path / 'a.nix', 1)
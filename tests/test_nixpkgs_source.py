@@ -14,13 +14,23 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import re
+import json
+import asyncio
 import pytest
+from pathlib import Path
 from packaging.requirements import Requirement
 from packaging.version import Version, parse
-from pynixify.exceptions import PackageNotFound
+from pynixify.exceptions import PackageNotFound, NixBuildError
+from pynixify import cache, nixpkgs_sources
 from pynixify.nixpkgs_sources import (
+    JSONObjectStream,
+    LazyNixpkgsData,
+    NixpkgsContext,
     NixpkgsData,
     NixPackage,
+    load_nixpkgs_context,
+    load_nixpkgs_data,
 )
 
 
@@ -113,3 +123,309 @@ def test_from_requirement():
     assert len(drvs) == 1
     assert drvs[0].attr == 'a3'
     assert drvs[0].version == parse('3.0.0')
+
+
+
+def test_from_pypi_name_sorted():
+    repo = NixpkgsData(MULTIVERSION_DATA)
+    assert [drv.attr for drv in repo.from_pypi_name('a')] == [
+        'a1', 'a2', 'a3']
+
+
+@pytest.mark.parametrize('specifier,attrs', [
+    ('==2.3', ['a2']),
+    ('==2.3.0', ['a2']),
+    ('==3', ['a3']),
+    ('==2.*', ['a2']),
+    ('==2.5', []),
+    ('>1.0.1,<4', ['a2', 'a3']),
+    ('', ['a1', 'a2', 'a3']),
+])
+def test_from_requirement_specifiers(specifier, attrs):
+    repo = NixpkgsData(MULTIVERSION_DATA)
+    for _ in range(2):  # The second lookup is memoized
+        drvs = repo.from_requirement(Requirement(f'a{specifier}'))
+        assert [drv.attr for drv in drvs] == attrs
+
+
+def test_from_requirement_returns_new_packages():
+    repo = NixpkgsData(MULTIVERSION_DATA)
+    (first,) = repo.from_requirement(Requirement('a==3'))
+    first.version = parse('4.0')
+    (second,) = repo.from_requirement(Requirement('a==3'))
+    assert second.version == parse('3.0.0')
+
+
+def test_invalid_versions_are_ignored():
+    repo = NixpkgsData({'a': [
+        {"attr": "a", "pypiName": "a", "version": "1.7.7-SNAPSHOT"},
+        {"attr": "a2", "pypiName": "a", "version": "2.0"},
+    ]})
+    assert [drv.attr for drv in repo.from_pypi_name('a')] == ['a2']
+
+@pytest.mark.asyncio
+async def test_load_nixpkgs_data_from_cache(tmp_path, monkeypatch):
+    async def find_nixpkgs_path():
+        return Path('/nix/store/00000000000000000000000000000000-nixpkgs')
+    monkeypatch.setattr(nixpkgs_sources, 'find_nixpkgs_path', find_nixpkgs_path)
+    monkeypatch.setattr(cache, '_cache_dir', tmp_path)
+
+    nix_expression_path = (
+        Path(nixpkgs_sources.__file__).parent / "data" / "pythonPackages.nix")
+    cache_path = await nixpkgs_sources._nixpkgs_data_cache_path(
+        nix_expression_path, [])
+    assert cache_path is not None
+    cache.write_json(cache_path, {'zstd': [['zstd', '1.4.4.0']]})
+
+    # nix-instantiate isn't called because the cache is warm
+    repo = NixpkgsData(await load_nixpkgs_data([]))
+    drvs = repo.from_pypi_name('zstd')
+    assert drvs[0].attr == 'zstd'
+    assert drvs[0].version == parse('1.4.4.0')
+
+
+
+def test_json_object_stream():
+    data = {
+        'zstd': [{'attr': 'zstd', 'version': '1.4.4.0', 'src': None}],
+        'ünicode': [{'attr': 'a', 'version': '1'}, {'attr': 'b', 'version': '2'}],
+        'empty': [],
+    }
+    encoded = json.dumps(data, indent=1, ensure_ascii=False).encode()
+    stream = JSONObjectStream()
+    items = []
+    for i in range(len(encoded)):
+        items += stream.feed(encoded[i:i+1])
+    stream.close()
+    assert dict(items) == data
+
+    stream = JSONObjectStream()
+    stream.feed(encoded[:-5])
+    with pytest.raises(ValueError):
+        stream.close()
+
+
+@pytest.mark.asyncio
+async def test_load_nixpkgs_data_streaming(monkeypatch):
+    monkeypatch.setattr(cache, '_cache_dir', None)
+    output = json.dumps({
+        'zstd': [{'attr': 'zstd', 'pypiName': 'zstd',
+                  'src': 'mirror://pypi/z/zstd/zstd-1.4.4.0.tar.gz',
+                  'version': '1.4.4.0'}],
+    }).encode()
+
+    class Scheduler:
+        async def run_streaming(self, program, *args, on_stdout, weight):
+            for i in range(0, len(output), 10):
+                on_stdout(output[i:i+10])
+            return (0, b'')
+
+    monkeypatch.setattr(nixpkgs_sources, 'scheduler', Scheduler())
+    data = await load_nixpkgs_data([])
+    assert data == {'zstd': [{'attr': 'zstd', 'version': '1.4.4.0'}]}
+
+
+def fake_lookup_scheduler(packages):
+    """Simulate nix-instantiate evaluating lookupPythonPackages.nix."""
+    calls = []
+
+    class Scheduler:
+        async def run(self, program, *args):
+            attrs = re.findall(r'"([^"]+)"', args[-1])
+            calls.append(attrs)
+            return (0, json.dumps([packages.get(a) for a in attrs]).encode(),
+                    b'')
+
+    return (calls, Scheduler())
+
+
+@pytest.mark.asyncio
+async def test_lazy_nixpkgs_data(monkeypatch):
+    (calls, scheduler) = fake_lookup_scheduler({
+        'pytest-runner': {'attr': 'pytest-runner', 'version': '5.1',
+                          'src': 'mirror://pypi/p/pytest-runner/x.tar.gz'},
+        'pyyaml': {'attr': 'pyyaml', 'version': '5.3',
+                   'src': 'mirror://pypi/P/PyYAML/PyYAML-5.3.tar.gz'},
+        # Its source isn't from PyPI, so the attr is used as PyPI name
+        'zstd': {'attr': 'zstd', 'version': '1.4.4.0', 'src': None},
+        # An attr that happens to have the same name of another package
+        'other': {'attr': 'other', 'version': '1.0',
+                  'src': 'mirror://pypi/s/something/something-1.0.tar.gz'},
+    })
+    monkeypatch.setattr(nixpkgs_sources, 'scheduler', scheduler)
+    repo = LazyNixpkgsData(window=0.01)
+
+    await asyncio.gather(
+        repo.prepare('pytest_runner'),
+        repo.prepare('PyYAML', 'zstd'),
+        repo.prepare('other', 'missing'),
+    )
+    assert len(calls) == 1
+    assert 'pytest_runner' in calls[0]
+    (drv,) = repo.from_requirement(Requirement('pytest-runner>=5'))
+    assert drv.attr == 'pytest-runner'
+    assert repo.from_pypi_name('pyyaml')[0].version == parse('5.3')
+    assert repo.from_pypi_name('zstd')[0].attr == 'zstd'
+    with pytest.raises(PackageNotFound):
+        repo.from_pypi_name('other')
+    with pytest.raises(PackageNotFound):
+        repo.from_pypi_name('missing')
+
+    # Already prepared packages aren't evaluated again
+    await repo.prepare('zstd')
+    assert len(calls) == 1
+    with pytest.raises(AssertionError):
+        repo.from_pypi_name('not-prepared')
+
+@pytest.mark.usesnix
+@pytest.mark.asyncio
+async def test_lookup_python_packages_broken_attr():
+    from pynixify.pypi_api import nix_instantiate
+    path = Path(nixpkgs_sources.__file__).parent / 'data' / \
+        'lookupPythonPackages.nix'
+    fake_pkgs = """{ python3Packages = {
+        good = {
+          version = "1.0";
+          src.urls = [ "mirror://pypi/g/good/good-1.0.tar.gz" ];
+        };
+        broken = { version = throw "broken"; };
+        alias = throw "renamed";
+    }; }"""
+    result = await nix_instantiate(
+        f'import {path}', attrs='[ "good" "broken" "alias" "missing" ]',
+        pkgs=fake_pkgs)
+    assert result == [
+        {'attr': 'good', 'version': '1.0',
+         'src': 'mirror://pypi/g/good/good-1.0.tar.gz'},
+        None, None, None,
+    ]
+
+
+def fake_nix_build(tmp_path, broken=()):
+    """Simulate nix-build, recording which sources were built together."""
+    builds = []
+
+    async def run_nix_build(*args):
+        expr = args[-1]
+        attrs = re.findall(r'python3Packages\."([^"]+)"', expr)
+        builds.append(attrs)
+        if any(attr in broken for attr in attrs):
+            raise NixBuildError('nix-build failed with code 1')
+        if 'linkFarm' not in expr:
+            return tmp_path / f'{attrs[0]}-src'
+        out = tmp_path / f'sources-{len(builds)}'
+        out.mkdir()
+        for (i, attr) in enumerate(attrs):
+            (out / str(i)).symlink_to(tmp_path / f'{attr}-src')
+        return out
+
+    return (builds, run_nix_build)
+
+
+@pytest.mark.asyncio
+async def test_batched_sources(tmp_path, monkeypatch):
+    (builds, run_nix_build) = fake_nix_build(tmp_path)
+    monkeypatch.setattr(nixpkgs_sources, 'run_nix_build', run_nix_build)
+    packages = [
+        NixPackage(attr=attr, version=parse('1.0'))
+        for attr in ['b', 'a', 'c', 'a']
+    ]
+    sources = await asyncio.gather(*(p.source() for p in packages))
+    assert sources == [tmp_path / f'{p.attr}-src' for p in packages]
+    assert builds == [['a', 'b', 'c']]
+
+
+@pytest.mark.asyncio
+async def test_batched_sources_with_failure(tmp_path, monkeypatch):
+    (builds, run_nix_build) = fake_nix_build(tmp_path, broken=['b'])
+    monkeypatch.setattr(nixpkgs_sources, 'run_nix_build', run_nix_build)
+    results = await asyncio.gather(
+        NixPackage(attr='a', version=parse('1.0')).source(),
+        NixPackage(attr='b', version=parse('1.0')).source(),
+        return_exceptions=True,
+    )
+    assert results[0] == tmp_path / 'a-src'
+    assert isinstance(results[1], NixBuildError)
+    assert builds == [['a', 'b'], ['a'], ['b']]
+
+
+def test_batcher_survives_closed_loop(tmp_path, monkeypatch):
+    (builds, run_nix_build) = fake_nix_build(tmp_path)
+    monkeypatch.setattr(nixpkgs_sources, 'run_nix_build', run_nix_build)
+    batcher = nixpkgs_sources.Batcher(
+        nixpkgs_sources._realise_batch, window=0.01)
+
+    async def source(attr: str) -> Path:
+        return await batcher.get(attr)
+
+    # The loop is closed before the batch is flushed
+    loop = asyncio.new_event_loop()
+    waiting = loop.create_task(source('a'))
+    loop.run_until_complete(asyncio.sleep(0))
+    loop.close()
+    assert not waiting.done()
+    assert batcher._flush_task is not None
+    for task in (waiting, batcher._flush_task):
+        # Don't warn about them when they are garbage collected
+        task._log_destroy_pending = False  # type: ignore
+
+    async def cancelled():
+        waiting = asyncio.ensure_future(source('a'))
+        await asyncio.sleep(0)
+        assert batcher._flush_task is not None
+        batcher._flush_task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await asyncio.wait_for(waiting, 1)
+
+    asyncio.run(cancelled())
+    path = asyncio.run(asyncio.wait_for(source('b'), 1))
+    assert path == tmp_path / 'b-src'
+    assert builds == [['b']]
+
+
+def test_lazy_nixpkgs_data_survives_cancellation(monkeypatch):
+    (calls, scheduler) = fake_lookup_scheduler({
+        'zstd': {'attr': 'zstd', 'version': '1.4.4.0', 'src': None},
+    })
+    monkeypatch.setattr(nixpkgs_sources, 'scheduler', scheduler)
+    repo = LazyNixpkgsData(window=0.01)
+
+    async def cancelled():
+        waiting = asyncio.ensure_future(repo.prepare('zstd'))
+        await asyncio.sleep(0)
+        assert repo._batcher._flush_task is not None
+        repo._batcher._flush_task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await asyncio.wait_for(waiting, 1)
+
+    asyncio.run(cancelled())
+    asyncio.run(asyncio.wait_for(repo.prepare('zstd'), 1))
+    assert repo.from_pypi_name('zstd')[0].attr == 'zstd'
+    assert len(calls) == 1
+
+
+def test_is_old_nixpkgs():
+    assert NixpkgsContext(version='22.11.4').is_old_nixpkgs
+    assert not NixpkgsContext(version='23.05').is_old_nixpkgs
+
+
+@pytest.mark.asyncio
+async def test_load_nixpkgs_context(monkeypatch):
+    calls = []
+
+    class Scheduler:
+        async def run(self, program, *args):
+            calls.append(args)
+            return (0, json.dumps({
+                'version': '23.05',
+                'interpreters': ['python3', 'python39'],
+            }).encode(), b'')
+
+    monkeypatch.setattr(nixpkgs_sources, 'scheduler', Scheduler())
+    monkeypatch.setattr(nixpkgs_sources, '_nixpkgs_url', 'https://x/y.tar.gz')
+    context = await load_nixpkgs_context('abc')
+    assert context == NixpkgsContext(
+        version='23.05', url='https://x/y.tar.gz', sha256='abc',
+        interpreters=('python3', 'python39'))
+    ((*_, flag, nix_path),) = calls
+    assert (flag, nix_path) == ('-I', 'nixpkgs=https://x/y.tar.gz')
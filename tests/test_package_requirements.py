@@ -14,22 +14,179 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import asyncio
+import zipfile
 import pytest
 from pathlib import Path
 from typing import Sequence
 from packaging.requirements import Requirement
-from pynixify.package_requirements import PackageRequirements
+from packaging.version import Version
+from pynixify import cache, package_requirements
+from pynixify.pypi_api import PyPIPackage
+from .test_pypi_api import DummyCache
+from pynixify.package_requirements import (
+    PackageRequirements,
+    SourceData,
+    eval_package,
+    eval_path,
+    eval_path_requirements,
+)
+
+RESULT_PATH = Path(__file__).parent / "parse_setuppy_data_result"
+
+WHEEL_METADATA = """\
+Metadata-Version: 2.1
+Name: sampleproject
+Version: 2.0.0
+Summary: A sample Python project
+License: MIT
+Project-URL: Homepage, https://github.com/pypa/sampleproject
+Requires-Dist: peppercorn
+Requires-Dist: importlib-metadata ; python_version < "3.0"
+Requires-Dist: check-manifest ; extra == 'dev'
+Requires-Dist: coverage[toml] ; extra == 'test'
+
+A sample project.
+"""
+
+
+def make_wheel(path: Path, metadata: str = WHEEL_METADATA) -> Path:
+    with zipfile.ZipFile(path, 'w') as zf:
+        zf.writestr('sample/__init__.py', '')
+        zf.writestr('sampleproject-2.0.0.dist-info/METADATA', metadata)
+    return path
+
+
+def has_requirement(r: str, l: Sequence[Requirement]):
+    return any(str(e) == r for e in l)
+
 
 @pytest.mark.asyncio
 async def test_package_requirements():
-    reqs = PackageRequirements.from_result_path(
-        Path(__file__).parent / "parse_setuppy_data_result")
-
-    def has_requirement(r: str, l: Sequence[Requirement]):
-        return any(str(e) == r for e in l)
+    reqs = PackageRequirements.from_result_path(RESULT_PATH)
 
     assert has_requirement('pytest', reqs.test_requirements)
     assert not has_requirement('pytest', reqs.runtime_requirements)
     assert has_requirement('setuptools_scm', reqs.build_requirements)
     assert has_requirement('Click>=6.0', reqs.runtime_requirements)
 
+
+
+@pytest.mark.asyncio
+async def test_eval_path_is_memoized(tmp_path, monkeypatch):
+    builds = []
+    async def run_nix_build(*args):
+        builds.append(args)
+        await asyncio.sleep(0.01)
+        return RESULT_PATH
+    monkeypatch.setattr(package_requirements, 'run_nix_build', run_nix_build)
+    monkeypatch.setattr(package_requirements, '_evaluations', {})
+
+    package = PyPIPackage(
+        pypi_name='test',
+        download_url='',
+        sha256='',
+        version=Version('0.1dev'),
+        pypi_cache=None,  # type: ignore
+        local_source=tmp_path,
+    )
+    (reqs, other_reqs, meta) = await asyncio.gather(
+        eval_path_requirements(tmp_path),
+        eval_path_requirements(tmp_path),
+        package.metadata(),
+    )
+    assert len(builds) == 1
+    assert meta.description == 'test'
+    assert meta.url == 'https://test.com'
+    assert reqs == other_reqs
+    assert reqs is not other_reqs
+    assert (await eval_path(tmp_path)).metadata is meta
+    assert len(builds) == 1
+
+
+@pytest.mark.asyncio
+async def test_eval_package_persisted(tmp_path, monkeypatch):
+    builds = []
+    async def run_nix_build(*args):
+        builds.append(args)
+        return RESULT_PATH
+    monkeypatch.setattr(package_requirements, 'run_nix_build', run_nix_build)
+    monkeypatch.setattr(package_requirements, '_evaluations', {})
+
+    sources = []
+    class Package(PyPIPackage):
+        async def source(self, extra_args=[]):
+            sources.append(self)
+            return tmp_path
+
+    package = Package(
+        pypi_name='test',
+        download_url='https://example.com/test-1.0.tar.gz',
+        sha256='3593ca2f1e057279d70d6144b14472fb28035b1da213dde60906b703d6f82c55',
+        version=Version('1.0'),
+        pypi_cache=None,  # type: ignore
+    )
+    data: SourceData = await eval_package(package)
+    assert (len(sources), len(builds)) == (1, 1)
+
+    # Simulate a new run, which only has the persistent cache
+    monkeypatch.setattr(package_requirements, '_evaluations', {})
+    monkeypatch.setattr(cache, '_database', None)
+    assert await eval_package(package) == data
+    assert (len(sources), len(builds)) == (1, 1)
+    assert has_requirement('Click>=6.0', data.requirements.runtime_requirements)
+
+
+def test_wheel_metadata():
+    data = SourceData.from_wheel_metadata(WHEEL_METADATA)
+    reqs = data.requirements
+    assert reqs.build_requirements == []
+    assert has_requirement('peppercorn', reqs.runtime_requirements)
+    assert has_requirement('importlib-metadata; python_version < "3.0"',
+                           reqs.runtime_requirements)
+    assert not has_requirement('check-manifest', reqs.test_requirements)
+    assert has_requirement('coverage[toml]', reqs.test_requirements)
+    assert data.metadata.description == 'A sample Python project'
+    assert data.metadata.license == 'MIT'
+    assert data.metadata.url == 'https://github.com/pypa/sampleproject'
+    assert data.version == '2.0.0'
+
+
+@pytest.mark.asyncio
+async def test_eval_wheel_without_build(tmp_path, monkeypatch):
+    async def run_nix_build(*args):
+        raise AssertionError('wheels must not be built')
+    monkeypatch.setattr(package_requirements, 'run_nix_build', run_nix_build)
+    monkeypatch.setattr(package_requirements, '_evaluations', {})
+    monkeypatch.setattr(cache, '_cache_dir', None)
+    monkeypatch.setattr(cache, '_database', None)
+
+    wheel = make_wheel(tmp_path / 'sampleproject-2.0.0-py3-none-any.whl')
+    reqs = await eval_path_requirements(wheel)
+    assert has_requirement('peppercorn', reqs.runtime_requirements)
+
+
+@pytest.mark.asyncio
+async def test_eval_package_uses_wheel_metadata(monkeypatch):
+    monkeypatch.setattr(cache, '_cache_dir', None)
+    monkeypatch.setattr(cache, '_database', None)
+
+    class Package(PyPIPackage):
+        async def source(self, extra_args=[]):
+            raise AssertionError('the sdist must not be fetched')
+
+    class Cache(DummyCache):
+        async def fetch_wheel_metadata(self, url):
+            return WHEEL_METADATA
+
+    package = Package(
+        pypi_name='sampleproject',
+        download_url='https://example.com/sampleproject-2.0.0.tar.gz',
+        sha256='',
+        version=Version('2.0.0'),
+        pypi_cache=Cache(),
+        wheel_url='https://example.com/sampleproject-2.0.0-py3-none-any.whl',
+    )
+    data = await eval_package(package)
+    assert has_requirement('peppercorn', data.requirements.runtime_requirements)
+    assert (await package.metadata()).license == 'MIT'
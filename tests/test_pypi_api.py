@@ -14,9 +14,15 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import io
+import os
 import json
+import asyncio
+import zipfile
 import pytest
 from pathlib import Path
+from aiohttp import web
+from aiohttp.test_utils import TestServer
 from packaging.requirements import Requirement
 from packaging.utils import canonicalize_name
 from packaging.version import Version
@@ -29,8 +35,14 @@ from pynixify.pypi_api import (
     PyPICache,
     PyPIData,
     PyPIPackage,
+    file_sha256,
+    get_package_hash,
     get_path_hash,
+    nix_base32,
 )
+from pynixify import cache, pypi_api, trace
+from pynixify.trace import ChromeTracer
+from pynixify.wheel import ZIP_TAIL_SIZE, central_directory_range
 
 class DummyCache(ABCPyPICache):
     def __init__(self, **hardcoded_data):
@@ -78,6 +90,40 @@ async def test_invalid_package():
     with pytest.raises(PackageNotFound):
         await data.from_requirement(Requirement('xxx==1.3.1'))
 
+@pytest.mark.asyncio
+async def test_releases_are_parsed_once():
+    fetched = []
+    class Cache(DummyCache):
+        async def fetch(self, package):
+            fetched.append(package)
+            await asyncio.sleep(0.01)
+            return await super().fetch(package)
+
+    data = PyPIData(Cache(sampleproject=SAMPLEPROJECT_DATA))
+    (old, new, all_) = await asyncio.gather(
+        data.from_requirement(Requirement('sampleproject<1.3')),
+        data.from_requirement(Requirement('SampleProject>=1.3')),
+        data.from_requirement(Requirement('sampleproject')),
+    )
+    assert fetched == ['sampleproject']
+    assert len(old) + len(new) == len(all_)
+    versions = [p.version for p in all_]
+    assert versions == sorted(versions)
+    # Each call returns its own packages, since they are mutable
+    assert (await data.from_requirement(Requirement('sampleproject')))[0] \
+        is not all_[0]
+
+
+@pytest.mark.asyncio
+async def test_invalid_release_versions_are_ignored():
+    response = dict(SAMPLEPROJECT_DATA, releases={
+        'not-a-version': SAMPLEPROJECT_DATA['releases']['1.3.1'],
+        '1.3.1': SAMPLEPROJECT_DATA['releases']['1.3.1'],
+    })
+    data = PyPIData(DummyCache(sampleproject=response))
+    drvs = await data.from_requirement(Requirement('sampleproject'))
+    assert [str(drv.version) for drv in drvs] == ['1.3.1']
+
 @pytest.mark.asyncio
 async def test_fetch_blob():
     class Cache(DummyCache):
@@ -111,6 +157,18 @@ async def test_fetch_blob_fails():
         await p.source()
 
 
+@pytest.mark.asyncio
+async def test_store_paths_are_hashed_once(tmp_path, monkeypatch):
+    monkeypatch.setattr(pypi_api, 'is_store_path', lambda _: True)
+    path = tmp_path / 'random_file'
+    path.write_bytes((Path(__file__).parent / "random_file").read_bytes())
+    sha256 = 'f85f8edc8a1d510cba1e844048dc4750684f271e3b915fa3684ef9136405b229'
+    assert await file_sha256(path) == sha256
+    # Store paths are immutable, so its hash must not be computed again
+    path.write_bytes(b'')
+    assert await file_sha256(path) == sha256
+
+
 def test_package_filename():
     p = PyPIPackage(
         pypi_name='sampleproject',
@@ -130,6 +188,27 @@ async def test_get_path_hash():
     assert hash_ == '0adj0mj17yafd2imz49v3qklys2h8zf4hh443sx0ql8xibf8wpzq'
 
 
+def test_nix_base32():
+    sha256 = 'f85f8edc8a1d510cba1e844048dc4750684f271e3b915fa3684ef9136405b229'  # sha256sum of random_file
+    assert nix_base32(bytes.fromhex(sha256)) == (
+        '0adj0mj17yafd2imz49v3qklys2h8zf4hh443sx0ql8xibf8wpzq')
+    assert nix_base32(b'') == ''
+    assert nix_base32(b'\xff') == '7z'
+
+
+@pytest.mark.asyncio
+async def test_get_package_hash():
+    p = PyPIPackage(
+        pypi_name='sampleproject',
+        version=Version("1.3.1"),
+        sha256='f85f8edc8a1d510cba1e844048dc4750684f271e3b915fa3684ef9136405b229',
+        download_url='http://mockme',
+        pypi_cache=None,  # type: ignore
+    )
+    hash_ = await get_package_hash(p)
+    assert hash_ == '0adj0mj17yafd2imz49v3qklys2h8zf4hh443sx0ql8xibf8wpzq'
+
+
 @pytest.mark.skip(reason='unknown failure')
 @pytest.mark.usesnix
 @pytest.mark.asyncio
@@ -140,3 +219,280 @@ async def test_content_addressable_pypi_cache():
         'http://ignoreme.com/random_file', sha256)
     assert path == Path('/nix/store/678nlplmwnm46ian5jh0yb3q7y7hj9vr-random_file')
     assert path.exists()
+
+
+class FakePyPI:
+    def __init__(self, **packages):
+        self.packages = packages
+        self.requests = []
+
+    async def handle(self, request):
+        name = request.match_info['name']
+        self.requests.append((name, request.headers.get('If-None-Match')))
+        try:
+            data = self.packages[name]
+        except KeyError:
+            raise web.HTTPNotFound()
+        etag = f'"{name}-{data["info"]["version"]}"'
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304)
+        return web.json_response(data, headers={'ETag': etag})
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_get('/pypi/{name}/json', self.handle)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        return str(self.server.make_url('/pypi'))
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.server.close()
+
+
+@pytest.mark.asyncio
+async def test_pypi_cache_reuses_fresh_responses(tmp_path):
+    fake_pypi = FakePyPI(sampleproject=SAMPLEPROJECT_DATA)
+    async with fake_pypi as index_url:
+        cache = PyPICache(cache_dir=tmp_path, index_url=index_url)
+        assert await cache.fetch('sampleproject') == SAMPLEPROJECT_DATA
+        assert await cache.fetch('sampleproject') == SAMPLEPROJECT_DATA
+        # A new instance simulates another pynixify run
+        cache = PyPICache(cache_dir=tmp_path, index_url=index_url)
+        assert await cache.fetch('sampleproject') == SAMPLEPROJECT_DATA
+    assert fake_pypi.requests == [('sampleproject', None)]
+
+
+@pytest.mark.asyncio
+async def test_pypi_cache_revalidates_stale_responses(tmp_path):
+    fake_pypi = FakePyPI(sampleproject=SAMPLEPROJECT_DATA)
+    async with fake_pypi as index_url:
+        cache = PyPICache(cache_dir=tmp_path, ttl=0, index_url=index_url)
+        await cache.fetch('sampleproject')
+        assert await cache.fetch('sampleproject') == SAMPLEPROJECT_DATA
+    etag = f'"sampleproject-{SAMPLEPROJECT_DATA["info"]["version"]}"'
+    assert fake_pypi.requests == [
+        ('sampleproject', None),
+        ('sampleproject', etag),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_pypi_cache_evicts_least_recently_used(tmp_path):
+    other_data = dict(SAMPLEPROJECT_DATA, info={'version': '0.1'})
+    fake_pypi = FakePyPI(a=SAMPLEPROJECT_DATA, b=other_data)
+    async with fake_pypi as index_url:
+        cache = PyPICache(cache_dir=tmp_path, index_url=index_url,
+                          max_size=len(json.dumps(SAMPLEPROJECT_DATA)) + 1024)
+        await cache.fetch('a')
+        await cache.fetch('b')
+        await cache.fetch('b')
+        await cache.fetch('a')
+    assert [name for (name, _) in fake_pypi.requests] == ['a', 'b', 'a']
+    assert len(list((tmp_path / 'blobs').iterdir())) == 1
+
+
+@pytest.mark.asyncio
+async def test_pypi_cache_package_not_found(tmp_path):
+    async with FakePyPI() as index_url:
+        cache = PyPICache(cache_dir=tmp_path, index_url=index_url)
+        with pytest.raises(PackageNotFound):
+            await cache.fetch('xxx')
+
+
+@pytest.mark.asyncio
+async def test_pypi_cache_shares_session():
+    fake_pypi = FakePyPI(a=SAMPLEPROJECT_DATA, b=SAMPLEPROJECT_DATA)
+    async with fake_pypi as index_url:
+        cache = PyPICache(index_url=index_url, max_connections=1)
+        session = cache.session()
+        await asyncio.gather(cache.fetch('a'), cache.fetch('b'))
+        assert cache.session() is session
+        assert session.connector is not None
+        assert session.connector.limit == 1
+        await cache.close()
+        assert session.closed
+
+
+@pytest.mark.asyncio
+async def test_pypi_cache_traces_connections(monkeypatch):
+    tracer = ChromeTracer(io.StringIO())
+    monkeypatch.setattr(trace, '_tracer', tracer)
+    fake_pypi = FakePyPI(a=SAMPLEPROJECT_DATA, b=SAMPLEPROJECT_DATA)
+    async with fake_pypi as index_url:
+        cache = PyPICache(index_url=index_url, max_connections=1)
+        await cache.fetch('a')
+        await cache.fetch('b')
+        await cache.close()
+    requests = [r for r in tracer.records if r['name'] == 'http']
+    assert [r['status'] for r in requests] == [200, 200]
+    assert [r['connection'] for r in requests] == [0, 0]
+    # The connection is kept alive and reused
+    assert [r['reused'] for r in requests] == [False, True]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('pep658', [True, False])
+async def test_fetch_wheel_metadata(tmp_path, monkeypatch, pep658):
+    # Big enough to need a second range request for the METADATA file
+    wheel = tmp_path / 'sampleproject-2.0.0-py3-none-any.whl'
+    with zipfile.ZipFile(wheel, 'w') as zf:
+        zf.writestr('sampleproject-2.0.0.dist-info/METADATA',
+                    'Name: sampleproject\nRequires-Dist: peppercorn\n')
+        zf.writestr('sample/data.bin', os.urandom(ZIP_TAIL_SIZE * 2))
+        zf.writestr('sample/__init__.py', '')
+    requests = []
+
+    async def handle(request):
+        requests.append((request.path, request.headers.get('Range')))
+        if request.path.endswith('.metadata'):
+            if not pep658:
+                raise web.HTTPNotFound()
+            with zipfile.ZipFile(wheel) as zf:
+                return web.Response(body=zf.read(
+                    'sampleproject-2.0.0.dist-info/METADATA'))
+        return web.FileResponse(wheel)
+
+    app = web.Application()
+    app.router.add_get('/{filename}', handle)
+    async with TestServer(app) as server:
+        url = str(server.make_url(f'/{wheel.name}'))
+        pypi_cache = PyPICache()
+        try:
+            metadata = await pypi_cache.fetch_wheel_metadata(url)
+            assert metadata is not None
+            assert 'Requires-Dist: peppercorn' in metadata
+            assert await pypi_cache.fetch_wheel_metadata(url) == metadata
+        finally:
+            await pypi_cache.close()
+
+    if pep658:
+        assert len(requests) == 1
+    else:
+        # The .metadata file, the end of the zip and the METADATA member
+        assert len(requests) == 3
+        assert requests[1][1] == f'bytes=-{ZIP_TAIL_SIZE}'
+
+
+@pytest.mark.asyncio
+async def test_fetch_wheel_metadata_big_central_directory(tmp_path,
+                                                          monkeypatch):
+    wheel = tmp_path / 'numpy-2.0.0-py3-none-any.whl'
+    with zipfile.ZipFile(wheel, 'w') as zf:
+        zf.writestr('numpy-2.0.0.dist-info/METADATA', 'Name: numpy\n')
+        for i in range(2000):
+            zf.writestr(f'numpy/core/tests/data/module_{i:05}.py', '')
+        zf.comment = b'x' * 1000
+    with zipfile.ZipFile(wheel) as zf:
+        assert zf.start_dir < wheel.stat().st_size - ZIP_TAIL_SIZE
+    requests = []
+
+    async def handle(request):
+        requests.append(request.headers.get('Range'))
+        if request.path.endswith('.metadata'):
+            raise web.HTTPNotFound()
+        return web.FileResponse(wheel)
+
+    app = web.Application()
+    app.router.add_get('/{filename}', handle)
+    async with TestServer(app) as server:
+        url = str(server.make_url(f'/{wheel.name}'))
+        pypi_cache = PyPICache()
+        try:
+            metadata = await pypi_cache.fetch_wheel_metadata(url)
+        finally:
+            await pypi_cache.close()
+    assert metadata == 'Name: numpy\n'
+    with zipfile.ZipFile(wheel) as zf:
+        cd_end = wheel.stat().st_size - len(zf.comment) - 22
+        # The .metadata file, the end of the zip, the central directory
+        # and the METADATA member
+        assert requests[1:3] == [
+            f'bytes=-{ZIP_TAIL_SIZE}', f'bytes={zf.start_dir}-{cd_end - 1}']
+    assert len(requests) == 4
+
+
+def test_central_directory_range_zip64():
+    # The zip64 record, its locator and the end of central directory
+    # record of a zip whose central directory has 2 entries
+    tail = (
+        b'PK\x06\x06' + (44).to_bytes(8, 'little') + bytes(12) +
+        (2).to_bytes(8, 'little') * 2 + (100).to_bytes(8, 'little') +
+        (2**32).to_bytes(8, 'little') +
+        b'PK\x06\x07' + bytes(4) + (2**32 + 100).to_bytes(8, 'little') +
+        (1).to_bytes(4, 'little') +
+        b'PK\x05\x06' + bytes(8) + b'\xff' * 8 + bytes(2)
+    )
+    assert central_directory_range(tail) == (2**32, 100)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('status', [200, 500])
+async def test_fetch_wheel_metadata_failure(tmp_path, monkeypatch, status):
+    wheel = tmp_path / 'sampleproject-2.0.0-py3-none-any.whl'
+    with zipfile.ZipFile(wheel, 'w') as zf:
+        zf.writestr('sampleproject-2.0.0.dist-info/METADATA',
+                    'Name: sampleproject\n')
+    requests = []
+
+    async def handle(request):
+        requests.append(request.headers.get('Range'))
+        if request.path.endswith('.metadata'):
+            raise web.HTTPNotFound()
+        if len(requests) <= 2:
+            # The server ignores the range or fails the first time
+            return web.Response(status=status, body=wheel.read_bytes())
+        return web.FileResponse(wheel)
+
+    app = web.Application()
+    app.router.add_get('/{filename}', handle)
+    async with TestServer(app) as server:
+        url = str(server.make_url(f'/{wheel.name}'))
+        pypi_cache = PyPICache()
+        try:
+            assert await pypi_cache.fetch_wheel_metadata(url) is None
+            # The failure wasn't persisted, so it is tried again
+            metadata = await pypi_cache.fetch_wheel_metadata(url)
+            assert metadata == 'Name: sampleproject\n'
+        finally:
+            await pypi_cache.close()
+    assert len(requests) == 4
+
+
+@pytest.mark.asyncio
+async def test_wheel_url():
+    pypi = PyPIData(DummyCache(sampleproject=SAMPLEPROJECT_DATA),
+                    wheel_metadata=True)
+    (package,) = await pypi.from_requirement(
+        Requirement('sampleproject==1.3.1'))
+    assert package.wheel_url is not None
+    assert package.wheel_url.endswith('-none-any.whl')
+
+    pypi = PyPIData(DummyCache(sampleproject=SAMPLEPROJECT_DATA))
+    (package,) = await pypi.from_requirement(
+        Requirement('sampleproject==1.3.1'))
+    assert package.wheel_url is None
+
+
+@pytest.mark.asyncio
+async def test_wheel_url_requires_python3():
+    def dist(filename, packagetype='bdist_wheel'):
+        return {'packagetype': packagetype, 'filename': filename,
+                'url': f'https://example.com/{filename}',
+                'digests': {'sha256': '0' * 64}}
+
+    def release(version, *wheels):
+        return [dist(f'sampleproject-{version}.tar.gz', 'sdist')] + [
+            dist(f'sampleproject-{version}-{tags}.whl') for tags in wheels]
+
+    pypi = PyPIData(DummyCache(sampleproject={'releases': {
+        '1.0': release('1.0', 'py2-none-any', 'py3-none-any'),
+        '2.0': release('2.0', 'py2-none-any', 'py2.py3-none-any'),
+        '3.0': release('3.0', 'py2-none-any',
+                       'cp38-cp38-manylinux1_x86_64'),
+    }}), wheel_metadata=True)
+    packages = await pypi.from_requirement(Requirement('sampleproject'))
+    assert [p.wheel_url for p in packages] == [
+        'https://example.com/sampleproject-1.0-py3-none-any.whl',
+        'https://example.com/sampleproject-2.0-py2.py3-none-any.whl',
+        None,
+    ]
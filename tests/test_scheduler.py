@@ -0,0 +1,149 @@
+# pynixify - Nix expression generator for Python packages
+# Copyright (C) 2020 Matías Lang
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import sys
+import asyncio
+import pytest
+from pynixify.scheduler import (
+    Budget,
+    SubprocessScheduler,
+    set_priority,
+    PRIORITY_RESOLVE,
+    PRIORITY_WRITE,
+    PRIORITY_FORMAT,
+)
+
+
+async def hold(budget: Budget, name: str, order: list, **kwargs):
+    async with budget.slot(**kwargs):
+        order.append(name)
+        await asyncio.sleep(0.01)
+
+
+@pytest.mark.asyncio
+async def test_budget_priority():
+    budget = Budget(1)
+    order: list = []
+    await asyncio.gather(
+        hold(budget, 'first', order),
+        hold(budget, 'format', order, priority=PRIORITY_FORMAT),
+        hold(budget, 'resolve', order, priority=PRIORITY_RESOLVE),
+    )
+    assert order == ['first', 'resolve', 'format']
+    assert budget.used == 0
+    assert budget.stats.acquisitions == 3
+    assert budget.stats.max_queue_depth == 2
+
+
+@pytest.mark.asyncio
+async def test_budget_weights():
+    budget = Budget(3)
+    running = []
+    async def run(weight):
+        async with budget.slot(weight):
+            running.append(budget.used)
+            await asyncio.sleep(0.01)
+    await asyncio.gather(run(2), run(2), run(1), run(5))
+    assert max(running) <= 3
+    assert budget.used == 0
+
+
+@pytest.mark.asyncio
+async def test_budget_cancelled_waiter():
+    budget = Budget(1)
+    order: list = []
+    first = asyncio.ensure_future(hold(budget, 'first', order))
+    await asyncio.sleep(0)
+    cancelled = asyncio.ensure_future(hold(budget, 'cancelled', order))
+    await asyncio.sleep(0)
+    cancelled.cancel()
+    await asyncio.gather(first, hold(budget, 'last', order))
+    assert order == ['first', 'last']
+    assert budget.used == 0
+
+
+@pytest.mark.asyncio
+async def test_inherited_priority():
+    budget = Budget(1)
+    order: list = []
+    async def low_priority_task():
+        set_priority(PRIORITY_FORMAT)
+        await asyncio.gather(hold(budget, 'format', order))
+    await asyncio.gather(
+        hold(budget, 'first', order),
+        low_priority_task(),
+        hold(budget, 'resolve', order),
+    )
+    assert order == ['first', 'resolve', 'format']
+
+
+@pytest.mark.asyncio
+async def test_promoted_priority():
+    budget = Budget(1)
+    order: list = []
+    promoted = asyncio.get_running_loop().create_future()
+    async def low_priority_task():
+        promoted.set_result(set_priority(PRIORITY_FORMAT))
+        await hold(budget, 'promoted', order)
+    async def promote():
+        (await promoted).promote(PRIORITY_RESOLVE)
+    await asyncio.gather(
+        hold(budget, 'first', order),
+        low_priority_task(),
+        hold(budget, 'write', order, priority=PRIORITY_WRITE),
+        promote(),
+    )
+    assert order == ['first', 'promoted', 'write']
+    assert not (await promoted).budgets
+
+
+@pytest.mark.asyncio
+async def test_scheduler_run():
+    scheduler = SubprocessScheduler({}, default_limit=2)
+    (status, stdout, stderr) = await scheduler.run(
+        sys.executable, '-c', 'import sys; print(sys.stdin.read().upper())',
+        stdin=b'hello')
+    assert status == 0
+    assert stdout.strip() == b'HELLO'
+    assert scheduler.stats()[sys.executable].acquisitions == 1
+
+
+@pytest.mark.asyncio
+async def test_scheduler_kills_cancelled_process():
+    scheduler = SubprocessScheduler({}, default_limit=1)
+    task = asyncio.ensure_future(scheduler.run(
+        sys.executable, '-c', 'import time; time.sleep(60)'))
+    await asyncio.sleep(0.5)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await asyncio.wait_for(task, timeout=5)
+    assert scheduler.budget(sys.executable).used == 0
+
+
+@pytest.mark.asyncio
+async def test_scheduler_run_streaming():
+    scheduler = SubprocessScheduler({}, default_limit=1)
+    chunks: list = []
+    (status, stderr) = await scheduler.run_streaming(
+        sys.executable, '-c',
+        'import sys\n'
+        'for i in range(3):\n'
+        '    print(i, flush=True)\n'
+        'sys.stderr.write("x" * 2**20)\n',
+        on_stdout=chunks.append)
+    assert status == 0
+    assert b''.join(chunks) == b'0\n1\n2\n'
+    assert len(stderr) == 2**20
@@ -0,0 +1,158 @@
+# pynixify - Nix expression generator for Python packages
+# Copyright (C) 2020 Matías Lang
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import io
+import tarfile
+import pytest
+from pathlib import Path
+from typing import Dict
+from pynixify import cache, package_requirements
+from pynixify.package_requirements import eval_path_requirements
+from pynixify.static_metadata import (
+    is_trivial_setup_py,
+    parse_members,
+    static_source_data,
+)
+
+PYPROJECT = b"""
+[build-system]
+requires = ["setuptools>=61", "setuptools_scm[toml]>=6.2", "wheel"]
+build-backend = "setuptools.build_meta"
+
+[project]
+name = "sample"
+version = "1.0"
+description = "A sample project"
+license = {text = "MIT"}
+dependencies = ["click>=7", 'importlib-metadata; python_version < "3.8"']
+
+[project.optional-dependencies]
+test = ["pytest"]
+docs = ["sphinx"]
+
+[project.urls]
+Homepage = "https://example.com"
+"""
+
+SETUP_CFG = b"""
+[metadata]
+name = sample
+version = attr: sample.__version__
+description = A sample project
+url = https://example.com
+
+[options]
+install_requires =
+    click>=7
+    # a comment
+    requests
+setup_requires = setuptools_scm
+tests_require = pytest
+
+[options.extras_require]
+testing = mock
+"""
+
+TRIVIAL_SETUP_PY = b"""
+'''Docstring'''
+import setuptools
+
+if __name__ == "__main__":
+    setuptools.setup()
+"""
+
+
+def make_sdist(path: Path, members: Dict[str, bytes]) -> Path:
+    with tarfile.open(path, 'w:gz') as tf:
+        for (name, content) in members.items():
+            info = tarfile.TarInfo(f'sample-1.0/{name}')
+            info.size = len(content)
+            tf.addfile(info, io.BytesIO(content))
+    return path
+
+
+def test_pyproject(tmp_path):
+    sdist = make_sdist(tmp_path / 'sample-1.0.tar.gz', {
+        'pyproject.toml': PYPROJECT,
+        'sample/__init__.py': b'',
+    })
+    data = static_source_data(sdist)
+    assert data is not None
+    assert data['build_requirements'] == ['setuptools_scm[toml]>=6.2']
+    assert data['runtime_requirements'] == [
+        'click>=7', 'importlib-metadata; python_version < "3.8"']
+    assert data['test_requirements'] == ['pytest']
+    assert data['metadata'] == {
+        'description': 'A sample project',
+        'license': 'MIT',
+        'url': 'https://example.com',
+    }
+    assert data['version'] == '1.0'
+
+
+def test_setup_cfg(tmp_path):
+    data = parse_members({
+        'setup.cfg': SETUP_CFG,
+        'setup.py': TRIVIAL_SETUP_PY,
+    })
+    assert data is not None
+    assert data['build_requirements'] == ['setuptools_scm']
+    assert data['runtime_requirements'] == ['click>=7', 'requests']
+    assert data['test_requirements'] == ['pytest', 'mock']
+    assert data['metadata']['url'] == 'https://example.com'
+    assert data['version'] is None
+
+
+@pytest.mark.parametrize('members', [
+    # setup.py could add requirements
+    {'setup.cfg': SETUP_CFG, 'setup.py': b'from setuptools import setup\n'
+                                         b'setup(install_requires=["x"])'},
+    {'pyproject.toml': PYPROJECT.replace(
+        b'version = "1.0"', b'dynamic = ["dependencies"]')},
+    {'setup.cfg': SETUP_CFG.replace(
+        b'install_requires =', b'install_requires = file: reqs.txt\nx =')},
+    # pyproject.toml without PEP 621 metadata
+    {'pyproject.toml': b'[build-system]\nrequires = ["setuptools"]\n'},
+    {'setup.py': TRIVIAL_SETUP_PY},
+])
+def test_dynamic_metadata(members):
+    assert parse_members(members) is None
+
+
+def test_trivial_setup_py():
+    assert is_trivial_setup_py(TRIVIAL_SETUP_PY)
+    assert is_trivial_setup_py(b'from setuptools import setup\nsetup()\n')
+    assert not is_trivial_setup_py(b'from setuptools import setup\n')
+    assert not is_trivial_setup_py(
+        b'import setuptools\nimport os\nos.system("x")\nsetuptools.setup()')
+    assert not is_trivial_setup_py(b'setup(')
+
+
+@pytest.mark.asyncio
+async def test_eval_static_sdist_without_build(tmp_path, monkeypatch):
+    async def run_nix_build(*args):
+        raise AssertionError('static metadata must not be built')
+    monkeypatch.setattr(package_requirements, 'run_nix_build', run_nix_build)
+    monkeypatch.setattr(package_requirements, '_evaluations', {})
+    monkeypatch.setattr(cache, '_cache_dir', None)
+    monkeypatch.setattr(cache, '_database', None)
+
+    sdist = make_sdist(tmp_path / 'sample-1.0.tar.gz', {
+        'pyproject.toml': PYPROJECT,
+    })
+    reqs = await eval_path_requirements(sdist)
+    assert [str(r) for r in reqs.build_requirements] == [
+        'setuptools_scm[toml]>=6.2']
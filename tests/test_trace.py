@@ -0,0 +1,145 @@
+import gc
+import io
+import sys
+import json
+import asyncio
+import pytest
+from pynixify import trace
+from pynixify.scheduler import SubprocessScheduler
+from pynixify.trace import (
+    ChromeTracer,
+    Lanes,
+    Tracer,
+    chrome_trace,
+    event,
+    span,
+)
+
+
+@pytest.fixture
+def records(monkeypatch):
+    fp = io.StringIO()
+    monkeypatch.setattr(trace, '_tracer', Tracer(fp))
+
+    def read():
+        return [json.loads(line) for line in fp.getvalue().splitlines()]
+    return read
+
+
+def test_span(records):
+    with span('outer', package='a') as record:
+        record['extra'] = 1
+        with span('inner'):
+            event('something', value=2)
+    (something, inner, outer) = records()
+    assert outer['name'] == 'outer' and outer['type'] == 'span'
+    assert outer['package'] == 'a' and outer['extra'] == 1
+    assert outer['parent'] is None
+    assert outer['start'] <= inner['start'] <= inner['end'] <= outer['end']
+    assert inner['parent'] == outer['id']
+    assert something['type'] == 'event'
+    assert something['parent'] == inner['id']
+    assert 'error' not in outer
+
+
+def test_span_error(records):
+    with pytest.raises(ValueError):
+        with span('failing'):
+            raise ValueError()
+    (failing,) = records()
+    assert failing['error'] == 'ValueError'
+
+
+@pytest.mark.asyncio
+async def test_tasks_inherit_parent(records):
+    async def child():
+        with span('child'):
+            await asyncio.sleep(0)
+
+    with span('parent') as parent:
+        await asyncio.gather(child(), child())
+    children = [r for r in records() if r['name'] == 'child']
+    assert len(children) == 2
+    assert all(r['parent'] == parent['id'] for r in children)
+
+
+@pytest.mark.asyncio
+async def test_task_ids_are_not_reused(records):
+    async def child():
+        with span('child'):
+            await asyncio.sleep(0)
+
+    for _ in range(5):
+        # The finished task is garbage collected, so the next one could
+        # have the same id()
+        await asyncio.ensure_future(child())
+        gc.collect()
+    assert len({r['task'] for r in records()}) == 5
+
+
+def test_disabled():
+    assert trace.get_tracer() is None
+    with span('nothing') as record:
+        record['ignored'] = True
+    event('nothing')
+
+
+@pytest.mark.asyncio
+async def test_subprocess_wait(records):
+    scheduler = SubprocessScheduler({}, default_limit=1)
+    await asyncio.gather(*(
+        scheduler.run(sys.executable, '-c', 'import time; time.sleep(0.1)')
+        for _ in range(2)
+    ))
+    spans = sorted(records(), key=lambda r: r['wait'])
+    assert [r['name'] for r in spans] == ['subprocess', 'subprocess']
+    assert all(r['status'] == 0 for r in spans)
+    # The second process waited for the first one to finish
+    assert spans[1]['wait'] >= 0.1
+
+
+def test_lanes():
+    lanes = Lanes()
+    assert [lanes.acquire() for _ in range(3)] == [0, 1, 2]
+    lanes.release(1)
+    assert lanes.acquire() == 1
+    assert lanes.acquire() == 3
+
+
+@pytest.mark.asyncio
+async def test_chrome_trace(monkeypatch):
+    tracer = ChromeTracer(io.StringIO())
+    monkeypatch.setattr(trace, '_tracer', tracer)
+    scheduler = SubprocessScheduler({}, default_limit=2)
+
+    async def child():
+        with span('child'):
+            await scheduler.run(sys.executable, '-c', 'pass')
+
+    with span('parent'):
+        await asyncio.gather(*(child() for _ in range(3)))
+
+    data = chrome_trace(tracer.records)
+    json.dumps(data)
+    events = data['traceEvents']
+    slices = [e for e in events if e['ph'] == 'X']
+    children = [e for e in slices if e['name'] == 'child']
+    (parent,) = [e for e in slices if e['name'] == 'parent']
+    # Each gathered coroutine runs in its own task track
+    assert len({e['tid'] for e in children}) == 3
+    assert parent['tid'] not in {e['tid'] for e in children}
+    # Processes are drawn in the tracks of the two slots of the budget
+    processes = [e for e in slices if e['name'] == sys.executable]
+    assert len(processes) == 3
+    assert {e['tid'] for e in processes} <= {0, 1}
+    assert len({e['pid'] for e in processes}) == 1
+    assert len([e for e in slices if e['name'] == 'queued']) == 3
+    # Flows from the parent to its children and from the tasks to the
+    # processes
+    flows = [e for e in events if e['ph'] == 's']
+    assert len(flows) == 6
+    assert len([e for e in events if e['ph'] == 'f']) == 6
+
+
+def test_empty_chrome_trace():
+    assert chrome_trace([]) == {'traceEvents': []}
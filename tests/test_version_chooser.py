@@ -15,8 +15,10 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import json
+import asyncio
 import pytest
 from pathlib import Path
+from typing import Dict, List, Tuple
 from pynixify.base import Package
 from packaging.requirements import Requirement
 from pynixify.package_requirements import PackageRequirements
@@ -30,6 +32,7 @@ from pynixify.pypi_api import (
 )
 from pynixify.version_chooser import (
     VersionChooser,
+    BacktrackingVersionChooser,
     ChosenPackageRequirements,
 )
 from pynixify.exceptions import (
@@ -66,6 +69,20 @@ MULTIVERSION_DATA = {
     ]
 }
 
+# Every version of f depends on g, which is only compatible with a<2.4
+BACKTRACKING_DATA = dict(MULTIVERSION_DATA, **{
+    "f": [
+        {"attr": f"f{i}", "pypiName": "f", "version": f"{i}.0"}
+        for i in range(1, 6)
+    ],
+    "g": [{"attr": "g", "pypiName": "g", "version": "1.0"}],
+})
+
+BACKTRACKING_REQUIREMENTS: Dict[str, Tuple[list, list, list]] = dict(
+    {f"f{i}": ([], [], [Requirement('g')]) for i in range(1, 6)},
+    g=([], [], [Requirement('a<2.4')]),
+)
+
 dummy_pypi = PyPIData(DummyCache())
 
 
@@ -392,3 +409,266 @@ async def test_require_local_package():
     assert c.package_for('flask')
     src = await sampleproject.source()
     assert src == Path('/src')
+
+
+@pytest.mark.asyncio
+async def test_greedy_fails_without_backtracking():
+    nixpkgs = NixpkgsData(BACKTRACKING_DATA)
+    c = VersionChooser(nixpkgs, dummy_pypi,
+                       dummy_package_requirements(BACKTRACKING_REQUIREMENTS))
+    await c.require(Requirement('a'))
+    with pytest.raises(NoMatchingVersionFound):
+        await c.require(Requirement('f'))
+
+
+@pytest.mark.asyncio
+async def test_backtracking():
+    nixpkgs = NixpkgsData(BACKTRACKING_DATA)
+    c = BacktrackingVersionChooser(
+        nixpkgs, dummy_pypi,
+        dummy_package_requirements(BACKTRACKING_REQUIREMENTS))
+    await c.require(Requirement('a'))
+    await c.require(Requirement('f'))
+    assert_version(c, 'a', '2.3')
+    assert_version(c, 'f', '5.0')
+    assert_version(c, 'g', '1.0')
+
+
+@pytest.mark.asyncio
+async def test_backtracking_concurrent_requires():
+    nixpkgs = NixpkgsData(BACKTRACKING_DATA)
+    c = BacktrackingVersionChooser(
+        nixpkgs, dummy_pypi,
+        dummy_package_requirements(BACKTRACKING_REQUIREMENTS))
+    await asyncio.gather(c.require(Requirement('a')),
+                         c.require(Requirement('f')))
+    assert_version(c, 'a', '2.3')
+    assert {p.attr for p in c.all_packages().values()} == {'a2', 'f5', 'g'}
+
+
+@pytest.mark.asyncio
+async def test_backtracking_require_all_resolves_once(monkeypatch):
+    nixpkgs = NixpkgsData(BACKTRACKING_DATA)
+    c = BacktrackingVersionChooser(
+        nixpkgs, dummy_pypi,
+        dummy_package_requirements(BACKTRACKING_REQUIREMENTS))
+    resolutions: List[List[str]] = []
+    resolve = c._resolve
+
+    async def counting_resolve(roots: List[Requirement]):
+        resolutions.append([str(r) for r in roots])
+        await resolve(roots)
+
+    monkeypatch.setattr(c, '_resolve', counting_resolve)
+    await c.require_all([
+        Requirement('a'),
+        Requirement('f'),
+        Requirement('g; python_version < "3"'),
+    ])
+    assert resolutions == [['a', 'f']]
+    assert_version(c, 'a', '2.3')
+    assert_version(c, 'f', '5.0')
+
+
+@pytest.mark.asyncio
+async def test_backtracking_is_bounded():
+    nixpkgs = NixpkgsData(BACKTRACKING_DATA)
+    c = BacktrackingVersionChooser(
+        nixpkgs, dummy_pypi,
+        dummy_package_requirements(BACKTRACKING_REQUIREMENTS),
+        max_backtracks=3)
+    await c.require(Requirement('a'))
+    with pytest.raises(NoMatchingVersionFound):
+        await c.require(Requirement('f'))
+
+
+@pytest.mark.asyncio
+async def test_backtracking_no_matching_version():
+    nixpkgs = NixpkgsData(BACKTRACKING_DATA)
+    c = BacktrackingVersionChooser(
+        nixpkgs, dummy_pypi,
+        dummy_package_requirements(BACKTRACKING_REQUIREMENTS))
+    await c.require(Requirement('a>=2.4'))
+    with pytest.raises(NoMatchingVersionFound):
+        await c.require(Requirement('f'))
+
+
+@pytest.mark.asyncio
+async def test_backtracking_invalid_package():
+    nixpkgs = NixpkgsData(BACKTRACKING_DATA)
+    c = BacktrackingVersionChooser(
+        nixpkgs, dummy_pypi, dummy_package_requirements())
+    with pytest.raises(PackageNotFound):
+        await c.require(Requirement('invalid'))
+
+
+@pytest.mark.asyncio
+async def test_backtracking_caches_requirements():
+    nixpkgs = NixpkgsData(BACKTRACKING_DATA)
+    evaluated: List[str] = []
+    reqs_f = dummy_package_requirements(BACKTRACKING_REQUIREMENTS)
+
+    async def counting_reqs_f(package: Package) -> PackageRequirements:
+        evaluated.append(package.attr)
+        return await reqs_f(package)
+
+    c = BacktrackingVersionChooser(nixpkgs, dummy_pypi, counting_reqs_f)
+    await c.require(Requirement('a'))
+    await c.require(Requirement('f'))
+    assert len(evaluated) == len(set(evaluated))
+
+
+@pytest.mark.asyncio
+async def test_backtracking_prefers_nixpkgs():
+    nixpkgs = NixpkgsData(NIXPKGS_SAMPLEPROJECT)
+    pypi = PyPIData(DummyCache(sampleproject=SAMPLEPROJECT_DATA))
+    c = BacktrackingVersionChooser(nixpkgs, pypi, dummy_package_requirements())
+    await c.require(Requirement('sampleproject'))
+    assert isinstance(c.package_for('sampleproject'), NixPackage)
+    assert_version(c, 'sampleproject', '1.0')
+
+    c = BacktrackingVersionChooser(nixpkgs, pypi, dummy_package_requirements())
+    await c.require(Requirement('sampleproject>1.0'))
+    assert isinstance(c.package_for('sampleproject'), PyPIPackage)
+    assert_version(c, 'sampleproject', '1.3.1')
+
+
+@pytest.mark.asyncio
+async def test_backtracking_speculates_pending_packages():
+    data = {
+        name: [{"attr": name, "pypiName": name, "version": "1.0"}]
+        for name in ['p', 'q1', 'q2', 'q3']
+    }
+    reqs_f = dummy_package_requirements({
+        'p': ([], [], [Requirement('q1'), Requirement('q2'),
+                       Requirement('q3')]),
+    })
+    running = 0
+    max_running = 0
+
+    async def slow_reqs_f(package: Package) -> PackageRequirements:
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.05)
+        running -= 1
+        return await reqs_f(package)
+
+    c = BacktrackingVersionChooser(NixpkgsData(data), dummy_pypi, slow_reqs_f,
+                                   max_speculative=2)
+    await c.require(Requirement('p'))
+    assert {p.attr for p in c.all_packages().values()} == {
+        'p', 'q1', 'q2', 'q3'}
+    # While one of the q packages was being decided, the other ones were
+    # evaluated in the background, but no more than max_speculative
+    assert max_running == 3
+    assert not c._speculations
+
+
+@pytest.mark.asyncio
+async def test_backtracking_promotes_needed_speculations():
+    from pynixify.scheduler import Budget, PRIORITY_RESOLVE, get_priority
+    data = {
+        name: [{"attr": name, "pypiName": name, "version": "1.0"}]
+        for name in ['p', 'q1', 'q2']
+    }
+    reqs_f = dummy_package_requirements({
+        'p': ([], [], [Requirement('q1'), Requirement('q2')]),
+    })
+    budget = Budget(1)
+    order = []
+
+    async def budgeted_reqs_f(package: Package) -> PackageRequirements:
+        if package.attr != 'p':
+            async with budget.slot():
+                order.append((package.attr, get_priority()))
+        return await reqs_f(package)
+
+    async def competitor():
+        async with budget.slot(priority=PRIORITY_RESOLVE + 1):
+            order.append(('competitor', PRIORITY_RESOLVE + 1))
+
+    await budget.acquire()
+    competing = asyncio.ensure_future(competitor())
+    c = BacktrackingVersionChooser(NixpkgsData(data), dummy_pypi,
+                                   budgeted_reqs_f, max_speculative=2)
+    resolving = asyncio.ensure_future(c.require(Requirement('p')))
+    # Both q packages are speculated, and the resolver waits for one
+    await asyncio.sleep(0.05)
+    budget.release()
+    await asyncio.gather(competing, resolving)
+    # The package needed by the resolver went before the competitor,
+    # and the other one after it
+    assert [name for (name, _) in order][1] == 'competitor'
+    assert order[0][1] == PRIORITY_RESOLVE
+    assert {order[0][0], order[2][0]} == {'q1', 'q2'}
+
+
+@pytest.mark.asyncio
+async def test_backtracking_cancelled_speculation_is_promoted():
+    from pynixify.scheduler import Budget, PRIORITY_RESOLVE, get_priority
+    from pynixify.version_chooser import _ResolutionState
+    data = {
+        name: [{"attr": name, "pypiName": name, "version": "1.0"}]
+        for name in ['q1', 'q2']
+    }
+    reqs_f = dummy_package_requirements()
+    # Stands for the nix-build budget, which is full until released
+    budget = Budget(1)
+    started: List[str] = []
+    priorities = {}
+
+    async def budgeted_reqs_f(package: Package) -> PackageRequirements:
+        started.append(package.attr)
+        async with budget.slot():
+            priorities[package.attr] = get_priority()
+        return await reqs_f(package)
+
+    await budget.acquire()
+    c = BacktrackingVersionChooser(NixpkgsData(data), dummy_pypi,
+                                   budgeted_reqs_f, max_speculative=1)
+
+    def speculate(name: str):
+        c._speculate(_ResolutionState(
+            decisions={}, constraints={name: [(Requirement(name), None)]},
+        ), [name])
+
+    speculate('q1')
+    await asyncio.sleep(0.01)
+    # Done at the end of each resolution
+    c._cancel_speculations(lambda _: True)
+    speculate('q2')
+    await asyncio.sleep(0.01)
+    # The evaluation of q1 is still running, so q2 has to wait for it
+    assert started == ['q1']
+
+    resolving = asyncio.ensure_future(c.require(Requirement('q1')))
+    await asyncio.sleep(0.01)
+    budget.release()
+    await resolving
+    # The resolver reused the speculation and promoted it
+    assert started.count('q1') == 1
+    assert priorities['q1'] == PRIORITY_RESOLVE
+    assert_version(c, 'q1', '1.0')
+
+
+@pytest.mark.asyncio
+async def test_lazy_nixpkgs_data(monkeypatch):
+    from pynixify import nixpkgs_sources
+    from pynixify.nixpkgs_sources import LazyNixpkgsData
+    from .test_nixpkgs_source import fake_lookup_scheduler
+    (calls, scheduler) = fake_lookup_scheduler({
+        'flask': {'attr': 'flask', 'version': '1.1.1', 'src': None},
+        'click': {'attr': 'click', 'version': '7.0', 'src': None},
+        'jinja2': {'attr': 'jinja2', 'version': '2.10.3', 'src': None},
+    })
+    monkeypatch.setattr(nixpkgs_sources, 'scheduler', scheduler)
+    reqs_f = dummy_package_requirements({
+        'flask': ([], [], [Requirement('click'), Requirement('jinja2')]),
+    })
+    c = VersionChooser(LazyNixpkgsData(window=0.01), dummy_pypi, reqs_f)
+    await c.require(Requirement('flask'))
+    assert_version(c, 'click', '7.0')
+    assert_version(c, 'jinja2', '2.10.3')
+    # One batch per level of the dependency graph
+    assert len(calls) == 2